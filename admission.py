@@ -0,0 +1,310 @@
+"""Admission control for LLM-bound endpoints.
+
+Every request to a limited view goes through, in order:
+1. a per-user token bucket (AQUAAI_USER_RATE_PER_MIN, burst AQUAAI_USER_BURST) -> 429
+2. a per-user concurrency cap, counting queued requests (AQUAAI_USER_CONCURRENCY) -> 429
+3. a global pool of AQUAAI_LLM_SLOTS slots. When all are busy the request waits in a
+   short fair queue: one FIFO per user, served round-robin, so a user with many
+   queued requests cannot starve the others. When the queue is full, a newcomer
+   takes the place of the newest request of the user queueing the most; if there
+   is none, or the expected wait exceeds AQUAAI_ADMISSION_MAX_WAIT, the request
+   gets 503 right away instead of timing out later.
+
+Rejections carry Retry-After. Users are keyed on the session username (the client
+address for anonymous requests).
+
+Batches (/api/batch) pass the per-user checks once for the whole request (enter /
+leave) and then take one global slot per LLM call (acquire_bulk / release_bulk).
+Bulk calls are never rejected: they wait in their own queue and only get a slot
+when no interactive request is queued.
+
+Run ``python admission.py`` for an overload simulation: one heavy user and several
+light ones against a small slot pool.
+"""
+import functools
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+LLM_SLOTS = int(os.environ.get('AQUAAI_LLM_SLOTS', '8'))
+USER_CONCURRENCY = int(os.environ.get('AQUAAI_USER_CONCURRENCY', '2'))
+USER_RATE_PER_MIN = float(os.environ.get('AQUAAI_USER_RATE_PER_MIN', '30'))
+USER_BURST = float(os.environ.get('AQUAAI_USER_BURST', '10'))
+QUEUE_SIZE = int(os.environ.get('AQUAAI_ADMISSION_QUEUE', '32'))
+MAX_WAIT = float(os.environ.get('AQUAAI_ADMISSION_MAX_WAIT', '15'))
+WAIT_WINDOW = 500
+
+
+class Rejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def rejection_response(error):
+    """Flask (response, status) for a Rejected, with its Retry-After header."""
+    from flask import jsonify
+    response = jsonify({'error': error.reason})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status
+
+
+class _Waiter:
+    __slots__ = ('user', 'event', 'granted')
+
+    def __init__(self, user):
+        self.user = user
+        self.event = threading.Event()
+        self.granted = False
+
+
+class AdmissionController:
+    def __init__(self, slots=LLM_SLOTS, user_concurrency=USER_CONCURRENCY, rate_per_min=USER_RATE_PER_MIN,
+                 burst=USER_BURST, queue_size=QUEUE_SIZE, max_wait=MAX_WAIT):
+        self.slots = slots
+        self.user_concurrency = user_concurrency
+        self.rate = rate_per_min / 60.0
+        self.burst = burst
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._user_active = {}         # user -> running + queued requests
+        self._queues = OrderedDict()   # user -> deque of waiters; order = round-robin turn
+        self._queued = 0
+        self._bulk = deque()           # waiters for bulk (batch) calls; served after the fair queue
+        self._buckets = {}             # user -> [tokens, last_refill]
+        self._service_avg = None       # EWMA of slot hold time, for wait estimates
+        self._waits = deque(maxlen=WAIT_WINDOW)
+        self.metrics = {k: 0 for k in ('admitted', 'queued', 'rate_limited', 'user_concurrency_limited',
+                                       'overloaded', 'queue_timeouts', 'bulk_calls')}
+
+    # -- checks ----------------------------------------------------------------------------
+
+    def _take_token(self, user, now):
+        tokens, last = self._buckets.get(user, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens < 1.0:
+            self._buckets[user] = [tokens, now]
+            return (1.0 - tokens) / self.rate if self.rate else 60.0
+        self._buckets[user] = [tokens - 1.0, now]
+        if len(self._buckets) > 10000:
+            # Drop users whose bucket has refilled completely; they start full again anyway
+            for key in [k for k, (t, ts) in self._buckets.items() if t + (now - ts) * self.rate >= self.burst]:
+                del self._buckets[key]
+        return 0.0
+
+    def _expected_wait(self, position):
+        service = self._service_avg if self._service_avg is not None else 1.0
+        return service * (position / max(1, self.slots))
+
+    def _reject(self, key, status, reason, retry_after):
+        self.metrics[key] += 1
+        raise Rejected(status, reason, max(1, int(retry_after + 0.999)))
+
+    def _check_user(self, user, now):
+        wait = self._take_token(user, now)
+        if wait:
+            self._reject('rate_limited', 429, 'Too many requests, slow down', wait)
+        if self._user_active.get(user, 0) >= self.user_concurrency:
+            self._reject('user_concurrency_limited', 429, 'Too many requests in progress for this user',
+                         self._expected_wait(1))
+
+    # -- acquire / release -----------------------------------------------------------------
+
+    def acquire(self, user):
+        """Block until a slot is granted (returns the time queued) or raise Rejected."""
+        now = time.monotonic()
+        with self._lock:
+            self._check_user(user, now)
+            if self._in_flight < self.slots and not self._queued:
+                self._grant(user)
+                self._waits.append(0.0)
+                return 0.0
+            # Position this request would take (a push-out keeps the queue at its maximum length)
+            expected = self._expected_wait(min(self._queued, self.queue_size - 1) + 1)
+            if expected > self.max_wait or (self._queued >= self.queue_size and not self._push_out(user)):
+                self._reject('overloaded', 503, 'Server busy, try again shortly', expected)
+            waiter = _Waiter(user)
+            self._queues.setdefault(user, deque()).append(waiter)
+            self._queued += 1
+            self._user_active[user] = self._user_active.get(user, 0) + 1
+            self.metrics['queued'] += 1
+
+        with tracing.span('admission.wait', user=user):
+            waiter.event.wait(self.max_wait)
+        waited = time.monotonic() - now
+        with self._lock:
+            if not waiter.granted:
+                queue = self._queues.get(user)
+                timed_out = queue is not None and waiter in queue
+                if timed_out:
+                    queue.remove(waiter)
+                    if not queue:
+                        del self._queues[user]
+                    self._queued -= 1
+                self._release_user(user)
+                self._reject('queue_timeouts' if timed_out else 'overloaded', 503, 'Server busy, try again shortly',
+                             self._expected_wait(self._queued))
+            self._waits.append(waited)
+        return waited
+
+    def _push_out(self, user):
+        """Full queue: evict the newest waiter of the user queueing the most, if that is not this user."""
+        mine = len(self._queues.get(user, ()))
+        longest = max(self._queues, key=lambda u: len(self._queues[u]), default=None)
+        if longest is None or len(self._queues[longest]) <= mine + 1:
+            return False
+        victim = self._queues[longest].pop()
+        self._queued -= 1
+        victim.event.set()  # wakes up ungranted and gets a 503
+        return True
+
+    def _grant(self, user, counted=False):
+        self._in_flight += 1
+        if not counted:
+            self._user_active[user] = self._user_active.get(user, 0) + 1
+        self.metrics['admitted'] += 1
+
+    def _release_user(self, user):
+        left = self._user_active.get(user, 1) - 1
+        if left > 0:
+            self._user_active[user] = left
+        else:
+            self._user_active.pop(user, None)
+
+    def release(self, user, held_seconds):
+        with self._lock:
+            self._in_flight -= 1
+            if user is not None:
+                self._release_user(user)
+            alpha = 0.2
+            self._service_avg = held_seconds if self._service_avg is None else (1 - alpha) * self._service_avg + alpha * held_seconds
+            # Hand freed slots to the next user in round-robin order
+            while self._in_flight < self.slots and self._queues:
+                next_user, queue = self._queues.popitem(last=False)
+                waiter = queue.popleft()
+                if queue:
+                    self._queues[next_user] = queue
+                self._queued -= 1
+                waiter.granted = True
+                self._grant(next_user, counted=True)
+                waiter.event.set()
+            while self._in_flight < self.slots and self._bulk:
+                waiter = self._bulk.popleft()
+                waiter.granted = True
+                self._in_flight += 1
+                waiter.event.set()
+
+    def enter(self, user):
+        """Count a bulk request against the user's rate and concurrency limits, without a slot."""
+        with self._lock:
+            self._check_user(user, time.monotonic())
+            self._user_active[user] = self._user_active.get(user, 0) + 1
+
+    def leave(self, user):
+        with self._lock:
+            self._release_user(user)
+
+    def acquire_bulk(self):
+        """Block until a slot is free for one call of a batch; returns the time queued. Never rejects."""
+        now = time.monotonic()
+        with self._lock:
+            self.metrics['bulk_calls'] += 1
+            if self._in_flight < self.slots and not self._queued and not self._bulk:
+                self._in_flight += 1
+                return 0.0
+            waiter = _Waiter(None)
+            self._bulk.append(waiter)
+        with tracing.span('admission.bulk_wait'):
+            waiter.event.wait()
+        return time.monotonic() - now
+
+    def release_bulk(self, held_seconds):
+        self.release(None, held_seconds)
+
+    def limit(self, user_fn):
+        """Decorator for Flask views; user_fn() returns the key requests are limited on."""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                user = user_fn()
+                try:
+                    self.acquire(user)
+                except Rejected as e:
+                    return rejection_response(e)
+                start = time.monotonic()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self.release(user, time.monotonic() - start)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = dict(self.metrics)
+            stats.update(slots=self.slots, in_flight=self._in_flight, queue_length=self._queued,
+                         queued_users=len(self._queues), bulk_queue_length=len(self._bulk),
+                         service_ms_avg=round(self._service_avg * 1000.0, 1) if self._service_avg is not None else None)
+
+        def pct(p):
+            return round(waits[min(len(waits) - 1, int(p * len(waits)))] * 1000.0, 1) if waits else None
+        stats.update(queue_wait_p50_ms=pct(0.50), queue_wait_p95_ms=pct(0.95), queue_wait_max_ms=pct(1.0))
+        return stats
+
+
+def _simulate(label, controller, users, service=0.05):
+    """users: {name: number of requests fired at once}."""
+    outcomes = {}
+
+    def one(user):
+        try:
+            waited = controller.acquire(user)
+        except Rejected as e:
+            return user, e.status, None
+        start = time.monotonic()
+        time.sleep(service)
+        controller.release(user, time.monotonic() - start)
+        return user, 200, waited
+
+    requests = [u for u, n in users.items() for _ in range(n)]
+    with ThreadPoolExecutor(max_workers=len(requests)) as pool:
+        for user, status, waited in pool.map(one, requests):
+            entry = outcomes.setdefault(user, {'ok': 0, 429: 0, 503: 0, 'max_wait_ms': 0.0})
+            entry['ok' if status == 200 else status] += 1
+            if waited is not None:
+                entry['max_wait_ms'] = max(entry['max_wait_ms'], round(waited * 1000.0, 1))
+    stats = controller.stats()
+    print(f"-- {label}: p50 wait {stats['queue_wait_p50_ms']}ms, p95 {stats['queue_wait_p95_ms']}ms, "
+          f"rejected 429={stats['rate_limited'] + stats['user_concurrency_limited']} "
+          f"503={stats['overloaded'] + stats['queue_timeouts']}")
+    for user, entry in sorted(outcomes.items()):
+        print(f"   {user:<8} {entry}")
+
+
+def main():
+    _simulate('under capacity', AdmissionController(slots=8, user_concurrency=4, rate_per_min=6000, burst=50),
+              {'alice': 3, 'bob': 3})
+    _simulate('heavy user vs light users', AdmissionController(slots=4, user_concurrency=20, rate_per_min=6000,
+                                                               burst=50, queue_size=8, max_wait=2.0),
+              {'heavy': 20, 'light1': 2, 'light2': 2, 'light3': 2})
+    _simulate('per-user concurrency cap', AdmissionController(slots=8, user_concurrency=2, rate_per_min=6000, burst=50),
+              {'alice': 6, 'bob': 2})
+    _simulate('token bucket (burst 3)', AdmissionController(slots=8, user_concurrency=10, rate_per_min=60, burst=3),
+              {'alice': 6})
+    controller = AdmissionController(slots=2, user_concurrency=50, rate_per_min=6000, burst=100,
+                                     queue_size=40, max_wait=0.3)
+    controller._service_avg = 0.05
+    _simulate('overload, 0.3s queue deadline', controller, {f'u{i}': 4 for i in range(10)})
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
-from flask import Flask, request, jsonify, send_from_directory, session, redirect
-from chatbot_core import langgraph_app, VECTORSTORE_DIR, set_vectorstore, LLM_AVAILABLE, EMBEDDINGS_AVAILABLE
-from indexer import index_documents
-from langchain_community.vectorstores import FAISS
+from flask import Flask, request, jsonify, send_from_directory, session, redirect, g, Response, stream_with_context
+from chatbot_core import langgraph_app, VECTORSTORE_DIR, set_vectorstore, refresh_tombstones, LLM_AVAILABLE, EMBEDDINGS_AVAILABLE, EMBEDDINGS_ID, answer_cache, retrieval_cache_stats, vectorstore_stats, intent_router, llm_invoker, set_history_loader, speculate_retrieval, retrieval_sessions
+from indexer import index_documents, load_vectorstore, delete_document, compact_vectorstore, ReindexRequiredError
+from sharded_store import make_scope
+from llm_invoke import new_deadline, CircuitOpenError, LLMTimeoutError
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime, timedelta
 import sqlite3
@@ -9,15 +10,57 @@ from datetime import datetime
 import os
 from dotenv import load_dotenv
 import uuid
+import threading
+import contextlib
+import json
 from image_handler import process_image
+import tracing
+import profiling
+from message_log import create_message_log
+from admission import AdmissionController, Rejected, rejection_response
+import static_assets
+import thumbnails
+import chat_search
+import archive
+import batch_qa
+import warmup
+import chatbot_core
 OCR_AVAILABLE = True
 
 app = Flask(__name__, static_folder='static')
 load_dotenv()
 
+# Hashed + precompressed copies of static/ (see static_assets.py); pages fall back to static/ if this fails
+try:
+    static_assets.build()
+except OSError as e:
+    print(f"Static asset build failed, serving static/ directly: {e}")
+
 # Secret key for session management (set SECRET_KEY in your environment for production)
 app.secret_key = os.environ.get('SECRET_KEY', 'dev-secret-change-me')
 
+
+# Request tracing: one root span per HTTP request (see tracing.py)
+@app.before_request
+def start_request_trace():
+    route = request.url_rule.rule if request.url_rule else request.path
+    g.trace = tracing.start_trace(f"{request.method} {route}", trace_id=request.headers.get('X-Trace-Id'))
+
+
+@app.after_request
+def tag_request_trace(response):
+    root = g.get('trace')
+    if root is not None:
+        root.set(status=response.status_code)
+        response.headers['X-Trace-Id'] = root.trace_id
+    return response
+
+
+@app.teardown_request
+def end_request_trace(exc):
+    tracing.end_trace(g.pop('trace', None), error=exc)
+
+
 # Database migration and setup functions
 def ensure_database_schema():
     """Ensure database has the correct schema"""
@@ -72,7 +115,7 @@ migrate_database()
 
 # SQLite database setup
 def setup_db():
-    conn = sqlite3.connect("chat_history.db")
+    conn = sqlite3.connect("chat_history.db", factory=tracing.TracedConnection)
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS conversations (
@@ -83,6 +126,8 @@ def setup_db():
             message TEXT
         )
     """)
+    # Every per-chat read (history, chat view, archival) is a range scan on this
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_conversations_chat ON conversations (chat_id, id)")
     # Chat metadata table with proper naming
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS chat_metadata (
@@ -120,31 +165,70 @@ def setup_db():
     except Exception:
         # Likely column already exists; ignore
         pass
+    # Scope of uploaded documents (see indexer.setup_db)
+    for column in ('chat_id TEXT', 'uploader TEXT'):
+        try:
+            cursor.execute(f"ALTER TABLE documents ADD COLUMN {column}")
+        except Exception:
+            pass
     conn.commit()
     return conn
 
+# Chat messages are persisted write-behind (see message_log.py)
+message_log = create_message_log("chat_history.db")
+
+# Full-text index over conversations, kept in sync by triggers (see chat_search.py)
+_conn = setup_db()
+SEARCH_AVAILABLE = chat_search.ensure_index(_conn)
+_conn.close()
+
+# Chats inactive for AQUAAI_ARCHIVE_AFTER_DAYS move to the compressed archive (see archive.py)
+archive.start_scheduler("chat_history.db", message_log)
+
+# Open API connections, touch the index and prime SQLite before the first requests need them (see warmup.py)
+warmup.start([
+    ('imports', warmup.warm_imports),
+    ('http', lambda: warmup.warm_http(chatbot_core.llm)),
+    ('index', lambda: warmup.warm_index(chatbot_core.vectorstore)),
+    ('retrieval', lambda: warmup.warm_retrieval(chatbot_core.embed_question, chatbot_core.search_by_vector,
+                                                chatbot_core.vectorstore)),
+    ('sqlite', lambda: warmup.warm_sqlite("chat_history.db")),
+])
+DEFAULT_CHAT_NAME = 'New AquaAI Chat'
+
 def save_message(conn, chat_id, role, message):
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO conversations (chat_id, timestamp, role, message) VALUES (?, ?, ?, ?)",
-        (chat_id, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), role, message)
-    )
-    conn.commit()
+    """Queue a message for the background writer. ``conn`` is unused but kept for callers."""
+    message_log.append(chat_id, role, message)
 
 def get_conversation_history(conn, chat_id, limit=5):
+    # Only a stat of the archive file unless this chat is archived (see archive.is_archived)
+    archive.rehydrate(chat_id)
     cursor = conn.cursor()
-    cursor.execute(
-        "SELECT role, message FROM conversations WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
-        (chat_id, limit*2)
-    )
-    rows = cursor.fetchall()
+    with message_log.consistent_read(conn, chat_id) as pending:
+        cursor.execute(
+            "SELECT role, message FROM conversations WHERE chat_id = ? ORDER BY id DESC LIMIT ?",
+            (chat_id, limit*2)
+        )
+        rows = cursor.fetchall()
     rows.reverse()
+    rows.extend((role, msg) for _, role, msg in pending)
+    rows = rows[-limit*2:]
     history = ""
     for role, msg in rows:
         prefix = "User" if role == 'user' else "Assistant"
         history += f"{prefix}: {msg}\n"
     return history
 
+def load_history(chat_id):
+    """History for the graph's history node, which runs on its own thread next to retrieval."""
+    conn = setup_db()
+    try:
+        return get_conversation_history(conn, chat_id)
+    finally:
+        conn.close()
+
+set_history_loader(load_history)
+
 def create_chat_metadata(conn, chat_id, chat_name, username):
     """Create or update chat metadata with proper naming"""
     cursor = conn.cursor()
@@ -209,15 +293,42 @@ def update_chat_name(conn, chat_id, new_name):
     )
     conn.commit()
 
+def is_admin_session():
+    """Admin = the configured ADMIN_USER, or any user listed in AQUAAI_ADMIN_USERS (comma separated)."""
+    if not session.get('logged_in'):
+        return False
+    admins = {u.strip() for u in os.environ.get('AQUAAI_ADMIN_USERS', '').split(',') if u.strip()}
+    admins.add(os.environ.get('ADMIN_USER', 'admin'))
+    return session.get('username') in admins
+
+# Bounds concurrent LLM-bound requests globally and per user; see admission.py
+admission_controller = AdmissionController()
+
+
+def admission_key():
+    return session.get('username') or f"ip:{request.remote_addr}"
+
 # Note: the LangGraph workflow is defined in chatbot_core.py and imported as langgraph_app.
 
+def serve_page(name):
+    response = static_assets.send_page(name)
+    return response if response is not None else send_from_directory('static', name)
+
 # Flask Routes
 @app.route('/')
 def serve_index():
     # Require login for main UI
     if not session.get('logged_in'):
         return redirect('/login')
-    return send_from_directory('static', 'index.html')
+    return serve_page('index.html')
+
+
+@app.route('/assets/<path:filename>')
+def serve_asset(filename):
+    response = static_assets.send_asset(filename)
+    if response is None:
+        return jsonify({'error': 'Not found'}), 404
+    return response
 
 
 @app.route('/login', methods=['GET'])
@@ -229,7 +340,7 @@ def login_page():
     if os.path.exists(auth_path):
         return send_from_directory(os.path.join('static', 'auth'), 'login.html')
     # fallback to the top-level static login page
-    return send_from_directory('static', 'login.html')
+    return serve_page('login.html')
 
 
 @app.route('/login', methods=['POST'])
@@ -272,7 +383,7 @@ def forgot_page():
     auth_path = os.path.join('static', 'auth', 'forgot.html')
     if os.path.exists(auth_path):
         return send_from_directory(os.path.join('static', 'auth'), 'forgot.html')
-    return send_from_directory('static', 'forgot.html')
+    return serve_page('forgot.html')
 
 
 @app.route('/api/chats', methods=['GET'])
@@ -336,6 +447,29 @@ def get_chats():
     return jsonify(chats)
 
 
+@app.route('/api/search', methods=['GET'])
+def search_messages():
+    """Ranked full-text hits in the user's chats: ?q=<words>&page=1&page_size=20."""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not SEARCH_AVAILABLE:
+        return jsonify({'error': 'Search is not available (SQLite without FTS5)'}), 503
+    text = (request.args.get('q') or '').strip()
+    if not chat_search.build_query(text):
+        return jsonify({'error': 'q is required'}), 400
+    page = request.args.get('page', 1, type=int)
+    page_size = request.args.get('page_size', 20, type=int)
+    # Make messages still queued in the write-behind log searchable too
+    message_log.flush()
+    conn = setup_db()
+    try:
+        with tracing.span('search.fts', q_len=len(text), page=page):
+            results, has_more = chat_search.search(conn, session.get('username'), text, page, page_size)
+    finally:
+        conn.close()
+    return jsonify({'query': text, 'page': max(1, page), 'results': results, 'has_more': has_more})
+
+
 @app.route('/logout', methods=['POST'])
 def logout():
     session.clear()
@@ -487,6 +621,63 @@ def update_user():
         return jsonify({'error': str(e)}), 400
 
 
+def _legacy_avatar_file(value):
+    """Local file of an avatar stored before thumbnails (uploads/avatar_<uuid>.png), or None."""
+    if value.startswith('http') or thumbnails.digest_from_url(value):
+        return None
+    path = os.path.join('uploads', os.path.basename(value))
+    return path if os.path.basename(value).startswith('avatar_') and os.path.exists(path) else None
+
+
+def _release_avatar(cursor, old_value):
+    """Delete a replaced avatar's files unless another user still points at them."""
+    if not old_value:
+        return
+    cursor.execute("SELECT COUNT(*) FROM users WHERE avatar = ?", (old_value,))
+    if cursor.fetchone()[0]:
+        return
+    digest = thumbnails.digest_from_url(old_value)
+    if digest:
+        cursor.execute("SELECT COUNT(*) FROM users WHERE avatar LIKE ?", (f"/media/{digest}/%",))
+        if not cursor.fetchone()[0]:
+            thumbnails.remove(digest, 'avatar')
+        return
+    legacy = _legacy_avatar_file(old_value)
+    if legacy:
+        # Another worker may have released the same file already
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(legacy)
+
+
+def migrate_legacy_avatars():
+    """Move pre-thumbnail avatars (uploads/avatar_<uuid>.png) into the media store. Run once at startup."""
+    conn = setup_db()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT username, avatar FROM users WHERE avatar IS NOT NULL AND avatar != ''")
+        migrated = 0
+        for username, old_value in cursor.fetchall():
+            legacy = _legacy_avatar_file(old_value)
+            if not legacy:
+                continue
+            try:
+                with open(legacy, 'rb') as f:
+                    avatar = thumbnails.url(thumbnails.store(f.read(), 'avatar'))
+            except (OSError, thumbnails.ImageRejected) as e:
+                print(f"Avatar migration skipped for {username}: {e}")
+                continue
+            cursor.execute("UPDATE users SET avatar = ? WHERE username = ?", (avatar, username))
+            _release_avatar(cursor, old_value)
+            conn.commit()
+            migrated += 1
+        if migrated:
+            print(f"Moved {migrated} legacy avatar(s) into the media store")
+    finally:
+        conn.close()
+
+migrate_legacy_avatars()
+
+
 @app.route('/api/user/avatar', methods=['POST'])
 def upload_avatar():
     if not session.get('logged_in'):
@@ -496,19 +687,23 @@ def upload_avatar():
     file = request.files['file']
     if not file.mimetype.startswith('image/'):
         return jsonify({'error': 'Image required'}), 400
-    upload_folder = 'uploads'
-    os.makedirs(upload_folder, exist_ok=True)
-    filename = f"avatar_{uuid.uuid4()}.png"
-    path = os.path.join(upload_folder, filename)
-    file.save(path)
+    # Stored once per distinct image, with resized derivatives (see thumbnails.py)
+    try:
+        with tracing.span('file.save', kind='avatar'):
+            digest = thumbnails.store(file.read(), 'avatar')
+    except thumbnails.ImageRejected as e:
+        return jsonify({'error': str(e)}), 400
+    avatar_web = thumbnails.url(digest)
     username = session.get('username')
     conn = setup_db()
     cursor = conn.cursor()
-    cursor.execute("UPDATE users SET avatar = ? WHERE username = ?", (path, username))
+    cursor.execute("SELECT avatar FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    cursor.execute("UPDATE users SET avatar = ? WHERE username = ?", (avatar_web, username))
+    if row and row[0] != avatar_web:
+        _release_avatar(cursor, row[0])
     conn.commit()
     conn.close()
-    # Return a web-friendly avatar URL
-    avatar_web = '/uploads/' + os.path.basename(path)
     return jsonify({'message': 'Avatar uploaded', 'avatar': avatar_web})
 
 
@@ -540,6 +735,8 @@ def change_password():
     return jsonify({'message': 'Password changed'})
 
 @app.route('/api/message', methods=['POST'])
+@admission_controller.limit(admission_key)
+@profiling.profile_request('handle_message', is_admin_session)
 def handle_message():
     data = request.json
     query = data.get('message')
@@ -547,14 +744,20 @@ def handle_message():
     if not query or not chat_id:
         return jsonify({'error': 'Message and chat_id are required'}), 400
 
+    # Retrieval only sees the global collection and this user's uploads selected by `scope`
+    scope = make_scope(data.get('scope'), chat_id, session.get('username'), allow_all=is_admin_session())
+    # Embed + search while the chat metadata and the message are written; the graph joins the result
+    speculate_retrieval(query, scope)
     conn = setup_db()
     
-    # If this is the first user message, create chat metadata with proper name
+    # If this is the first user message, create chat metadata with proper name.
+    # A chat is new when it has no metadata row yet, or still carries the
+    # placeholder name given by POST /api/chats.
     cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM conversations WHERE chat_id = ?", (chat_id,))
-    message_count = cursor.fetchone()[0]
+    cursor.execute("SELECT chat_name FROM chat_metadata WHERE chat_id = ?", (chat_id,))
+    metadata_row = cursor.fetchone()
     
-    if message_count == 0:
+    if metadata_row is None or metadata_row[0] == DEFAULT_CHAT_NAME:
         # This is a new chat - use first user message as chat name (truncated)
         chat_name = query[:30] + '...' if len(query) > 30 else query
         create_chat_metadata(conn, chat_id, chat_name, session.get('username'))
@@ -565,16 +768,58 @@ def handle_message():
         if not LLM_AVAILABLE:
             conn.close()
             return jsonify({'error': 'LLM not configured. Set OPENAI_API_KEY.'}), 500
-        history = get_conversation_history(conn, chat_id)
-        final_state = langgraph_app.invoke({"question": query, "chat_id": chat_id, "history": history})
+        with tracing.span('graph.invoke'):
+            # The graph loads the history itself, in parallel with retrieval
+            final_state = langgraph_app.invoke({"question": query, "chat_id": chat_id,
+                                                "user": session.get('username'), "scope": scope,
+                                                "deadline": new_deadline()})
         answer = final_state.get("final_answer") or final_state.get("raw_response")
         save_message(conn, chat_id, 'assistant', answer)
         conn.close()
         return jsonify({'response': answer})
+    except CircuitOpenError as e:
+        conn.close()
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = str(max(1, int(e.retry_after)))
+        return response, 503
+    except LLMTimeoutError as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 504
     except Exception as e:
         conn.close()
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/batch', methods=['POST'])
+def handle_batch():
+    """Answer a JSONL body of questions; streams one JSON line per answer, then a summary line."""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not LLM_AVAILABLE:
+        return jsonify({'error': 'LLM not configured. Set OPENAI_API_KEY.'}), 500
+    try:
+        items = batch_qa.parse_items(request.get_data(as_text=True).splitlines())
+    except batch_qa.BatchError as e:
+        return jsonify({'error': str(e)}), 400
+    scope = make_scope(request.args.get('scope'), None, session.get('username'), allow_all=is_admin_session())
+    requested = request.args.get('concurrency', batch_qa.BATCH_CONCURRENCY, type=int)
+    concurrency = max(1, min(batch_qa.BATCH_CONCURRENCY, requested))
+    # The batch counts once against the user's limits while it streams; each LLM call takes a global slot
+    user = admission_key()
+    try:
+        admission_controller.enter(user)
+    except Rejected as e:
+        return rejection_response(e)
+
+    def generate():
+        with tracing.span('batch.run', items=len(items)):
+            for line in batch_qa.run_batch(items, scope, concurrency, admission=admission_controller):
+                yield json.dumps(line, ensure_ascii=False) + '\n'
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    # Runs even when the client goes away before the first line (a generator's finally would not)
+    response.call_on_close(lambda: admission_controller.leave(user))
+    return response
+
 @app.route('/api/chats', methods=['POST'])
 def create_chat():
     """Create a new chat with proper metadata"""
@@ -583,7 +828,7 @@ def create_chat():
     
     data = request.json
     chat_id = data.get('chat_id')
-    chat_name = data.get('name', 'New AquaAI Chat')
+    chat_name = data.get('name', DEFAULT_CHAT_NAME)
     
     if not chat_id:
         return jsonify({'error': 'Chat ID is required'}), 400
@@ -595,6 +840,7 @@ def create_chat():
     return jsonify({'success': True, 'chat_id': chat_id, 'name': chat_name})
 
 @app.route('/api/upload', methods=['POST'])
+@profiling.profile_request('handle_upload', is_admin_session)
 def handle_upload():
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
@@ -616,12 +862,16 @@ def handle_upload():
     upload_folder = 'uploads'
     os.makedirs(upload_folder, exist_ok=True)
     file_path = os.path.join(upload_folder, f"{uuid.uuid4()}.pdf")
-    file.save(file_path)
+    with tracing.span('file.save', kind='pdf'):
+        file.save(file_path)
 
     # Index the uploaded file (index_documents will save metadata and persist vectorstore)
     result = None
     try:
-        result = index_documents([file_path], save_metadata=True)
+        with tracing.span('indexer.index_documents'):
+            # Scoped to this chat and uploader; other users never retrieve from it
+            result = index_documents([file_path], save_metadata=True,
+                                     scope={'chat_id': chat_id, 'uploader': session.get('username')})
     except Exception as e:
         # If indexing fails with an exception (rare, indexer usually returns a dict), return an error
         try:
@@ -648,14 +898,10 @@ def handle_upload():
     try:
         if isinstance(result, dict) and result.get('vectorstore_dir'):
             try:
-                from chatbot_core import EMBEDDINGS_AVAILABLE, embeddings
+                from chatbot_core import EMBEDDINGS_AVAILABLE, EMBEDDINGS_ID, embeddings
                 if EMBEDDINGS_AVAILABLE:
-                    # Respect opt-in flag for dangerous pickle loading
-                    allow_deser = os.environ.get('ALLOW_DANGEROUS_DESERIALIZATION', '0') in ('1', 'true', 'True')
-                    if allow_deser:
-                        vs = FAISS.load_local(result['vectorstore_dir'], embeddings, allow_dangerous_deserialization=True)
-                    else:
-                        vs = FAISS.load_local(result['vectorstore_dir'], embeddings)
+                    # load_vectorstore checks the manifest and respects the opt-in pickle flag
+                    vs = load_vectorstore(embeddings, EMBEDDINGS_ID, result['vectorstore_dir'])
                     set_vectorstore(vs)
                 else:
                     # Can't load vectorstore without embeddings configured
@@ -681,6 +927,19 @@ def handle_upload():
     return jsonify({'message': message})
 
 
+def readiness_report():
+    """Warm-up state and current resource use, shown by /api/diagnostics and the admin status page."""
+    store = vectorstore_stats() or {}
+    hit_ratios = {'answers': answer_cache.stats()['hit_ratio']}
+    hit_ratios.update((name, stats['hit_ratio']) for name, stats in retrieval_cache_stats().items())
+    return dict(warmup.stats(), resources={
+        'rss_bytes': warmup.rss_bytes(),
+        'index_bytes': store.get('index_bytes', 0),
+        'chunks': store.get('chunks', 0),
+        'cache_hit_ratios': hit_ratios,
+    })
+
+
 @app.route('/api/diagnostics', methods=['GET'])
 def diagnostics():
     """Return a small diagnostics JSON with environment and feature availability."""
@@ -689,9 +948,11 @@ def diagnostics():
     return jsonify({
         'llm_available': LLM_AVAILABLE,
         'embeddings_available': EMBEDDINGS_AVAILABLE,
+        'embeddings_model': EMBEDDINGS_ID,
         'ocr_available': OCR_AVAILABLE,
         'vectorstore_exists': vs_exists,
         'allow_dangerous_deserialization': allow_deser,
+        'readiness': readiness_report(),
         'env_vars': {
             'OPENAI_API_KEY_set': bool(os.environ.get('OPENAI_API_KEY')),
             'TESSERACT_CMD': os.environ.get('TESSERACT_CMD')
@@ -704,7 +965,17 @@ def uploaded_file(filename):
     # Serve files from the uploads directory
     return send_from_directory('uploads', filename)
 
+
+@app.route('/media/<digest>/<int:size>')
+def media_file(digest, size):
+    response = thumbnails.send(digest, size)
+    if response is None:
+        return jsonify({'error': 'Not found'}), 404
+    return response
+
 @app.route('/api/image', methods=['POST'])
+@admission_controller.limit(admission_key)
+@profiling.profile_request('handle_image', is_admin_session)
 def handle_image():
     """Accept an image upload, run OCR (if available), and ask the LLM to answer a question using the OCR text.
 
@@ -724,48 +995,56 @@ def handle_image():
     if not file.mimetype.startswith('image/'):
         return jsonify({'error': 'Only image files are allowed'}), 400
 
-    upload_folder = 'uploads'
-    os.makedirs(upload_folder, exist_ok=True)
-    # preserve original extension if possible
-    filename = file.filename or f"{uuid.uuid4()}.png"
-    _, ext = os.path.splitext(filename)
-    if not ext:
-        ext = '.png'
-    file_path = os.path.join(upload_folder, f"{uuid.uuid4()}{ext}")
-    file.save(file_path)
-
+    # Checked before anything is written, so a request that cannot be answered stores nothing
     if not OCR_AVAILABLE:
         return jsonify({'error': 'OCR not available. Install Pillow and pytesseract and ensure Tesseract OCR is installed on the system.'}), 500
+    if not LLM_AVAILABLE:
+        return jsonify({'error': 'LLM not configured. Set OPENAI_API_KEY.'}), 500
+
+    # Deduplicated by content; the vision model gets a bounded-size WebP rather than the original
+    try:
+        with tracing.span('file.save', kind='image'):
+            digest = thumbnails.store(file.read(), 'image')
+    except thumbnails.ImageRejected as e:
+        return jsonify({'error': str(e)}), 400
+    file_path = thumbnails.derivative_path(digest, thumbnails.VISION_SIZE, 'webp')
 
     try:
-        if not LLM_AVAILABLE:
-            return jsonify({'error': 'LLM not configured. Set OPENAI_API_KEY.'}), 500
         # pass the configured llm from chatbot_core
         from chatbot_core import llm as configured_llm
         result = process_image(file_path, question, chat_id, configured_llm, setup_db, save_message, get_conversation_history)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+    result['image'] = thumbnails.url(digest)
     return jsonify(result)
 
 @app.route('/api/chats/<chat_id>', methods=['GET'])
 def get_chat_messages(chat_id):
+    # An archived chat is moved back into conversations the first time it is opened
+    archive.rehydrate(chat_id)
     conn = setup_db()
     cursor = conn.cursor()
-    cursor.execute("SELECT role, message, timestamp FROM conversations WHERE chat_id = ? ORDER BY id", (chat_id,))
-    messages = [{'sender': row[0], 'content': row[1], 'time': row[2][-8:-3]} for row in cursor.fetchall()]
+    with message_log.consistent_read(conn, chat_id) as pending:
+        cursor.execute("SELECT role, message, timestamp FROM conversations WHERE chat_id = ? ORDER BY id", (chat_id,))
+        rows = cursor.fetchall()
+    rows.extend((role, msg, ts) for ts, role, msg in pending)
+    messages = [{'sender': row[0], 'content': row[1], 'time': row[2][-8:-3]} for row in rows]
     conn.close()
     return jsonify(messages)
 
 # FIXED: Renamed this endpoint to avoid conflict
 @app.route('/api/chats/<chat_id>', methods=['DELETE'])
 def delete_user_chat(chat_id):
+    message_log.discard(chat_id)
     conn = setup_db()
     cursor = conn.cursor()
     cursor.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
     cursor.execute("DELETE FROM chat_metadata WHERE chat_id = ?", (chat_id,))
     conn.commit()
     conn.close()
+    archive.delete(chat_id=chat_id)
+    retrieval_sessions.drop(chat_id)
     return jsonify({'message': 'Chat deleted'})
 
 @app.route('/api/chats/<chat_id>/rename', methods=['POST'])
@@ -787,7 +1066,7 @@ def admin_dashboard():
     # Simple admin check - you might want to implement proper admin authentication
     if not session.get('logged_in'):
         return redirect('/login')
-    return send_from_directory('static', 'admin.html')
+    return serve_page('admin.html')
 
 @app.route('/api/admin/statistics')
 def admin_statistics():
@@ -944,7 +1223,8 @@ def admin_documents():
         cursor.execute("""
             SELECT id, filename, filepath, uploaded_at, 
                    LENGTH(filepath) as file_size,
-                   filepath LIKE '%vectorstore%' as is_indexed
+                   filepath LIKE '%vectorstore%' as is_indexed,
+                   chat_id, uploader
             FROM documents 
             ORDER BY uploaded_at DESC
         """)
@@ -957,7 +1237,9 @@ def admin_documents():
                 'filepath': row[2],
                 'uploaded_at': row[3],
                 'file_size': row[4],
-                'is_indexed': bool(row[5])
+                'is_indexed': bool(row[5]),
+                'chat_id': row[6],
+                'uploader': row[7]
             })
         
         return jsonify({'documents': documents})
@@ -966,6 +1248,49 @@ def admin_documents():
     finally:
         conn.close()
 
+def compact_and_reload():
+    """Background job: drop tombstoned chunks from the index, then swap in the compacted store."""
+    try:
+        result = compact_vectorstore()
+        if result.get('vectorstore_dir') and EMBEDDINGS_AVAILABLE:
+            from chatbot_core import embeddings
+            set_vectorstore(load_vectorstore(embeddings, EMBEDDINGS_ID, result['vectorstore_dir']))
+    except Exception as e:
+        print('Vectorstore compaction failed:', e)
+
+@app.route('/api/admin/documents/<int:document_id>', methods=['DELETE'])
+def admin_delete_document(document_id):
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not is_admin_session():
+        return jsonify({'error': 'Admin access required'}), 403
+    
+    try:
+        result = delete_document(document_id)
+    except LookupError as e:
+        return jsonify({'error': str(e)}), 404
+    except ReindexRequiredError as e:
+        return jsonify({'error': str(e), 'reindex_required': True}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    # Deleted chunks disappear from search right away; the index is rewritten later
+    refresh_tombstones()
+    if result['compaction_needed']:
+        threading.Thread(target=compact_and_reload, name='vectorstore-compaction', daemon=True).start()
+    return jsonify({'message': 'Document deleted', **result})
+
+@app.route('/api/admin/archive', methods=['POST'])
+def admin_run_archive():
+    """Archive inactive chats and compact the databases now, in the background."""
+    if not session.get('logged_in'):
+        return jsonify({'error': 'Not authenticated'}), 401
+    if not is_admin_session():
+        return jsonify({'error': 'Admin access required'}), 403
+    threading.Thread(target=archive.run, kwargs={'message_log': message_log}, name='chat-archiver-manual',
+                     daemon=True).start()
+    return jsonify({'message': 'Archival started'}), 202
+
 @app.route('/api/admin/system-status')
 def admin_system_status():
     if not session.get('logged_in'):
@@ -982,6 +1307,14 @@ def admin_system_status():
             'ocr_available': OCR_AVAILABLE,
             'vectorstore_exists': vs_exists,
             'allow_dangerous_deserialization': allow_deser,
+            'answer_cache': answer_cache.stats(),
+            'retrieval_caches': retrieval_cache_stats(),
+            'vectorstore': vectorstore_stats(),
+            'intent_router': intent_router.stats(),
+            'llm': llm_invoker.stats(),
+            'admission': admission_controller.stats(),
+            'archive': archive.stats(),
+            'readiness': readiness_report(),
             'env_vars': {
                 'OPENAI_API_KEY_set': bool(os.environ.get('OPENAI_API_KEY')),
                 'TESSERACT_CMD': os.environ.get('TESSERACT_CMD')
@@ -990,6 +1323,29 @@ def admin_system_status():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/profiles')
+def admin_profiles():
+    if not is_admin_session():
+        return jsonify({'error': 'Admin access required'}), 403
+    return jsonify({
+        'profiling_enabled': profiling.PROFILING_ENABLED,
+        'slow_ms_threshold': profiling.SLOW_MS or None,
+        'profiles': profiling.list_profiles()
+    })
+
+@app.route('/api/admin/profiles/<profile_id>')
+def admin_profile_detail(profile_id):
+    if not is_admin_session():
+        return jsonify({'error': 'Admin access required'}), 403
+    # ?format=prof downloads the raw cProfile dump; default is the text report
+    ext = '.prof' if request.args.get('format') == 'prof' else '.txt'
+    path = profiling.profile_path(profile_id, ext)
+    if not path:
+        return jsonify({'error': 'Profile not found'}), 404
+    if ext == '.prof':
+        return send_from_directory(profiling.PROFILE_DIR, os.path.basename(path), as_attachment=True)
+    return send_from_directory(profiling.PROFILE_DIR, os.path.basename(path), mimetype='text/plain')
+
 @app.route('/api/admin/users/<int:user_id>', methods=['DELETE'])
 def admin_delete_user(user_id):
     if not session.get('logged_in'):
@@ -1008,6 +1364,9 @@ def admin_delete_user(user_id):
         
         username = user[0]
         
+        # Make sure queued messages are on disk so the deletes below cover them
+        message_log.flush()
+        
         # Delete user's chats
         cursor.execute("DELETE FROM conversations WHERE chat_id LIKE ?", (f'{username}-%',))
         cursor.execute("DELETE FROM chat_metadata WHERE user_id = ?", (username,))
@@ -1016,6 +1375,7 @@ def admin_delete_user(user_id):
         cursor.execute("DELETE FROM users WHERE id = ?", (user_id,))
         
         conn.commit()
+        archive.delete(prefix=f'{username}-')
         return jsonify({'message': 'User deleted successfully'})
     except Exception as e:
         conn.rollback()
@@ -1029,6 +1389,7 @@ def admin_delete_chat(chat_id):
     if not session.get('logged_in'):
         return jsonify({'error': 'Not authenticated'}), 401
     
+    message_log.discard(chat_id)
     conn = setup_db()
     cursor = conn.cursor()
     
@@ -1036,6 +1397,8 @@ def admin_delete_chat(chat_id):
         cursor.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
         cursor.execute("DELETE FROM chat_metadata WHERE chat_id = ?", (chat_id,))
         conn.commit()
+        archive.delete(chat_id=chat_id)
+        retrieval_sessions.drop(chat_id)
         return jsonify({'message': 'Chat deleted successfully'})
     except Exception as e:
         conn.rollback()
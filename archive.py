@@ -0,0 +1,299 @@
+"""Hot/cold partitioning of chat history.
+
+Chats with no message for AQUAAI_ARCHIVE_AFTER_DAYS days are moved out of
+conversations into a separate SQLite file (AQUAAI_ARCHIVE_DB), one row per
+chat holding its messages as compressed JSON (zstd when the zstandard package
+is installed, zlib otherwise; the codec is stored per row). chat_metadata
+stays in the hot DB, so the sidebar still lists archived chats.
+
+rehydrate() moves a chat back, with its original message ids, the first time
+it is opened or written to. Both directions run with the archive ATTACHed, in
+a single BEGIN IMMEDIATE transaction, so a chat is never in both places or
+in neither, even with another process archiving or rehydrating at the same
+time. Archived chats are not in the full-text search index until they are
+rehydrated. The check on the message path is cheap: is_archived() keeps the
+archived chat ids in memory and only re-reads them when the archive file
+changes (mtime or size), so active chats never open the archive.
+
+A background job (every AQUAAI_ARCHIVE_INTERVAL_HOURS) archives, then
+compacts both files: it switches them to auto_vacuum=INCREMENTAL once (one
+full VACUUM), and afterwards gives free pages back with incremental_vacuum,
+so the hot DB shrinks to what active chats need.
+
+    python archive.py                 # archive + compact now
+    python archive.py --days 30
+    python archive.py --compact-only
+"""
+import argparse
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HOT_DB = 'chat_history.db'
+ARCHIVE_DB = os.environ.get('AQUAAI_ARCHIVE_DB', 'chat_archive.db')
+ARCHIVE_AFTER_DAYS = float(os.environ.get('AQUAAI_ARCHIVE_AFTER_DAYS', '7'))
+ARCHIVE_INTERVAL = float(os.environ.get('AQUAAI_ARCHIVE_INTERVAL_HOURS', '6')) * 3600
+FIRST_RUN_DELAY = 60
+ZSTD_LEVEL = 10
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS archive.archived_chats (
+        chat_id TEXT PRIMARY KEY,
+        codec TEXT NOT NULL,
+        payload BLOB NOT NULL,
+        messages INTEGER,
+        raw_bytes INTEGER,
+        last_timestamp TEXT,
+        archived_at TEXT
+    )
+"""
+
+last_run = {}
+_archived_ids = set()
+_archived_stamp = None    # (path, mtime_ns, size) of the archive file when _archived_ids was read
+_ids_lock = threading.Lock()
+
+
+def compress(data):
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return 'zlib', zlib.compress(data, 9)
+
+
+def decompress(codec, blob):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('Chat archived with zstd but the zstandard package is not installed')
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+
+def _connect(db_path, archive_path):
+    # Autocommit mode: transactions below are explicit BEGIN IMMEDIATE ... COMMIT
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    conn.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+    conn.execute(_SCHEMA)
+    return conn
+
+
+def _forget_ids():
+    global _archived_stamp
+    with _ids_lock:
+        _archived_stamp = None
+
+
+def is_archived(chat_id, archive_path=ARCHIVE_DB):
+    """Whether a chat is in the archive; a stat of the file unless it changed since the last call."""
+    global _archived_ids, _archived_stamp
+    try:
+        st = os.stat(archive_path)
+    except OSError:
+        return False
+    stamp = (archive_path, st.st_mtime_ns, st.st_size)
+    with _ids_lock:
+        if stamp != _archived_stamp:
+            conn = sqlite3.connect(archive_path, timeout=30)
+            try:
+                _archived_ids = {row[0] for row in conn.execute("SELECT chat_id FROM archived_chats")}
+            except sqlite3.OperationalError:
+                _archived_ids = set()
+            finally:
+                conn.close()
+            _archived_stamp = stamp
+        return chat_id in _archived_ids
+
+
+def _archive_chat(conn, chat_id, cutoff):
+    """Move one chat if it is still inactive. Returns (messages, raw_bytes, stored_bytes) or None."""
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        rows = conn.execute("SELECT id, timestamp, role, message FROM conversations WHERE chat_id = ? ORDER BY id",
+                            (chat_id,)).fetchall()
+        if not rows or max(row[1] or '' for row in rows) >= cutoff:
+            conn.execute("ROLLBACK")
+            return None
+        previous = conn.execute("SELECT codec, payload FROM archive.archived_chats WHERE chat_id = ?", (chat_id,)).fetchone()
+        if previous:
+            # Messages written after an earlier archival; merge by id
+            merged = {row[0]: row for row in json.loads(decompress(*previous))}
+            merged.update((row[0], list(row)) for row in rows)
+            rows = [merged[i] for i in sorted(merged)]
+        raw = json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        codec, blob = compress(raw)
+        conn.execute(
+            "INSERT OR REPLACE INTO archive.archived_chats VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (chat_id, codec, blob, len(rows), len(raw), max(row[1] or '' for row in rows),
+             datetime.now().strftime(TIMESTAMP_FORMAT)))
+        conn.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return len(rows), len(raw), len(blob)
+
+
+def archive_inactive(db_path=HOT_DB, days=ARCHIVE_AFTER_DAYS, archive_path=ARCHIVE_DB, message_log=None):
+    """Archive every chat whose newest message is older than `days`. Returns a summary dict."""
+    cutoff = (datetime.now() - timedelta(days=days)).strftime(TIMESTAMP_FORMAT)
+    conn = _connect(db_path, archive_path)
+    summary = {'chats': 0, 'messages': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    try:
+        candidates = [row[0] for row in conn.execute(
+            "SELECT chat_id FROM conversations GROUP BY chat_id HAVING MAX(timestamp) < ?", (cutoff,))]
+        for chat_id in candidates:
+            if message_log is not None:
+                # Messages still queued for this chat mean it is active again
+                with message_log.paused(chat_id) as pending:
+                    moved = None if pending else _archive_chat(conn, chat_id, cutoff)
+            else:
+                moved = _archive_chat(conn, chat_id, cutoff)
+            if moved:
+                summary['chats'] += 1
+                summary['messages'] += moved[0]
+                summary['raw_bytes'] += moved[1]
+                summary['stored_bytes'] += moved[2]
+    finally:
+        conn.close()
+        _forget_ids()
+    return summary
+
+
+def rehydrate(chat_id, db_path=HOT_DB, archive_path=ARCHIVE_DB):
+    """Move an archived chat back into conversations. Returns the number of messages restored."""
+    if not is_archived(chat_id, archive_path):
+        return 0
+    conn = _connect(db_path, archive_path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT codec, payload FROM archive.archived_chats WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:  # rehydrated by someone else in the meantime
+                conn.execute("ROLLBACK")
+                return 0
+            messages = json.loads(decompress(*row))
+            # Original ids keep the chat's order; OR IGNORE makes a repeated restore harmless
+            conn.executemany("INSERT OR IGNORE INTO conversations (id, chat_id, timestamp, role, message) VALUES (?, ?, ?, ?, ?)",
+                             [(m[0], chat_id, m[1], m[2], m[3]) for m in messages])
+            conn.execute("DELETE FROM archive.archived_chats WHERE chat_id = ?", (chat_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return len(messages)
+    finally:
+        conn.close()
+        _forget_ids()
+
+
+def delete(chat_id=None, prefix=None, archive_path=ARCHIVE_DB):
+    """Remove archived chats by id or chat id prefix (chat / user deletion)."""
+    if not os.path.exists(archive_path):
+        return 0
+    conn = sqlite3.connect(archive_path, timeout=30)
+    try:
+        with conn:
+            conn.execute(_SCHEMA.replace('archive.', ''))
+            if chat_id is not None:
+                cursor = conn.execute("DELETE FROM archived_chats WHERE chat_id = ?", (chat_id,))
+            else:
+                cursor = conn.execute("DELETE FROM archived_chats WHERE chat_id LIKE ?", (f'{prefix}%',))
+            return cursor.rowcount
+    finally:
+        conn.close()
+        _forget_ids()
+
+
+def compact(db_path):
+    """Return free pages to the filesystem. Returns bytes before/after and whether a full VACUUM ran."""
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        before = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+        full = conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+        if full:
+            # auto_vacuum mode only changes with a VACUUM; after this one, incremental is enough
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            conn.execute("PRAGMA incremental_vacuum")
+        after = conn.execute("PRAGMA page_count").fetchone()[0] * page_size
+    finally:
+        conn.close()
+    return {'bytes_before': before, 'bytes_after': after, 'full_vacuum': full}
+
+
+def run(db_path=HOT_DB, archive_path=ARCHIVE_DB, days=ARCHIVE_AFTER_DAYS, message_log=None):
+    started = time.time()
+    result = {'archived': archive_inactive(db_path, days, archive_path, message_log),
+              'hot_db': compact(db_path), 'archive_db': compact(archive_path)}
+    result['seconds'] = round(time.time() - started, 2)
+    result['finished_at'] = datetime.now().strftime(TIMESTAMP_FORMAT)
+    last_run.clear()
+    last_run.update(result)
+    archived, hot = result['archived'], result['hot_db']
+    print(f"Archive: moved {archived['chats']} chat(s) / {archived['messages']} message(s) "
+          f"({archived['raw_bytes']} -> {archived['stored_bytes']} bytes); "
+          f"hot DB {hot['bytes_before']} -> {hot['bytes_after']} bytes in {result['seconds']}s")
+    return result
+
+
+def start_scheduler(db_path=HOT_DB, message_log=None):
+    """Run archival + compaction in a daemon thread every ARCHIVE_INTERVAL (disabled when days <= 0)."""
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return None
+
+    def loop():
+        time.sleep(FIRST_RUN_DELAY)
+        while True:
+            try:
+                run(db_path, message_log=message_log)
+            except Exception as e:
+                print(f"Warning: chat archival failed, will retry: {e}")
+            time.sleep(ARCHIVE_INTERVAL)
+
+    thread = threading.Thread(target=loop, name='chat-archiver', daemon=True)
+    thread.start()
+    return thread
+
+
+def stats(archive_path=ARCHIVE_DB):
+    info = {'after_days': ARCHIVE_AFTER_DAYS, 'codec': 'zstd' if zstandard is not None else 'zlib',
+            'last_run': dict(last_run) or None, 'archived_chats': 0, 'archive_bytes': 0}
+    if os.path.exists(archive_path):
+        info['archive_bytes'] = os.path.getsize(archive_path)
+        conn = sqlite3.connect(archive_path, timeout=30)
+        try:
+            info['archived_chats'] = conn.execute("SELECT COUNT(*) FROM archived_chats").fetchone()[0]
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.close()
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=HOT_DB)
+    parser.add_argument('--days', type=float, default=ARCHIVE_AFTER_DAYS)
+    parser.add_argument('--compact-only', action='store_true')
+    args = parser.parse_args()
+    if args.compact_only:
+        for path in (args.db, ARCHIVE_DB):
+            if os.path.exists(path):
+                print(path, compact(path))
+        return
+    run(args.db, days=args.days)
+
+
+if __name__ == '__main__':
+    main()
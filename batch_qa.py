@@ -0,0 +1,199 @@
+"""Answer many questions in one go (research reports, offline evaluation).
+
+run_batch() takes a list of questions and does the per-question work of
+/api/message in bulk:
+- embedding: every question not in the query vector cache is embedded in a
+  single embed_documents call
+- retrieval: one FAISS search per shard with all query vectors as a matrix
+- answers: cached answers are reused; the remaining prompts are sent to the
+  LLM from a pool of AQUAAI_BATCH_CONCURRENCY threads, each call with its own
+  deadline, retries and circuit breaker (llm_invoke.py). Given an admission
+  controller, every call also takes one of its global slots (admission.py)
+
+Results are yielded as soon as each answer is ready (not in input order; every
+result carries its index), followed by one summary line. Every question goes
+through retrieval: there is no chat, so no history and no small-talk route.
+
+    python batch_qa.py questions.jsonl > answers.jsonl
+    python batch_qa.py questions.jsonl -o answers.jsonl --concurrency 8 --scope global
+
+Each input line is {"question": "...", "id": "..."} ("id" optional) or a
+JSON string. /api/batch takes the same format as the request body and
+streams the same lines back.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import tracing
+
+BATCH_CONCURRENCY = int(os.environ.get('AQUAAI_BATCH_CONCURRENCY', '4'))
+BATCH_MAX_ITEMS = int(os.environ.get('AQUAAI_BATCH_MAX_ITEMS', '500'))
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_items(lines):
+    """Questions from JSONL lines: [{'id', 'question'}]. Raises BatchError for malformed input."""
+    items = []
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            raise BatchError(f'Line {number}: not valid JSON')
+        if isinstance(entry, str):
+            entry = {'question': entry}
+        question = entry.get('question') if isinstance(entry, dict) else None
+        if not isinstance(question, str) or not question.strip():
+            raise BatchError(f'Line {number}: "question" is required')
+        items.append({'id': entry.get('id'), 'question': question.strip()})
+    if not items:
+        raise BatchError('No questions')
+    if len(items) > BATCH_MAX_ITEMS:
+        raise BatchError(f'At most {BATCH_MAX_ITEMS} questions per batch')
+    return items
+
+
+def _ms(seconds):
+    return round(seconds * 1000.0, 1)
+
+
+def embed_all(questions):
+    """Query vectors for every question (None where embeddings are unavailable); misses in one call."""
+    import chatbot_core
+    if not chatbot_core.EMBEDDINGS_AVAILABLE or chatbot_core.embeddings is None:
+        return [None] * len(questions)
+    vectors = [chatbot_core.query_vector_cache.get(q) for q in questions]
+    missing = sorted({q for q, v in zip(questions, vectors) if v is None})
+    if missing:
+        with tracing.span('batch.embed', texts=len(missing)):
+            embedded = dict(zip(missing, chatbot_core.embeddings.embed_documents(missing)))
+        for question, vector in embedded.items():
+            chatbot_core.query_vector_cache.put(question, vector)
+        vectors = [v if v is not None else embedded[q] for q, v in zip(questions, vectors)]
+    return vectors
+
+
+def _source(doc):
+    meta = getattr(doc, 'metadata', None) or {}
+    return meta.get('source') or meta.get('filename')
+
+
+def run_batch(items, scope=None, concurrency=BATCH_CONCURRENCY, admission=None):
+    """Yield one result dict per item as it completes, then a summary dict ({'summary': ...}).
+
+    admission: an AdmissionController whose slots the LLM calls take (None = no global limit).
+    """
+    import chatbot_core
+    from llm_invoke import new_deadline
+    from sharded_store import make_scope
+
+    scope = scope or make_scope('global')
+    started = time.perf_counter()
+    questions = [item['question'] for item in items]
+    vectors = embed_all(questions)
+    embedded_at = time.perf_counter()
+
+    # One matrix query for every question that has a vector
+    searchable = [i for i, v in enumerate(vectors) if v is not None]
+    results = [[] for _ in items]
+    if searchable and chatbot_core.vectorstore is not None:
+        with tracing.span('batch.search', queries=len(searchable)):
+            found = chatbot_core.search_batch([vectors[i] for i in searchable], chatbot_core.RETRIEVAL_K, scope)
+        for i, hits in zip(searchable, found):
+            results[i] = hits
+    searched_at = time.perf_counter()
+    version = chatbot_core.scope_version(scope)
+    summary = {'items': len(items), 'cached': 0, 'errors': 0,
+               'embed_ms': _ms(embedded_at - started), 'search_ms': _ms(searched_at - embedded_at)}
+
+    def result(i, answer=None, cached=False, error=None, **timings):
+        docs = [doc for doc, _ in results[i]]
+        return {'index': i, 'id': items[i]['id'], 'question': questions[i], 'answer': answer,
+                'sources': sorted({s for s in map(_source, docs) if s}), 'cached': cached, 'error': error,
+                'timings': dict(timings, total_ms=_ms(time.perf_counter() - started))}
+
+    def answer(i, submitted):
+        docs = [doc for doc, _ in results[i]]
+        state = {'question': questions[i], 'history': '', 'docs': docs, 'use_context': bool(docs)}
+        prompt = chatbot_core.prompt_node(chatbot_core.format_node(state))['prompt']
+        if admission is not None:
+            admission.acquire_bulk()
+        picked = time.perf_counter()
+        try:
+            # The deadline starts when the call does, not while the item waits for a worker or a slot
+            raw = chatbot_core.llm_invoker.invoke(prompt, deadline=new_deadline())
+            text = chatbot_core.StrOutputParser().invoke(raw)
+            error = None
+        except Exception as e:
+            text, error = None, f"{type(e).__name__}: {e}"
+        finally:
+            if admission is not None:
+                admission.release_bulk(time.perf_counter() - picked)
+        llm_ms = _ms(time.perf_counter() - picked)
+        if error is None and chatbot_core.ANSWER_CACHE_ENABLED:
+            chatbot_core.answer_cache.store(questions[i], vectors[i], version, text, llm_ms)
+        return result(i, text, error=error, queue_ms=_ms(picked - submitted), llm_ms=llm_ms)
+
+    pending = []
+    for i in range(len(items)):
+        hit = (chatbot_core.answer_cache.lookup(questions[i], vectors[i], version)
+               if chatbot_core.ANSWER_CACHE_ENABLED else None)
+        if hit is not None:
+            summary['cached'] += 1
+            yield result(i, hit, cached=True)
+        else:
+            pending.append(i)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix='batch-llm') as pool:
+        futures = [pool.submit(answer, i, time.perf_counter()) for i in pending]
+        try:
+            for future in as_completed(futures):
+                item = future.result()
+                summary['errors'] += item['error'] is not None
+                yield item
+        finally:
+            # A closed stream (client gone) drops the questions no worker has started yet
+            for future in futures:
+                future.cancel()
+    summary['total_ms'] = _ms(time.perf_counter() - started)
+    yield {'summary': summary}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('questions', help='JSONL file, one question per line ("-" for stdin)')
+    parser.add_argument('-o', '--output', help='Write results here instead of stdout')
+    parser.add_argument('--concurrency', type=int, default=BATCH_CONCURRENCY)
+    parser.add_argument('--scope', default='global', help='Comma-separated selectors: global, mine, chat, all')
+    args = parser.parse_args()
+
+    source = sys.stdin if args.questions == '-' else open(args.questions, encoding='utf-8')
+    with source:
+        try:
+            items = parse_items(source)
+        except BatchError as e:
+            parser.error(str(e))
+    from sharded_store import make_scope
+    out = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for line in run_batch(items, make_scope(args.scope, allow_all=True), args.concurrency):
+            out.write(json.dumps(line, ensure_ascii=False) + '\n')
+            out.flush()
+            if 'summary' in line:
+                print(f"Batch: {line['summary']}", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Memory per chunk and recall@4 of compressed index types versus the float32 flat index.
+
+Chunks come from the bundled literature/ PDFs (or --files) and are embedded with the
+local hashing backend, so no network access is needed. Queries are random 20-word
+windows of the chunks themselves; the flat float32 top-k is the ground truth.
+
+    python benchmarks/compression_report.py
+    python benchmarks/compression_report.py --chunk-size 300 --dims 256 512
+
+"rerank" re-scores the top k * --rerank-factor candidates with the full-precision
+vectors, which is what the chatbot does when a compressed store has its archive.
+Product quantization needs at least 256 chunks to train; with fewer it falls back
+to int8 (use a smaller --chunk-size or more PDFs to see real PQ numbers).
+"""
+import argparse
+import os
+import random
+import sys
+from glob import glob
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def load_chunks(files, chunk_size):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    import indexer
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_size // 5)
+    chunks = []
+    for path in files:
+        chunks.extend(c.page_content for c in indexer.iter_pdf_chunks(path, splitter))
+    return chunks
+
+
+def make_queries(chunks, count, seed=0):
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        words = rng.choice(chunks).split()
+        start = rng.randrange(max(1, len(words) - 20))
+        queries.append(' '.join(words[start:start + 20]))
+    return queries
+
+
+def truncate(matrix, dims):
+    cut = matrix[:, :dims]
+    norms = np.linalg.norm(cut, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return np.ascontiguousarray(cut / norms, dtype=np.float32)
+
+
+def recall(found, truth, k):
+    hits = sum(len(set(f[:k]) & set(t[:k])) for f, t in zip(found, truth))
+    return hits / (k * len(truth))
+
+
+def exact_rerank(candidates, queries, base, k):
+    reranked = []
+    for row, query in zip(candidates, queries):
+        row = [i for i in row if i >= 0]
+        dist = ((base[row] - query) ** 2).sum(axis=1)
+        reranked.append([row[j] for j in np.argsort(dist)[:k]])
+    return reranked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', nargs='+', help='PDFs to index (default: literature/*.pdf)')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=4)
+    parser.add_argument('--rerank-factor', type=int, default=4)
+    parser.add_argument('--dims', type=int, nargs='*', default=[], help='Also report truncated embeddings of these sizes')
+    args = parser.parse_args()
+
+    import faiss
+    import vector_index
+    from embeddings_provider import HashingEmbeddings
+
+    files = args.files or sorted(glob(os.path.join(ROOT, 'literature', '*.pdf')))
+    chunks = load_chunks(files, args.chunk_size)
+    if not chunks:
+        sys.exit('No chunks extracted.')
+    embeddings = HashingEmbeddings()
+    base = np.asarray(embeddings.embed_documents(chunks), dtype=np.float32)
+    queries = np.asarray(embeddings.embed_documents(make_queries(chunks, args.queries)), dtype=np.float32)
+    k, fetch = args.k, args.k * args.rerank_factor
+
+    truth_index = faiss.IndexFlatL2(base.shape[1])
+    truth_index.add(base)
+    _, truth = truth_index.search(queries, k)
+    flat_bytes = vector_index.bytes_per_vector(truth_index)
+
+    print(f"{len(chunks)} chunks from {len(files)} PDF(s), {len(queries)} queries, dim {base.shape[1]}")
+    print(f"{'index':<12}{'dims':>6}{'bytes/chunk':>13}{'vs flat':>9}{'recall@' + str(k):>11}{'rerank':>9}")
+
+    variants = [(t, None) for t in vector_index.INDEX_TYPES] + [('flat', d) for d in args.dims]
+    for index_type, dims in variants:
+        vectors, query_vectors = base, queries
+        if dims:
+            vectors, query_vectors = truncate(base, dims), truncate(queries, dims)
+        index = vector_index.create_index(vectors, index_type)
+        index.add(vectors)
+        per_chunk = vector_index.bytes_per_vector(index)
+        _, found = index.search(query_vectors, fetch)
+        plain = recall([row[:k] for row in found.tolist()], truth.tolist(), k)
+        # Re-ranking uses float32 vectors of the same length, as the on-disk archive would hold
+        reranked = recall(exact_rerank(found.tolist(), query_vectors, vectors, k), truth.tolist(), k)
+        label = vector_index.index_type_of(index)
+        print(f"{label:<12}{vectors.shape[1]:>6}{per_chunk:>13.0f}{flat_bytes / per_chunk:>8.1f}x"
+              f"{plain:>11.3f}{reranked:>9.3f}")
+
+
+if __name__ == '__main__':
+    main()
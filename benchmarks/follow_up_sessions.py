@@ -0,0 +1,123 @@
+"""Multi-turn retrieval with and without the per-chat working set (caches.RetrievalSessions).
+
+Indexes literature/ plus --filler synthetic passages (spread over shards of
+AQUAAI_SHARD_MAX_CHUNKS, so a full search costs what it would on a real
+corpus) with the local hashing embeddings, then replays a few scripted
+conversations turn by turn. Each turn has a verbatim passage of the brief that
+answers it; "found" counts turns whose top 4 contain it.
+
+    python benchmarks/follow_up_sessions.py
+    python benchmarks/follow_up_sessions.py --filler 200000 --runs 5
+
+Latency is the search step only (query embeddings are computed beforehand and
+cost the same in both modes): the index search, or the re-rank of the working set.
+"""
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from glob import glob
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CONVERSATIONS = [
+    [("What is the average dry-season rice yield?", "The average dry-season rice yield"),
+     ("And in the wet season?", "The average wet season rice yield"),
+     ("How much rice did that give in total in the dry season?", "is estimated at 2320 tonnes")],
+    [("Which irrigation schemes were part of the pilot trial?", "A pilot trial was undertaken by BlackWatch Consulting"),
+     ("What was its objective?", "The objective was to test the questionnaire"),
+     ("How many surveys did they collect?", "(372 in total)")],
+    [("What are the six stages of a benchmarking process?", "A benchmarking process usually involves six stages"),
+     ("What should the first stage start with?", "Identification should commence with"),
+     ("And what properties should the indicators have?", "meaningful, relevant, simple and cost-effective")],
+    [("Which subproject was most affected by flooding?", "Kokoah appeared most susceptible"),
+     ("Why might that be?", "inadequate drainage capacity"),
+     ("Which irrigation schemes need investment?", "has the best production and greatest satisfaction")],
+]
+
+
+def normalize(text):
+    return ' '.join(text.split()).lower()
+
+
+def build_store(filler, seed=0):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from langchain_core.documents import Document
+    import chatbot_core
+    import indexer
+    from sharded_store import ShardedVectorStore, SHARD_MAX_CHUNKS
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    chunks = []
+    for path in sorted(glob(os.path.join(ROOT, 'literature', '*.pdf'))):
+        chunks.extend(indexer.iter_pdf_chunks(path, splitter))
+    vocabulary = sorted({w for c in chunks for w in c.page_content.split()})
+    rng = random.Random(seed)
+    chunks += [Document(page_content=' '.join(rng.choices(vocabulary, k=120))) for _ in range(filler)]
+    rng.shuffle(chunks)
+
+    store = ShardedVectorStore(chatbot_core.VECTORSTORE_DIR, chatbot_core.embeddings)
+    for no, start in enumerate(range(0, len(chunks), SHARD_MAX_CHUNKS)):
+        shard, _ = indexer.add_chunks_streaming(None, chunks[start:start + SHARD_MAX_CHUNKS], chatbot_core.embeddings,
+                                                index_type='flat')
+        store.put(f"s{no:04d}", shard)
+    chatbot_core.set_vectorstore(store)
+    return len(chunks), len(store.shards)
+
+
+def replay(sessions, runs):
+    import chatbot_core
+    from sharded_store import make_scope
+
+    chatbot_core.RETRIEVAL_SESSIONS_ENABLED = sessions
+    chatbot_core.WORKING_SET_K = max(chatbot_core.RETRIEVAL_K, chatbot_core.SESSION_WORKING_SET) if sessions \
+        else chatbot_core.RETRIEVAL_K
+    first, later, found, turns = [], [], 0, 0
+    for run in range(runs):
+        chatbot_core.retrieval_cache.clear()
+        for n, conversation in enumerate(CONVERSATIONS):
+            chat_id = f"bench-{sessions}-{run}-{n}"
+            scope = make_scope('global', chat_id, 'bench')
+            for turn, (question, passage) in enumerate(conversation):
+                vector = chatbot_core.embed_question(question)
+                start = time.perf_counter()
+                results = chatbot_core.session_search(chat_id, question, vector, scope)
+                (first if turn == 0 else later).append((time.perf_counter() - start) * 1000.0)
+                found += any(normalize(passage) in normalize(doc.page_content) for doc, _ in results)
+                turns += 1
+    return first, later, found / turns
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filler', type=int, default=60000, help='Synthetic passages added to the index')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    logging.getLogger('pypdf').setLevel(logging.ERROR)
+
+    os.environ.setdefault('AQUAAI_EMBEDDINGS_PROVIDER', 'hashing')
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    # chatbot_core looks for vectorstore/ and literature/ in the working directory; start from an empty one
+    os.chdir(tempfile.mkdtemp(prefix='aquaai-bench-'))
+    import chatbot_core
+
+    chunks, shards = build_store(args.filler)
+    print(f"{chunks} chunks in {shards} shard(s), {len(CONVERSATIONS)} conversations x "
+          f"{len(CONVERSATIONS[0])} turns, {args.runs} runs")
+    print(f"{'mode':<10}{'turn 1 p50':>12}{'follow-up p50':>15}{'follow-up p95':>15}{'found':>8}")
+    for sessions in (False, True):
+        first, later, found = replay(sessions, args.runs)
+        later.sort()
+        p95 = later[min(len(later) - 1, int(0.95 * len(later)))]
+        print(f"{'sessions' if sessions else 'search':<10}{statistics.median(first):>12.2f}"
+              f"{statistics.median(later):>15.2f}{p95:>15.2f}{found:>8.2f}")
+    print('session stats:', chatbot_core.retrieval_sessions.stats())
+
+
+if __name__ == '__main__':
+    main()
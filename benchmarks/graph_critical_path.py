@@ -0,0 +1,105 @@
+"""Critical path of /api/message: serial history + retrieval versus the parallel graph.
+
+Runs the real LangGraph workflow over a small in-memory store with injected
+latencies: --embed-ms per query embedding (the provider round trip),
+--history-ms per history load, --persist-ms for writing the chat metadata and
+message before the graph starts, and --llm-ms per model call (fake model, no
+network). Every question is distinct, so no cache answers for it.
+
+    python benchmarks/graph_critical_path.py
+    python benchmarks/graph_critical_path.py --embed-ms 120 --history-ms 40 --runs 30
+
+Modes:
+  serial       persist, load history, then run the graph with it (the old order)
+  parallel     persist, then the graph loads history next to retrieval
+  speculative  retrieval is started before persisting, the graph joins it
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+class SlowEmbeddings:
+    def __init__(self, inner, delay):
+        self.inner = inner
+        self.delay = delay
+
+    def embed_query(self, text):
+        time.sleep(self.delay)
+        return self.inner.embed_query(text)
+
+    def embed_documents(self, texts):
+        return self.inner.embed_documents(texts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--embed-ms', type=float, default=80)
+    parser.add_argument('--history-ms', type=float, default=30)
+    parser.add_argument('--persist-ms', type=float, default=20)
+    parser.add_argument('--llm-ms', type=float, default=50)
+    parser.add_argument('--runs', type=int, default=20)
+    args = parser.parse_args()
+
+    os.environ.setdefault('AQUAAI_EMBEDDINGS_PROVIDER', 'hashing')
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+    # chatbot_core looks for vectorstore/ and literature/ in the working directory; start from an empty one
+    os.chdir(tempfile.mkdtemp(prefix='aquaai-bench-'))
+    from langchain_community.vectorstores import FAISS
+    import chatbot_core
+    import llm_invoke
+    from sharded_store import ShardedVectorStore, make_scope
+
+    base = chatbot_core.embeddings
+    store = ShardedVectorStore(chatbot_core.VECTORSTORE_DIR, base)
+    texts = [f"Passage {i} about irrigation scheduling, groundwater recharge and drought planning." for i in range(500)]
+    store.put('s0000', FAISS.from_texts(texts, base))
+    chatbot_core.set_vectorstore(store)
+    chatbot_core.embeddings = SlowEmbeddings(base, args.embed_ms / 1000.0)
+    chatbot_core.llm_invoker.model = llm_invoke.FakeModel(latency=lambda: args.llm_ms / 1000.0)
+
+    def load_history(chat_id):
+        time.sleep(args.history_ms / 1000.0)
+        return "User: hello\nAssistant: Hi! How can I help?\n"
+    chatbot_core.set_history_loader(load_history)
+
+    def persist():
+        time.sleep(args.persist_ms / 1000.0)
+
+    def request(mode, i):
+        question = f"How does drip irrigation variant {mode} {i} affect groundwater recharge?"
+        scope = make_scope('global')
+        start = time.perf_counter()
+        if mode == 'speculative':
+            chatbot_core.speculate_retrieval(question, scope)
+        persist()
+        state = {"question": question, "chat_id": "bench", "scope": scope}
+        if mode == 'serial':
+            state["history"] = load_history("bench")
+        final = chatbot_core.langgraph_app.invoke(state)
+        return (time.perf_counter() - start) * 1000.0, final.get("timings", {})
+
+    print(f"embed {args.embed_ms:.0f}ms, history {args.history_ms:.0f}ms, persist {args.persist_ms:.0f}ms, "
+          f"llm {args.llm_ms:.0f}ms, {args.runs} runs per mode")
+    print(f"{'mode':<13}{'p50 ms':>9}{'p95 ms':>9}   mean node ms")
+    for mode in ('serial', 'parallel', 'speculative'):
+        totals, nodes = [], {}
+        for i in range(args.runs):
+            total, timings = request(mode, i)
+            totals.append(total)
+            for node, ms in timings.items():
+                nodes.setdefault(node, []).append(ms)
+        totals.sort()
+        p95 = totals[min(len(totals) - 1, int(0.95 * len(totals)))]
+        per_node = ', '.join(f"{node} {statistics.mean(ms):.1f}" for node, ms in nodes.items())
+        print(f"{mode:<13}{statistics.median(totals):>9.1f}{p95:>9.1f}   {per_node}")
+
+
+if __name__ == '__main__':
+    main()
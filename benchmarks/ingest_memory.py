@@ -0,0 +1,87 @@
+"""Peak RSS of PDF ingestion: eager (load all pages, embed all chunks) vs streaming.
+
+Each mode runs in a fresh subprocess so peak RSS is not shared between runs.
+Embeddings use the local hashing backend so no network access is needed.
+
+    python benchmarks/ingest_memory.py                 # bundled literature/ PDFs
+    python benchmarks/ingest_memory.py --files a.pdf b.pdf
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def run_mode(mode, files):
+    from langchain_community.document_loaders import PyPDFLoader
+    from langchain_community.vectorstores import FAISS
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    from embeddings_provider import HashingEmbeddings
+    import indexer
+
+    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    embeddings = HashingEmbeddings()
+    baseline = _peak_rss_mb()
+    start = time.perf_counter()
+    vectorstore = None
+    chunks_total = 0
+    for path in files:
+        if mode == 'eager':
+            # The pre-streaming path: every page, every chunk and every vector at once
+            chunks = splitter.split_documents(PyPDFLoader(path).load())
+            if vectorstore is None:
+                vectorstore = FAISS.from_documents(chunks, embeddings)
+            else:
+                vectorstore.add_documents(chunks)
+            chunks_total += len(chunks)
+        else:
+            vectorstore, ids = indexer.add_chunks_streaming(vectorstore, indexer.iter_pdf_chunks(path, splitter), embeddings)
+            chunks_total += len(ids)
+    with tempfile.TemporaryDirectory() as tmp:
+        vectorstore.save_local(tmp)
+    elapsed = time.perf_counter() - start
+    print(f"{mode}\t{chunks_total}\t{elapsed:.2f}\t{baseline:.1f}\t{_peak_rss_mb():.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--files', nargs='+', help='PDFs to ingest (default: literature/*.pdf)')
+    parser.add_argument('--mode', choices=['eager', 'streaming'], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    files = args.files
+    if not files:
+        folder = os.path.join(ROOT, 'literature')
+        files = sorted(os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith('.pdf'))
+
+    if args.mode:
+        run_mode(args.mode, files)
+        return
+
+    print(f"Ingesting {len(files)} PDF(s), {sum(os.path.getsize(f) for f in files) / 1e6:.1f} MB")
+    print(f"{'mode':<10} {'chunks':>7} {'seconds':>8} {'RSS before MB':>14} {'peak RSS MB':>12}")
+    for mode in ('eager', 'streaming'):
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--mode', mode, '--files', *files],
+                             capture_output=True, text=True, cwd=ROOT)
+        lines = [l for l in out.stdout.splitlines() if l.startswith(mode + '\t')]
+        if out.returncode != 0 or not lines:
+            print(f"{mode:<10} failed: {out.stderr.strip().splitlines()[-1] if out.stderr.strip() else 'no output'}")
+            continue
+        _, chunks, secs, before, peak = lines[-1].split('\t')
+        print(f"{mode:<10} {chunks:>7} {secs:>8} {before:>14} {peak:>12}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Retrieval quality and latency of chunking / index / k configurations.
+
+Questions come from a checked-in JSONL file (default benchmarks/retrieval_eval.jsonl,
+written against literature/cc5126en.pdf), each with a short verbatim passage of the
+source that answers it. A retrieved chunk is relevant when it contains that passage
+(case and whitespace ignored). Everything runs offline with the local hashing
+embeddings (or --provider), so numbers are reproducible from one run to the next.
+
+    python benchmarks/retrieval_eval.py
+    python benchmarks/retrieval_eval.py --chunk-sizes 500 1000 --index-types flat int8 -k 4 8
+    python benchmarks/retrieval_eval.py --qa my_questions.jsonl --files a.pdf b.pdf
+
+For every chunk size x index type x k it reports:
+  recall@k   share of questions with a relevant chunk in the top k
+  MRR        mean reciprocal rank of the first relevant chunk (0 when none in the top k)
+  ctx tok    mean tokens of the k chunks put in the prompt (tiktoken cl100k_base if
+             installed, else characters / 4)
+  p50/p95    retrieval latency per question: query embedding + search (+ re-rank),
+             over --repeat runs
+  coverage   share of passages that lie whole inside some chunk; the rest were cut
+             at a chunk boundary, so no k can find them
+
+Compressed index types re-rank k * AQUAAI_RERANK_FACTOR candidates with the
+full-precision vectors, as the chatbot does.
+"""
+import argparse
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import tempfile
+import time
+from glob import glob
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+DEFAULT_QA = os.path.join(ROOT, 'benchmarks', 'retrieval_eval.jsonl')
+_SPACE = re.compile(r"\s+")
+
+
+def normalize(text):
+    return _SPACE.sub(' ', text).strip().lower()
+
+
+def load_qa(path):
+    with open(path, encoding='utf-8') as f:
+        pairs = [json.loads(line) for line in f if line.strip()]
+    return [(pair['question'], normalize(pair['passage'])) for pair in pairs]
+
+
+def token_counter():
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding('cl100k_base')
+        return lambda text: len(encoding.encode(text)), 'cl100k'
+    except Exception:
+        return lambda text: len(text) // 4, 'chars/4'
+
+
+def load_chunks(files, chunk_size, overlap):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    import indexer
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=int(chunk_size * overlap))
+    chunks = []
+    for path in files:
+        chunks.extend(indexer.iter_pdf_chunks(path, splitter))
+    return chunks
+
+
+def build_store(chunks, embeddings, index_type, workdir):
+    import indexer
+    import vector_index
+    archive = None if index_type == 'flat' else vector_index.FullVectorArchive(tempfile.mkdtemp(dir=workdir))
+    store, _ = indexer.add_chunks_streaming(None, chunks, embeddings, index_type=index_type, archive=archive)
+    return store, archive
+
+
+def retrieve(store, archive, embeddings, question, k):
+    import vector_index
+    vector = embeddings.embed_query(question)
+    if archive is None or vector_index.RERANK_FACTOR <= 1:
+        return store.similarity_search_with_score_by_vector(vector, k=k)
+    candidates = store.similarity_search_with_score_by_vector(vector, k=k * vector_index.RERANK_FACTOR)
+    return vector_index.rerank(vector, candidates, archive, k)
+
+
+def evaluate(store, archive, embeddings, qa, k, repeat, count_tokens):
+    found, latencies, tokens, ranks = 0, [], [], []
+    for question, passage in qa:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            results = retrieve(store, archive, embeddings, question, k)
+            latencies.append((time.perf_counter() - start) * 1000.0)
+        texts = [doc.page_content for doc, _ in results]
+        rank = next((i for i, text in enumerate(texts, 1) if passage in normalize(text)), None)
+        found += rank is not None
+        ranks.append(1.0 / rank if rank else 0.0)
+        tokens.append(sum(count_tokens(text) for text in texts))
+    latencies.sort()
+    return {'recall': found / len(qa), 'mrr': statistics.mean(ranks), 'tokens': statistics.mean(tokens),
+            'p50': statistics.median(latencies), 'p95': latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--qa', default=DEFAULT_QA, help='JSONL of {"question", "passage"}')
+    parser.add_argument('--files', nargs='+', help='PDFs to index (default: literature/*.pdf)')
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[500, 1000, 1500])
+    parser.add_argument('--overlap', type=float, default=0.2, help='Chunk overlap as a fraction of the chunk size')
+    parser.add_argument('--index-types', nargs='+', default=['flat', 'int8'])
+    parser.add_argument('-k', type=int, nargs='+', default=[2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=5, help='Searches per question for the latency percentiles')
+    parser.add_argument('--provider', default='hashing', help='Embeddings backend (hashing keeps it offline)')
+    args = parser.parse_args()
+    # pypdf warns about every font it cannot fully decode; the text is extracted fine
+    logging.getLogger('pypdf').setLevel(logging.ERROR)
+
+    from embeddings_provider import get_embeddings
+
+    files = args.files or sorted(glob(os.path.join(ROOT, 'literature', '*.pdf')))
+    qa = load_qa(args.qa)
+    embeddings, embeddings_id = get_embeddings(args.provider)
+    count_tokens, tokenizer = token_counter()
+    workdir = tempfile.mkdtemp(prefix='aquaai-eval-')
+
+    print(f"{len(qa)} questions, {len(files)} PDF(s), embeddings {embeddings_id}, tokens {tokenizer}")
+    print(f"{'chunk':>6}{'chunks':>8}{'index':>7}{'k':>4}{'recall@k':>10}{'MRR':>7}{'ctx tok':>9}"
+          f"{'p50 ms':>8}{'p95 ms':>8}{'coverage':>10}")
+    for chunk_size in args.chunk_sizes:
+        chunks = load_chunks(files, chunk_size, args.overlap)
+        if not chunks:
+            sys.exit('No chunks extracted.')
+        normalized = [normalize(c.page_content) for c in chunks]
+        coverage = sum(any(passage in text for text in normalized) for _, passage in qa) / len(qa)
+        for index_type in args.index_types:
+            store, archive = build_store(chunks, embeddings, index_type, workdir)
+            for k in args.k:
+                r = evaluate(store, archive, embeddings, qa, k, args.repeat, count_tokens)
+                print(f"{chunk_size:>6}{len(chunks):>8}{index_type:>7}{k:>4}{r['recall']:>10.3f}{r['mrr']:>7.3f}"
+                      f"{r['tokens']:>9.0f}{r['p50']:>8.2f}{r['p95']:>8.2f}{coverage:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,345 @@
+"""In-process caches used by the chat pipeline.
+
+- LRUCache: thread-safe LRU with an optional TTL and hit/miss counters.
+- SingleFlight: collapses concurrent calls with the same key into one.
+- AnswerCache: final answers keyed on the normalized question, with a
+  semantic fallback (cosine similarity of query embeddings) and a vectorstore
+  version so that new uploads invalidate old answers.
+- RetrievalSessions: per-chat working set of the last retrieval, re-ranked
+  for follow-up questions instead of searching the index again.
+"""
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+ANSWER_CACHE_ENABLED = os.environ.get('AQUAAI_ANSWER_CACHE', '1') in ('1', 'true', 'True')
+ANSWER_CACHE_SIZE = int(os.environ.get('AQUAAI_ANSWER_CACHE_SIZE', '1000'))
+ANSWER_CACHE_TTL = float(os.environ.get('AQUAAI_ANSWER_CACHE_TTL', str(24 * 3600)))
+ANSWER_CACHE_THRESHOLD = float(os.environ.get('AQUAAI_ANSWER_CACHE_THRESHOLD', '0.95'))
+QUERY_VECTOR_CACHE_SIZE = int(os.environ.get('AQUAAI_QUERY_VECTOR_CACHE_SIZE', '4096'))
+RETRIEVAL_CACHE_SIZE = int(os.environ.get('AQUAAI_RETRIEVAL_CACHE_SIZE', '2048'))
+RETRIEVAL_SESSIONS_ENABLED = os.environ.get('AQUAAI_RETRIEVAL_SESSIONS', '1') in ('1', 'true', 'True')
+SESSION_CACHE_SIZE = int(os.environ.get('AQUAAI_SESSION_CACHE_SIZE', '1000'))
+SESSION_TTL = float(os.environ.get('AQUAAI_SESSION_TTL', '3600'))
+SESSION_WORKING_SET = int(os.environ.get('AQUAAI_SESSION_WORKING_SET', '12'))
+SESSION_REUSE_RATIO = float(os.environ.get('AQUAAI_SESSION_REUSE_RATIO', '0.8'))
+SESSION_FOLLOW_UP_WEIGHT = float(os.environ.get('AQUAAI_SESSION_FOLLOW_UP_WEIGHT', '0.5'))
+SESSION_FOLLOW_UP_RATIO = float(os.environ.get('AQUAAI_SESSION_FOLLOW_UP_RATIO', '0.5'))
+
+_MISSING = object()
+
+
+class LRUCache:
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and time.time() - item[0] > self.ttl:
+                del self._data[key]
+                item = _MISSING
+            if item is _MISSING:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, _MISSING)
+        return None if item is _MISSING else item[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def items(self):
+        """Snapshot of live (key, value) pairs, oldest first."""
+        now = time.time()
+        with self._lock:
+            return [(k, v) for k, (ts, v) in self._data.items() if self.ttl is None or now - ts <= self.ttl]
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+class _Call:
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Concurrent do(key, fn) calls share a single execution of fn for that key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stats(self):
+        return {'executed': self.executed, 'coalesced': self.coalesced}
+
+
+def vector_key(vector):
+    """Stable hash of a query vector, used to key retrieval results."""
+    return hashlib.sha1(np.asarray(vector, dtype=np.float32).tobytes()).hexdigest()
+
+
+def normalize_question(text):
+    text = (text or '').lower()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+# Words that usually point back at earlier turns ("what about the second one?")
+_FOLLOW_UP = re.compile(
+    r"\b(it|its|this|that|these|those|they|them|he|she|above|previous|earlier|again|more|"
+    r"first|second|third|last|also|else|continue|elaborate|same|another|other)\b"
+)
+# ... or that continue the previous one ("and in the wet season?")
+_CONTINUATION = re.compile(r"^(and|but|so|what about|how about)\b")
+
+
+def looks_like_follow_up(question):
+    """Heuristic: True when the question is short or points back at earlier turns."""
+    normalized = normalize_question(question)
+    if len(normalized.split()) <= 3 and not normalized.startswith(('what is', 'define')):
+        return True
+    return bool(_FOLLOW_UP.search(normalized) or _CONTINUATION.match(normalized))
+
+
+def depends_on_history(question, history):
+    """Heuristic: True when the question probably only makes sense with the conversation so far.
+
+    The message is saved before the history is read, so a history that ends with the question
+    itself is treated as the history before it.
+    """
+    history = (history or '').strip()
+    current = f"User: {(question or '').strip()}"
+    if history.endswith(current):
+        history = history[:-len(current)].strip()
+    if not history:
+        return False
+    return looks_like_follow_up(question)
+
+
+class RetrievalSessions:
+    """The chunks (and their vectors) the last full search of each chat returned.
+
+    match() re-ranks a chat's working set by cosine similarity to the new question
+    and returns the top k as (doc, squared L2 distance of unit vectors), or None
+    when the index has to be searched: no session, a different vectorstore
+    version/scope, or a question whose best match in the set is below
+    reuse_ratio x the best match of the query that built it (a new topic).
+    Follow-ups ("and the second method?") are ranked with the previous query
+    mixed in, so they stay on the chunks the conversation is about, and have
+    the lower follow_up_ratio bar: their own words say little about the topic.
+    """
+
+    def __init__(self, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_TTL, reuse_ratio=SESSION_REUSE_RATIO,
+                 follow_up_weight=SESSION_FOLLOW_UP_WEIGHT, follow_up_ratio=SESSION_FOLLOW_UP_RATIO):
+        self.reuse_ratio = reuse_ratio
+        self.follow_up_weight = follow_up_weight
+        self.follow_up_ratio = follow_up_ratio
+        self._sessions = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.reused = 0
+        self.follow_ups = 0
+        self.drifted = 0
+        self.stale = 0
+
+    def match(self, chat_id, version, vector, question, k):
+        """Re-ranked working set for this question, or None; counts nothing (see lookup)."""
+        return self._match(chat_id, version, vector, question, k)[0]
+
+    def lookup(self, chat_id, version, vector, question, k):
+        results, outcome = self._match(chat_id, version, vector, question, k)
+        with self._lock:
+            self.lookups += 1
+            if outcome in ('reused', 'follow_up'):
+                self.reused += 1
+            if outcome == 'follow_up':
+                self.follow_ups += 1
+            elif outcome == 'drifted':
+                self.drifted += 1
+            elif outcome == 'stale':
+                self.stale += 1
+        return results
+
+    def _match(self, chat_id, version, vector, question, k):
+        session = self._sessions.get(chat_id) if chat_id and vector is not None else None
+        if session is None:
+            return None, 'miss'
+        if session['version'] != version:
+            self._sessions.pop(chat_id)
+            return None, 'stale'
+        query = _unit(vector)
+        follow_up = looks_like_follow_up(question)
+        if follow_up:
+            query = _unit(query + self.follow_up_weight * session['query'])
+        similarity = session['vectors'] @ query
+        if float(similarity.max()) < (self.follow_up_ratio if follow_up else self.reuse_ratio) * session['best']:
+            return None, 'drifted'
+        order = np.argsort(-similarity)[:k]
+        results = [(session['docs'][i], float(2.0 - 2.0 * similarity[i])) for i in order]
+        return results, 'follow_up' if follow_up else 'reused'
+
+    def store(self, chat_id, version, vector, docs, vectors):
+        """Remember a chat's working set: docs and their vectors, in the same order."""
+        if not chat_id or vector is None or not docs:
+            return
+        query = _unit(vector)
+        matrix = np.vstack([_unit(v) for v in vectors])
+        self._sessions.put(chat_id, {'version': version, 'query': query, 'docs': list(docs), 'vectors': matrix,
+                                     'best': float((matrix @ query).max())})
+
+    def drop(self, chat_id):
+        self._sessions.pop(chat_id)
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'maxsize': self._sessions.maxsize, 'lookups': self.lookups,
+                    'reused': self.reused, 'follow_ups': self.follow_ups, 'drifted': self.drifted,
+                    'stale': self.stale, 'hit_ratio': round(self.reused / self.lookups, 3) if self.lookups else 0.0}
+
+
+class AnswerCache:
+    def __init__(self, maxsize=ANSWER_CACHE_SIZE, ttl=ANSWER_CACHE_TTL, threshold=ANSWER_CACHE_THRESHOLD):
+        self.threshold = threshold
+        self._entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.latency_saved_ms = 0.0
+
+    def lookup(self, question, vector, version):
+        """Return the cached answer or None."""
+        key = (version, normalize_question(question))
+        entry = self._entries.get(key)
+        if entry is not None:
+            return self._hit(entry, semantic=False)
+
+        if vector is not None:
+            candidates = [e for (v, _), e in self._entries.items() if v == version and e['vector'] is not None]
+            if candidates:
+                query = _unit(vector)
+                matrix = np.vstack([e['vector'] for e in candidates])
+                scores = matrix @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    return self._hit(candidates[best], semantic=True)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _hit(self, entry, semantic):
+        with self._lock:
+            if semantic:
+                self.semantic_hits += 1
+            else:
+                self.exact_hits += 1
+            self.latency_saved_ms += entry['cost_ms']
+        return entry['answer']
+
+    def store(self, question, vector, version, answer, cost_ms):
+        if not answer:
+            return
+        self._entries.put((version, normalize_question(question)), {
+            'answer': answer,
+            'vector': _unit(vector) if vector is not None else None,
+            'cost_ms': cost_ms,
+        })
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        hits = self.exact_hits + self.semantic_hits
+        lookups = hits + self.misses
+        return {
+            'enabled': ANSWER_CACHE_ENABLED,
+            'entries': len(self._entries),
+            'exact_hits': self.exact_hits,
+            'semantic_hits': self.semantic_hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'hit_ratio': round(hits / lookups, 3) if lookups else 0.0,
+            'latency_saved_ms': round(self.latency_saved_ms, 1),
+            'evictions': self._entries.evictions,
+        }
+
+
+def _unit(vector):
+    arr = np.asarray(vector, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(arr))
+    return arr / norm if norm else arr
@@ -0,0 +1,103 @@
+"""Full-text search over chat messages with SQLite FTS5.
+
+conversations_fts is an external-content FTS5 index over conversations.message:
+it stores only the inverted index, the text stays in conversations. Triggers
+keep it in sync with every INSERT/UPDATE/DELETE, including the message log's
+background writes and chat deletion. ensure_index() creates the table and
+triggers and backfills existing rows in one transaction, so an index is
+either absent or complete.
+
+search() ranks with bm25 and returns highlighted snippets. Results are
+limited to chats owned by the user: chat_metadata.user_id, or for chats
+without metadata the "<username>-" chat id prefix, as in /api/chats. Each hit
+costs one primary-key lookup on conversations and one on chat_metadata.
+"""
+import html
+import re
+import sqlite3
+
+FTS_TABLE = 'conversations_fts'
+SNIPPET_TOKENS = 16
+MAX_PAGE_SIZE = 50
+_TERM = re.compile(r"\w+", re.UNICODE)
+# Private-use markers so snippets can be HTML-escaped before <mark> is added
+_OPEN, _CLOSE = '\ue000', '\ue001'
+
+_TRIGGERS = (
+    f"""CREATE TRIGGER IF NOT EXISTS conversations_fts_ai AFTER INSERT ON conversations BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS conversations_fts_ad AFTER DELETE ON conversations BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS conversations_fts_au AFTER UPDATE OF message ON conversations BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, message) VALUES ('delete', old.id, old.message);
+        INSERT INTO {FTS_TABLE}(rowid, message) VALUES (new.id, new.message);
+    END""",
+)
+
+
+def ensure_index(conn):
+    """Create the FTS table and triggers, backfilling existing messages. Returns False if FTS5 is unavailable."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (FTS_TABLE,))
+    exists = cursor.fetchone() is not None
+    try:
+        if not exists:
+            cursor.execute(f"""CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+                message, content='conversations', content_rowid='id', tokenize='unicode61 remove_diacritics 2')""")
+        for trigger in _TRIGGERS:
+            cursor.execute(trigger)
+        if not exists:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+            cursor.execute("SELECT COUNT(*) FROM conversations")
+            print(f"Search index built over {cursor.fetchone()[0]} message(s)")
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        conn.rollback()
+        print(f"Full-text search unavailable: {e}")
+        return False
+    return True
+
+
+def build_query(text):
+    """FTS5 query matching every word of `text` (the last one as a prefix), or None if it has no words.
+
+    Words are quoted, so user input can never be parsed as FTS5 syntax.
+    """
+    terms = _TERM.findall(text or '')
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def _highlight(snippet):
+    return html.escape(snippet).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def search(conn, user, text, page=1, page_size=20):
+    """One page of ranked hits in the user's chats: (hits, has_more)."""
+    query = build_query(text)
+    if query is None:
+        return [], False
+    page_size = max(1, min(MAX_PAGE_SIZE, page_size))
+    offset = (max(1, page) - 1) * page_size
+    cursor = conn.cursor()
+    # One extra row tells whether another page exists without a COUNT over all matches
+    cursor.execute(f"""
+        SELECT c.id, c.chat_id, m.chat_name, c.role, c.timestamp,
+               snippet({FTS_TABLE}, 0, ?, ?, '…', ?), bm25({FTS_TABLE}) AS score
+        FROM {FTS_TABLE}
+        JOIN conversations c ON c.id = {FTS_TABLE}.rowid
+        LEFT JOIN chat_metadata m ON m.chat_id = c.chat_id
+        WHERE {FTS_TABLE} MATCH ? AND (m.user_id = ? OR (m.chat_id IS NULL AND c.chat_id LIKE ?))
+        ORDER BY score
+        LIMIT ? OFFSET ?
+    """, (_OPEN, _CLOSE, SNIPPET_TOKENS, query, user, f'{user}-%', page_size + 1, offset))
+    rows = cursor.fetchall()
+    hits = [{'message_id': row[0], 'chat_id': row[1], 'chat_name': row[2], 'role': row[3], 'timestamp': row[4],
+             'snippet': _highlight(row[5]), 'score': round(-row[6], 4)}
+            for row in rows[:page_size]]
+    return hits, len(rows) > page_size
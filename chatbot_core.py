@@ -1,44 +1,84 @@
 from langgraph.graph import StateGraph, START, END
 import os
+import time
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, Any, TypedDict
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
-from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+import tracing
+import vector_index
+from sharded_store import make_scope, RetrievalScope
+from intent_router import IntentRouter, classify, CHITCHAT, RETRIEVE, SUMMARIZE
+from llm_invoke import LLMInvoker, new_deadline
+from embeddings_provider import get_embeddings
+from indexer import load_vectorstore, read_manifest
+from caches import (AnswerCache, ANSWER_CACHE_ENABLED, depends_on_history, LRUCache, SingleFlight,
+                    vector_key, QUERY_VECTOR_CACHE_SIZE, RETRIEVAL_CACHE_SIZE, RetrievalSessions,
+                    RETRIEVAL_SESSIONS_ENABLED, SESSION_WORKING_SET)
 
 load_dotenv()
 llm = ChatOpenAI(model="gpt-5-mini", temperature=0.9)
 LLM_AVAILABLE = llm is not None 
+# Timeouts, retries, hedging and circuit breaking around every LLM call (see llm_invoke.py)
+llm_invoker = LLMInvoker(llm, name=getattr(llm, 'model_name', 'llm'))
 # Splitter and embeddings setup
 splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+# The backend is selected by AQUAAI_EMBEDDINGS_PROVIDER (see embeddings_provider.py)
 try:
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
+    _base_embeddings, EMBEDDINGS_ID = get_embeddings()
+    embeddings = tracing.TracedEmbeddings(_base_embeddings, model=EMBEDDINGS_ID)
     EMBEDDINGS_AVAILABLE = True
 except Exception as e:
     embeddings = None
+    EMBEDDINGS_ID = None
     EMBEDDINGS_AVAILABLE = False
-    print("Warning: OpenAIEmbeddings initialization failed (embeddings unavailable):", e)
+    print("Warning: embeddings initialization failed (embeddings unavailable):", e)
 
 # Vectorstore persistence folder
 VECTORSTORE_DIR = "vectorstore"
+# Bumped whenever a new vectorstore is installed; cached answers from older versions are ignored
+vectorstore_version = 0
+# Chunk ids of deleted documents that are still physically in the index (see indexer.delete_document)
+tombstones = frozenset()
+# Full-precision vectors of a compressed (fp16/int8/pq) index, used to re-rank candidates exactly
+full_vectors = None
+answer_cache = AnswerCache()
+# Query text -> embedding, and (vector hash, k, vectorstore version) -> search results.
+# The single-flight groups make concurrent identical questions share one call.
+query_vector_cache = LRUCache(maxsize=QUERY_VECTOR_CACHE_SIZE)
+retrieval_cache = LRUCache(maxsize=RETRIEVAL_CACHE_SIZE)
+embed_flight = SingleFlight()
+search_flight = SingleFlight()
+intent_router = IntentRouter()
+# Chunks of an uploaded document passed to the LLM for "summarize the document" requests
+SUMMARY_MAX_CHUNKS = int(os.environ.get('AQUAAI_SUMMARY_MAX_CHUNKS', '12'))
+RETRIEVAL_K = 4
+# Full searches fetch a larger working set per chat; follow-ups are re-ranked from it
+WORKING_SET_K = max(RETRIEVAL_K, SESSION_WORKING_SET) if RETRIEVAL_SESSIONS_ENABLED else RETRIEVAL_K
+retrieval_sessions = RetrievalSessions()
+# chat_id -> conversation history text; installed by app.py (see set_history_loader)
+history_loader = None
+# Retrieval started by app.py while the user's message is still being saved
+_speculation_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='speculative-retrieval')
 
 # Try to load an existing vectorstore from disk, otherwise initialize as None
-def load_or_create_embeddings(docs_folder="literature", embeddings_model="text-embedding-3-small"):
+vectorstore = None
+
+def load_or_create_embeddings(docs_folder="literature"):
     """Automatically load existing vectorstore or create from documents folder"""
     global vectorstore
     
-    # Try to load existing vectorstore first
+    # Try to load existing vectorstore first (refused if built with other embeddings)
     if os.path.exists(VECTORSTORE_DIR) and EMBEDDINGS_AVAILABLE:
         try:
-            allow_deser = os.environ.get('ALLOW_DANGEROUS_DESERIALIZATION', '0') in ('1', 'true', 'True')
-            if allow_deser:
-                vectorstore = FAISS.load_local(VECTORSTORE_DIR, embeddings, allow_dangerous_deserialization=True)
-                print(f"✓ Loaded existing vectorstore from {VECTORSTORE_DIR}")
-                return True
-            else:
-                vectorstore = FAISS.load_local(VECTORSTORE_DIR, embeddings)
+            loaded = load_vectorstore(embeddings, EMBEDDINGS_ID, VECTORSTORE_DIR)
+            if loaded is not None:
+                vectorstore = loaded
                 print(f"✓ Loaded existing vectorstore from {VECTORSTORE_DIR}")
                 return True
         except Exception as e:
@@ -59,8 +99,8 @@ def load_or_create_embeddings(docs_folder="literature", embeddings_model="text-e
                 result = index_documents(pdf_files, save_metadata=False)
                 if result.get('indexed', 0) > 0:
                     print(f"✓ Successfully indexed {result['indexed']} documents")
-                    # Load the newly created vectorstore
-                    vectorstore = FAISS.load_local(VECTORSTORE_DIR, embeddings, allow_dangerous_deserialization=True)
+                    # Load the newly created vectorstore; it was just written by this process
+                    vectorstore = load_vectorstore(embeddings, EMBEDDINGS_ID, VECTORSTORE_DIR, allow_deser=True)
                     return True
             except Exception as e:
                 print(f"✗ Failed to index documents: {e}")
@@ -101,33 +141,278 @@ Rules:
 def format_docs(docs):
     return "\n\n".join(doc.page_content for doc in docs)
 
+def embed_question(question):
+    """Embed a user question, or return None when embeddings are unavailable."""
+    if not EMBEDDINGS_AVAILABLE or embeddings is None or not question:
+        return None
+    key = question.strip()
+    vector = query_vector_cache.get(key)
+    if vector is not None:
+        return vector
+    try:
+        vector = embed_flight.do(key, lambda: embeddings.embed_query(key))
+    except Exception as e:
+        print(f"DEBUG: Query embedding error: {e}")
+        return None
+    query_vector_cache.put(key, vector)
+    return vector
+
+
+def retrieval_scope(state):
+    """The RetrievalScope of a request: app.py passes one, other callers get the default selectors."""
+    scope = state.get("scope")
+    if isinstance(scope, RetrievalScope):
+        return scope
+    return make_scope(scope, state.get("chat_id"), state.get("user"))
+
+
+def scope_version(scope, store=None):
+    """Cache version of results for a scope: the vectorstore version and the shards the search visits.
+
+    Keyed on shards rather than the scope itself, so chats without uploads share entries with each
+    other and with plain global searches.
+    """
+    store = vectorstore if store is None else store
+    return vectorstore_version, (store.scope_key(scope) if store is not None else ())
+
+
+def search_by_vector(vector, k=4, scope=None):
+    """Similarity search with results cached per (vector, k, vectorstore version, shards in scope)."""
+    store = vectorstore
+    key = (vector_key(vector), k, scope_version(scope, store))
+    results = retrieval_cache.get(key)
+    if results is None:
+        results = search_flight.do(key, lambda: _search_vector(store, vector, k, scope))
+        retrieval_cache.put(key, results)
+    return results
+
+
+def _search_vector(store, vector, k, scope=None):
+    # Only the shards in scope are searched
+    search = functools.partial(store.similarity_search_with_score_by_vector, scope=scope)
+    archive = full_vectors
+    if archive is None or vector_index.RERANK_FACTOR <= 1:
+        return _live_results(search, vector, k)
+    # The compressed index only shortlists; exact distances decide the final order
+    candidates = _live_results(search, vector, k * vector_index.RERANK_FACTOR)
+    with tracing.span('retrieval.rerank', candidates=len(candidates)):
+        return vector_index.rerank(vector, candidates, archive, k)
+
+
+def chunk_vectors(docs):
+    """Vectors of retrieved docs, in order; exact from the archive when there is one. Skips unknown docs."""
+    ids = [getattr(doc, 'id', None) for doc in docs]
+    archive = full_vectors
+    found = archive.get(i for i in ids if i) if archive is not None else {}
+    missing = [i for i in ids if i and i not in found]
+    if missing and vectorstore is not None:
+        found.update(vectorstore.vectors_for(missing))
+    return [(doc, found[i]) for doc, i in zip(docs, ids) if i in found]
+
+
+def session_search(chat_id, question, vector, scope):
+    """Top RETRIEVAL_K for a chat turn: the chat's working set re-ranked when the question stays on
+    its topic, otherwise a full search whose WORKING_SET_K results become the new working set."""
+    version = scope_version(scope)
+    if RETRIEVAL_SESSIONS_ENABLED and chat_id:
+        with tracing.span('retrieval.session'):
+            results = retrieval_sessions.lookup(chat_id, version, vector, question, RETRIEVAL_K)
+        if results is not None:
+            return results
+    results = search_by_vector(vector, k=WORKING_SET_K, scope=scope)
+    if RETRIEVAL_SESSIONS_ENABLED and chat_id and results:
+        pairs = chunk_vectors([doc for doc, _ in results])
+        if pairs:
+            docs, vectors = zip(*pairs)
+            retrieval_sessions.store(chat_id, version, vector, docs, vectors)
+    return results[:RETRIEVAL_K]
+
+
+def search_batch(vectors, k=RETRIEVAL_K, scope=None):
+    """search_by_vector for many vectors: one matrix query per shard, same tombstone and re-rank handling."""
+    store, dead, archive = vectorstore, tombstones, full_vectors
+    if store is None or not len(vectors):
+        return [[] for _ in vectors]
+    fetch = k * vector_index.RERANK_FACTOR if archive is not None and vector_index.RERANK_FACTOR > 1 else k
+    results = store.similarity_search_with_score_by_vectors(vectors, k=fetch + len(dead), scope=scope)
+    out = []
+    for vector, hits in zip(vectors, results):
+        hits = [(doc, score) for doc, score in hits if getattr(doc, 'id', None) not in dead]
+        out.append(vector_index.rerank(vector, hits, archive, k) if fetch > k else hits[:k])
+    return out
+
+
+def _live_results(search, query, k):
+    """Run a search, over-fetching by the number of tombstones and dropping deleted chunks."""
+    dead = tombstones
+    if not dead:
+        return search(query, k=k)
+    results = search(query, k=k + len(dead))
+    return [(doc, score) for doc, score in results if getattr(doc, 'id', None) not in dead][:k]
+
+
+def vectorstore_stats():
+    store = vectorstore
+    return store.stats() if store is not None else None
+
+
+def retrieval_cache_stats():
+    return {
+        'query_vectors': dict(query_vector_cache.stats(), **embed_flight.stats()),
+        'retrieval_results': dict(retrieval_cache.stats(), **search_flight.stats()),
+        'sessions': retrieval_sessions.stats(),
+    }
+
+
+def set_history_loader(loader):
+    """Install the function the history node calls with a chat_id (the graph can't import app.py)."""
+    global history_loader
+    history_loader = loader
+
+
+def speculate_retrieval(question, scope):
+    """Start embedding + searching a question in the background, before the graph runs.
+
+    The results land in the query-vector and retrieval caches; if retrieve_node
+    gets there while the work is still running it joins the same single-flight
+    call instead of repeating it. Only messages routed to retrieval are started.
+    """
+    if vectorstore is None or not EMBEDDINGS_AVAILABLE or classify(question)[0] != RETRIEVE:
+        return None
+    return _speculation_pool.submit(contextvars.copy_context().run, _speculative_retrieval, question, scope)
+
+
+def _speculative_retrieval(question, scope):
+    with tracing.span('retrieval.speculative'):
+        vector = embed_question(question)
+        if vector is None or vectorstore is None:
+            return
+        # A question the chat's working set answers needs no search at all
+        if RETRIEVAL_SESSIONS_ENABLED and retrieval_sessions.match(
+                getattr(scope, "chat_id", None), scope_version(scope), vector, question, RETRIEVAL_K) is not None:
+            return
+        search_by_vector(vector, k=WORKING_SET_K, scope=scope)
+
 # LangGraph Nodes
-def retrieve_node(state):
-    query = state.get("question")
-    global vectorstore
+def route_node(state):
+    """Classify the message locally so small talk and summaries skip similarity search."""
+    state["pipeline_started"] = time.perf_counter()
+    # Requests from app.py carry a deadline already; other callers get the default budget
+    state.setdefault("deadline", new_deadline())
+    route, reason = intent_router.route(state.get("question"))
+    state["route"] = route
+    state["route_reason"] = reason
     state["docs"] = []
     state["use_context"] = False
+    if route != RETRIEVE:
+        # Small talk depends on the conversation and summaries on the latest upload: not answer-cached
+        state["cache_bypass"] = True
+    state["routed_at"] = time.perf_counter()
+    return state
+
+
+def route_after_intent(state):
+    # History loads next to whatever the route fetches; small talk fetches nothing else
+    return {CHITCHAT: ["history"], SUMMARIZE: ["history", "summarize"], RETRIEVE: ["history", "retrieve"]}[state["route"]]
+
+
+def cache_lookup_node(state):
+    """Answer from the answer cache when an equivalent question was answered recently."""
+    state["cache_hit"] = False
+    state.setdefault("pipeline_started", time.perf_counter())
+    if not ANSWER_CACHE_ENABLED:
+        return state
+    if depends_on_history(state.get("question"), state.get("history")):
+        state["cache_bypass"] = True
+        answer_cache.record_bypass()
+        return state
+    if state.get("query_vector") is None:
+        state["query_vector"] = embed_question(state.get("question"))
+    # Answers depend on which documents were in scope, so the shards searched are part of the cache version
+    answer = answer_cache.lookup(state.get("question"), state.get("query_vector"),
+                                 scope_version(retrieval_scope(state)))
+    if answer is not None:
+        state["cache_hit"] = True
+        state["raw_response"] = answer
+        state["final_answer"] = answer
+    return state
+
+
+def route_after_cache(state):
+    return "hit" if state.get("cache_hit") else "miss"
+
+
+def retrieve_node(state):
+    """Embed + search. Runs next to history_node, so it returns only the keys it sets."""
+    query = state.get("question")
+    update = {"docs": [], "use_context": False}
     
     print(f"DEBUG: Vectorstore available: {vectorstore is not None}")
     print(f"DEBUG: Query: {query}")
     
     if not vectorstore:
         print("DEBUG: No vectorstore available - skipping retrieval")
-        return state
+        return update
 
     try:
-        results = vectorstore.similarity_search_with_score(query, k=4)
+        vector = state.get("query_vector")
+        if vector is None:
+            vector = embed_question(query)
+        update["query_vector"] = vector
+        scope = retrieval_scope(state)
+        if vector is not None:
+            results = session_search(state.get("chat_id"), query, vector, scope)
+        else:
+            results = _live_results(functools.partial(vectorstore.similarity_search_with_score, scope=scope), query, RETRIEVAL_K)
         print(f"DEBUG: Found {len(results)} results")
         if results:
             docs, scores = zip(*results)
-            state["docs"] = list(docs)
-            state["scores"] = list(scores)
-            state["use_context"] = True
+            update.update(docs=list(docs), scores=list(scores), use_context=True)
     except Exception as e:
         print(f"DEBUG: Retrieval error: {e}")
-        state["docs"] = []
-        state["use_context"] = False
-    return state
+        update.update(docs=[], use_context=False)
+    if state.get("route") == RETRIEVE and state.get("routed_at"):
+        # Embedding + search: what a chitchat route saves
+        intent_router.observe_retrieval((time.perf_counter() - state["routed_at"]) * 1000.0)
+    return update
+
+
+def summarize_node(state):
+    """Use the chunks of the latest upload in scope directly; fall back to retrieval if there is none.
+
+    Runs next to history_node, so it returns only the keys it sets.
+    """
+    start = time.perf_counter()
+    chunks = []
+    if vectorstore is not None:
+        try:
+            chunks = vectorstore.latest_document(retrieval_scope(state), exclude=tombstones)
+        except Exception as e:
+            print(f"DEBUG: Summary fetch error: {e}")
+    if not chunks:
+        intent_router.record_fallback()
+        return retrieve_node(state)
+    if len(chunks) > SUMMARY_MAX_CHUNKS:
+        # Spread the budget over the whole document rather than its first pages
+        step = len(chunks) / SUMMARY_MAX_CHUNKS
+        chunks = [chunks[int(i * step)] for i in range(SUMMARY_MAX_CHUNKS)]
+    intent_router.observe_summary_fetch((time.perf_counter() - start) * 1000.0)
+    return {"docs": chunks, "use_context": True}
+
+
+def history_node(state):
+    """Load the conversation so far, in parallel with retrieval. Callers may pass "history" themselves."""
+    if state.get("history") is not None:
+        return {}
+    loader = history_loader
+    if loader is None or not state.get("chat_id"):
+        return {"history": ""}
+    return {"history": loader(state["chat_id"])}
+
+
+def route_after_history(state):
+    # On the other routes the join before cache/format picks the history up
+    return "format" if state.get("route") == CHITCHAT else END
 
 def format_node(state):
     # Only set context if we have docs to include
@@ -160,33 +445,10 @@ def llm_node(state):
         print(state.get('prompt'))
         print('--- End prompt ---')
 
-    # Invoke the LLM. Some langchain chat models support streaming APIs and some don't;
-    # use a small helper that tries .predict, then falls back to .generate and extracts text.
     prompt_text = state["prompt"]
-
-    def _call_llm(model, prompt_text):
-        # Try the simplest synchronous API first
-        try:
-            return model.invoke(prompt_text).content
-        except Exception:
-            pass
-        # Try the generate API (returns an LLMResult with generations)
-        try:
-            res = model.generate([prompt_text])
-            # res.generations is a list of lists of Generation objects
-            texts = []
-            for gen_list in res.generations:
-                if gen_list and hasattr(gen_list[0], 'text'):
-                    texts.append(gen_list[0].text)
-            return "\n\n".join(texts)
-        except Exception as e:
-            # As a last resort, try __call__
-            try:
-                return model(prompt_text)
-            except Exception:
-                raise RuntimeError(f"Failed to invoke LLM: {e}")
-
-    state["raw_response"] = _call_llm(llm, prompt_text)
+    # Bounded by the request deadline; raises LLMTimeoutError / CircuitOpenError instead of hanging
+    with tracing.span('llm.invoke', model=getattr(llm, 'model_name', None), prompt_chars=len(prompt_text)):
+        state["raw_response"] = llm_invoker.invoke(prompt_text, deadline=state.get("deadline"))
 
     if DEBUG:
         print('--- Raw response from LLM ---')
@@ -201,25 +463,104 @@ def parse_node(state):
     return state
 
 
+def cache_store_node(state):
+    if ANSWER_CACHE_ENABLED and not state.get("cache_bypass"):
+        cost_ms = (time.perf_counter() - state.get("pipeline_started", time.perf_counter())) * 1000.0
+        answer_cache.store(state.get("question"), state.get("query_vector"), scope_version(retrieval_scope(state)),
+                           state.get("final_answer"), cost_ms)
+    return state
+
+
+def _merge_timings(current, update):
+    return {**(current or {}), **(update or {})}
+
+
+class ChatState(TypedDict, total=False):
+    """Graph state. Nodes that run side by side (history with retrieve/summarize) return
+    only the keys they set; "timings" (node -> ms) is merged from every node."""
+    question: str
+    chat_id: str
+    user: str
+    scope: Any
+    deadline: float
+    history: str
+    route: str
+    route_reason: str
+    pipeline_started: float
+    routed_at: float
+    docs: list
+    scores: list
+    use_context: bool
+    query_vector: Any
+    cache_hit: bool
+    cache_bypass: bool
+    context: str
+    prompt: str
+    raw_response: Any
+    final_answer: str
+    timings: Annotated[dict, _merge_timings]
+
+
+def _node(name, fn):
+    """Trace a node and record its wall time in state["timings"]."""
+    traced = tracing.traced(f"graph.{name}")(fn)
+
+    @functools.wraps(fn)
+    def run(state):
+        start = time.perf_counter()
+        update = traced(state)
+        update["timings"] = {name: round((time.perf_counter() - start) * 1000.0, 2)}
+        return update
+    return run
+
+
 # LangGraph Workflow
-graph = StateGraph(dict)
-graph.add_node("retrieve", retrieve_node)
-graph.add_node("format", format_node)
-graph.add_node("prompt", prompt_node)
-graph.add_node("llm", llm_node)
-graph.add_node("parse", parse_node)
-graph.add_edge(START, "retrieve")
-graph.add_edge("retrieve", "format")
+graph = StateGraph(ChatState)
+for _name, _fn in (("route", route_node), ("history", history_node), ("retrieve", retrieve_node),
+                   ("summarize", summarize_node), ("cache", cache_lookup_node), ("format", format_node),
+                   ("prompt", prompt_node), ("llm", llm_node), ("parse", parse_node),
+                   ("cache_store", cache_store_node)):
+    graph.add_node(_name, _node(_name, _fn))
+graph.add_edge(START, "route")
+# History loads in parallel with retrieval (or the summary fetch); both join before the prompt is built.
+# Small talk only waits for the history; summaries fetch the uploaded document instead of searching.
+graph.add_conditional_edges("route", route_after_intent, ["history", "retrieve", "summarize"])
+graph.add_conditional_edges("history", route_after_history, ["format", END])
+# The answer cache needs the question vector (from retrieve) and the history (for follow-up detection)
+graph.add_edge(["history", "retrieve"], "cache")
+graph.add_conditional_edges("cache", route_after_cache, {"hit": END, "miss": "format"})
+graph.add_edge(["history", "summarize"], "format")
 graph.add_edge("format", "prompt")
 graph.add_edge("prompt", "llm")
 graph.add_edge("llm", "parse")
-graph.add_edge("parse", END)
+graph.add_edge("parse", "cache_store")
+graph.add_edge("cache_store", END)
 langgraph_app = graph.compile()
 
 # Expose helper to reload or set vectorstore from external code if needed
 def set_vectorstore(vs):
-    global vectorstore
+    global vectorstore, vectorstore_version
     vectorstore = vs
+    vectorstore_version += 1
+    refresh_tombstones()
+
+
+def refresh_tombstones():
+    """Re-read deleted chunk ids from the manifest; cached answers and results are invalidated."""
+    global tombstones, vectorstore_version, full_vectors
+    try:
+        manifest = read_manifest(VECTORSTORE_DIR)
+        tombstones = frozenset(manifest.get('tombstones', []))
+        compressed = vectorstore is not None and vectorstore.compressed
+        if compressed and vector_index.FullVectorArchive.exists(VECTORSTORE_DIR):
+            full_vectors = vector_index.FullVectorArchive(VECTORSTORE_DIR)
+        else:
+            full_vectors = None
+    except Exception as e:
+        print(f"Warning: could not read vectorstore manifest: {e}")
+    vectorstore_version += 1
+
 
+refresh_tombstones()
 
-__all__ = ["langgraph_app", "VECTORSTORE_DIR", "embeddings", "splitter", "set_vectorstore", "llm", "LLM_AVAILABLE", "EMBEDDINGS_AVAILABLE"]
+__all__ = ["langgraph_app", "VECTORSTORE_DIR", "embeddings", "splitter", "set_vectorstore", "refresh_tombstones", "llm", "LLM_AVAILABLE", "EMBEDDINGS_AVAILABLE", "EMBEDDINGS_ID", "answer_cache", "retrieval_cache_stats", "vectorstore_stats", "intent_router", "llm_invoker", "set_history_loader", "speculate_retrieval", "retrieval_sessions"]
@@ -0,0 +1,146 @@
+"""Pluggable embedding backends.
+
+The backend is chosen with AQUAAI_EMBEDDINGS_PROVIDER:
+- openai (default): OpenAIEmbeddings, model from AQUAAI_EMBEDDINGS_MODEL
+  (default text-embedding-3-small). Needs OPENAI_API_KEY and network access.
+- hashing: local NumPy feature-hashing encoder (word unigrams + bigrams).
+  No model download, no network, well under a millisecond per query.
+- sentence-transformers: optional on-disk CPU model (pip install
+  sentence-transformers), loaded once per process and encoded in batches.
+
+Every backend has a model id (e.g. "openai:text-embedding-3-small") that the
+indexer records in the vectorstore manifest so a store built with one backend
+is never queried with another.
+
+AQUAAI_EMBEDDING_DIMS shortens the vectors (smaller index, faster search).
+OpenAI text-embedding-3 models shorten server-side through `dimensions`; other
+backends keep the leading dimensions and re-normalize. The model id gets an
+"@<dims>" suffix so shortened and full-length stores are never mixed.
+"""
+import os
+import re
+import threading
+import zlib
+
+import numpy as np
+
+try:
+    from langchain_core.embeddings import Embeddings
+except Exception:
+    Embeddings = object
+
+DEFAULT_PROVIDER = 'openai'
+DEFAULT_OPENAI_MODEL = 'text-embedding-3-small'
+DEFAULT_ST_MODEL = 'sentence-transformers/all-MiniLM-L6-v2'
+HASHING_DIM = int(os.environ.get('AQUAAI_HASHING_DIM', '768'))
+EMBEDDING_DIMS = int(os.environ.get('AQUAAI_EMBEDDING_DIMS', '0') or 0)   # 0 = full length
+
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+class HashingEmbeddings(Embeddings):
+    """Signed feature hashing of unigrams and bigrams with sublinear tf, L2-normalized."""
+
+    def __init__(self, dim=HASHING_DIM):
+        self.dim = dim
+        self.model_id = f"hashing:v1-{dim}"
+
+    def _features(self, text):
+        tokens = _TOKEN.findall((text or '').lower())
+        return tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]
+
+    def _embed(self, text):
+        vec = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            h = zlib.crc32(feature.encode('utf-8'))
+            vec[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        # Sublinear tf keeps long passages from being dominated by repeated words
+        vec = np.sign(vec) * np.log1p(np.abs(vec))
+        norm = float(np.linalg.norm(vec))
+        if norm:
+            vec /= norm
+        return vec
+
+    def embed_query(self, text):
+        return self._embed(text).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(t).tolist() for t in texts]
+
+
+_st_models = {}
+_st_lock = threading.Lock()
+
+
+class SentenceTransformerEmbeddings(Embeddings):
+    """Local CPU model from sentence-transformers; the model is loaded once per process."""
+
+    def __init__(self, model_name=DEFAULT_ST_MODEL, batch_size=64):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.model_id = f"st:{model_name}"
+
+    def _model(self):
+        with _st_lock:
+            if self.model_name not in _st_models:
+                try:
+                    from sentence_transformers import SentenceTransformer
+                except ImportError as e:
+                    raise RuntimeError("sentence-transformers is not installed. Install it with: pip install sentence-transformers") from e
+                _st_models[self.model_name] = SentenceTransformer(self.model_name, device='cpu')
+            return _st_models[self.model_name]
+
+    def embed_query(self, text):
+        return self._model().encode([text], normalize_embeddings=True)[0].tolist()
+
+    def embed_documents(self, texts):
+        vectors = self._model().encode(list(texts), batch_size=self.batch_size, normalize_embeddings=True)
+        return [v.tolist() for v in vectors]
+
+
+class TruncatedEmbeddings(Embeddings):
+    """Keep the first `dims` components of another backend's vectors, L2-normalized again."""
+
+    def __init__(self, inner, dims):
+        self.inner = inner
+        self.dims = dims
+
+    def _truncate(self, vector):
+        vec = np.asarray(vector, dtype=np.float32)[:self.dims]
+        norm = float(np.linalg.norm(vec))
+        return (vec / norm if norm else vec).tolist()
+
+    def embed_query(self, text):
+        return self._truncate(self.inner.embed_query(text))
+
+    def embed_documents(self, texts):
+        return [self._truncate(v) for v in self.inner.embed_documents(texts)]
+
+
+def configured_provider():
+    return os.environ.get('AQUAAI_EMBEDDINGS_PROVIDER', DEFAULT_PROVIDER).strip().lower()
+
+
+def get_embeddings(provider=None, model=None, dims=None):
+    """Build the configured embeddings object. Raises on misconfiguration (e.g. missing API key)."""
+    provider = (provider or configured_provider()).lower()
+    model = model or os.environ.get('AQUAAI_EMBEDDINGS_MODEL') or None
+    dims = EMBEDDING_DIMS if dims is None else dims
+    if provider == 'openai':
+        from langchain_openai import OpenAIEmbeddings
+        model = model or DEFAULT_OPENAI_MODEL
+        if dims and model.startswith('text-embedding-3'):
+            return OpenAIEmbeddings(model=model, dimensions=dims), f"openai:{model}@{dims}"
+        emb = OpenAIEmbeddings(model=model)
+        emb_id = f"openai:{model}"
+    elif provider == 'hashing':
+        emb = HashingEmbeddings()
+        emb_id = emb.model_id
+    elif provider in ('sentence-transformers', 'st'):
+        emb = SentenceTransformerEmbeddings(model or DEFAULT_ST_MODEL)
+        emb_id = emb.model_id
+    else:
+        raise RuntimeError(f"Unknown embeddings provider '{provider}'. Use openai, hashing or sentence-transformers.")
+    if dims:
+        return TruncatedEmbeddings(emb, dims), f"{emb_id}@{dims}"
+    return emb, emb_id
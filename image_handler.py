@@ -1,8 +1,10 @@
 import os
 import base64
+import mimetypes
 
 from dotenv import load_dotenv      
 from langchain_openai import ChatOpenAI
+import tracing
 
 # Use GPT-4 Vision model
 vision_llm = ChatOpenAI(model="gpt-4o", temperature=0.7)  # gpt-4o has vision capabilities
@@ -52,7 +54,7 @@ Analyze this image and provide a helpful answer. Focus on water, climate, sustai
                     {
                         "type": "image_url",
                         "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}"
+                            "url": f"data:{mimetypes.guess_type(file_path)[0] or 'image/jpeg'};base64,{base64_image}"
                         }
                     }
                 ]
@@ -62,7 +64,8 @@ Analyze this image and provide a helpful answer. Focus on water, climate, sustai
         # Query the LLM with vision capability
         try:
             # Use invoke for the vision model
-            response = vision_llm.invoke(prompt)
+            with tracing.span('llm.vision_invoke', model=getattr(vision_llm, 'model_name', None)):
+                response = vision_llm.invoke(prompt)
             answer = response.content
         except Exception as e:
             raise RuntimeError(f"GPT Vision call failed: {e}")
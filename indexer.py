@@ -1,19 +1,48 @@
 import os
+import json
+import time
+import uuid
+import hashlib
+import threading
 import argparse
 import sqlite3
 from datetime import datetime
 from glob import glob
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
+import shutil
+import numpy as np
+import tracing
+import text_cache
+import vector_index
+from sharded_store import ShardedVectorStore
+from embeddings_provider import get_embeddings
 
 VECTORSTORE_DIR = "vectorstore"
 DB_PATH = "chat_history.db"
+MANIFEST_FILE = "manifest.json"
+UPLOAD_DIR = "uploads"
+# Stores written before the manifest existed were always built with this model
+LEGACY_EMBEDDINGS_ID = "openai:text-embedding-3-small"
+# Deleted chunks stay in the FAISS index as tombstones until this many have accumulated
+COMPACT_THRESHOLD = int(os.environ.get('AQUAAI_COMPACT_THRESHOLD', '200'))
+# Chunks embedded and appended to the index per batch while streaming a PDF
+EMBED_BATCH_SIZE = int(os.environ.get('AQUAAI_EMBED_BATCH_SIZE', '64'))
+# Serializes read-modify-write cycles on the store/manifest within one process
+store_lock = threading.RLock()
+
+
+class EmbeddingsMismatchError(RuntimeError):
+    """The vectorstore on disk was built with a different embeddings model."""
+
+
+class ReindexRequiredError(RuntimeError):
+    """A document's chunks cannot be identified in the vectorstore; only a rebuild removes them."""
 
 
 def setup_db(db_path=DB_PATH):
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, factory=tracing.TracedConnection)
     cursor = conn.cursor()
     cursor.execute("""
         CREATE TABLE IF NOT EXISTS documents (
@@ -23,45 +52,277 @@ def setup_db(db_path=DB_PATH):
             uploaded_at TEXT
         )
     """)
+    # Scope columns: documents uploaded in a chat belong to that chat and uploader
+    for column in ('chat_id TEXT', 'uploader TEXT'):
+        try:
+            cursor.execute(f"ALTER TABLE documents ADD COLUMN {column}")
+        except sqlite3.OperationalError:
+            pass
     conn.commit()
     return conn
 
 
-def index_documents(paths, embeddings_model="text-embedding-3-small", chunk_size=1000, chunk_overlap=200, save_metadata=True):
+def read_manifest(vectorstore_dir=VECTORSTORE_DIR):
+    path = os.path.join(vectorstore_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def write_manifest(manifest, vectorstore_dir=VECTORSTORE_DIR):
+    os.makedirs(vectorstore_dir, exist_ok=True)
+    path = os.path.join(vectorstore_dir, MANIFEST_FILE)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+
+
+def check_manifest(embeddings_id, vectorstore_dir=VECTORSTORE_DIR):
+    """Raise EmbeddingsMismatchError if the store was built with another embeddings model."""
+    stored = read_manifest(vectorstore_dir).get('embeddings_model', LEGACY_EMBEDDINGS_ID)
+    if stored != embeddings_id:
+        raise EmbeddingsMismatchError(
+            f"Vectorstore '{vectorstore_dir}' was built with '{stored}' but the configured embeddings are "
+            f"'{embeddings_id}'. Rebuild the index or set AQUAAI_EMBEDDINGS_PROVIDER/AQUAAI_EMBEDDINGS_MODEL/AQUAAI_EMBEDDING_DIMS to match."
+        )
+
+
+def load_vectorstore(embeddings, embeddings_id, vectorstore_dir=VECTORSTORE_DIR, allow_deser=None):
+    """Load the sharded FAISS store from disk after checking its manifest. Returns None if there is none.
+
+    allow_deser defaults to ALLOW_DANGEROUS_DESERIALIZATION; pass True only for a store this
+    process has just written itself.
+    """
+    manifest = read_manifest(vectorstore_dir)
+    if not manifest.get('shards') and not os.path.exists(os.path.join(vectorstore_dir, 'index.faiss')):
+        return None
+    check_manifest(embeddings_id, vectorstore_dir)
+    if allow_deser is None:
+        allow_deser = os.environ.get('ALLOW_DANGEROUS_DESERIALIZATION', '0') in ('1', 'true', 'True')
+    return ShardedVectorStore.load(vectorstore_dir, embeddings, manifest, allow_deser)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _retire_chunks(vectorstore, chunk_ids):
+    """Remove chunk ids from the FAISS index and docstore, ignoring ids that are already gone."""
+    if vectorstore is None or not chunk_ids:
+        return 0
+    live = set(vectorstore.index_to_docstore_id.values())
+    ids = [cid for cid in chunk_ids if cid in live]
+    if ids:
+        vectorstore.delete(ids)
+    return len(ids)
+
+
+def iter_pdf_chunks(path, splitter, content_hash=None):
+    """Yield chunks page by page; only one page of the PDF is materialized at a time.
+
+    With a content_hash, pages come from (and are saved to) the parsed-text cache.
+    """
+    try:
+        if content_hash:
+            pages = text_cache.iter_pages(path, content_hash)
+        else:
+            pages = PyPDFLoader(path).lazy_load()
+    except Exception as e:
+        raise RuntimeError(f"Failed to load PDF '{path}': {e}. Ensure 'pypdf' (or the required PDF backend) is installed: pip install pypdf")
+    for page in pages:
+        # split_documents splits each page independently anyway, so this matches the eager path
+        yield from splitter.split_documents([page])
+
+
+def tag_chunks(chunks, tags):
+    """Add scope metadata (document_id, chat_id, uploader) to every chunk."""
+    for chunk in chunks:
+        chunk.metadata.update(tags)
+        yield chunk
+
+
+def _chunk_tags(document_id, scope):
+    tags = {'document_id': document_id}
+    if scope:
+        tags.update(chat_id=scope.get('chat_id'), uploader=scope.get('uploader'))
+    return {k: v for k, v in tags.items() if v is not None}
+
+
+def iter_batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _new_store(embeddings, train_vectors, index_type):
+    """Empty FAISS store whose index is built (and trained) for index_type."""
+    from langchain_community.docstore.in_memory import InMemoryDocstore
+    index = vector_index.create_index(train_vectors, index_type)
+    return FAISS(embeddings, index, InMemoryDocstore(), {})
+
+
+def _append_batches(vectorstore, batches, embeddings, index_type, archive):
+    if vectorstore is None:
+        vectorstore = _new_store(embeddings, [v for _, vectors, _, _ in batches for v in vectors], index_type)
+    for texts, vectors, metadatas, ids in batches:
+        vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=metadatas, ids=ids)
+        if archive is not None:
+            archive.put(ids, vectors)
+    return vectorstore
+
+
+def add_chunks_streaming(vectorstore, chunks, embeddings, batch_size=EMBED_BATCH_SIZE, index_type=None, archive=None):
+    """Embed and append chunks in bounded batches. Returns (vectorstore, chunk_ids).
+
+    - index_type: storage for a new store (default AQUAAI_INDEX_TYPE); int8/pq indexes hold
+      back up to AQUAAI_INDEX_TRAIN_SIZE vectors to train on before the first append
+    - archive: FullVectorArchive that also receives the full-precision vectors
+
+    If anything fails part-way, the chunks already appended are removed again before re-raising.
+    """
+    index_type = index_type or vector_index.INDEX_TYPE
+    chunk_ids = []
+    pending = []
+    try:
+        for batch in iter_batches(chunks, batch_size):
+            texts = [c.page_content for c in batch]
+            metadatas = [c.metadata for c in batch]
+            ids = [str(uuid.uuid4()) for _ in batch]
+            with tracing.span('indexer.embed_batch', size=len(batch)):
+                vectors = embeddings.embed_documents(texts)
+            chunk_ids.extend(ids)
+            pending.append((texts, vectors, metadatas, ids))
+            if (vectorstore is None and vector_index.needs_training(index_type)
+                    and sum(len(b[1]) for b in pending) < vector_index.TRAIN_SIZE):
+                continue
+            vectorstore = _append_batches(vectorstore, pending, embeddings, index_type, archive)
+            pending = []
+        if pending:
+            vectorstore = _append_batches(vectorstore, pending, embeddings, index_type, archive)
+    except Exception:
+        _retire_chunks(vectorstore, chunk_ids)
+        raise
+    return vectorstore, chunk_ids
+
+
+def _store_index_type(store, manifest):
+    """Index type for new shards: the store's own type, or the configured one for a new store."""
+    current = manifest.get('index_type') or store.index_type
+    return current if current in vector_index.INDEX_TYPES else vector_index.INDEX_TYPE
+
+
+def _full_vector_archive(index_type, vectorstore_dir=VECTORSTORE_DIR):
+    """Compressed indexes keep their full-precision vectors on disk for exact re-ranking."""
+    if index_type == 'flat':
+        return None
+    return vector_index.FullVectorArchive(vectorstore_dir)
+
+
+def _save_store(store, manifest):
+    """Save the shards that changed, then the manifest that lists them. Returns the shards written."""
+    os.makedirs(VECTORSTORE_DIR, exist_ok=True)
+    store.drop_empty()
+    with tracing.span('indexer.save_local', shards=len(store.dirty)):
+        written = store.save(VECTORSTORE_DIR)
+    manifest['shards'] = store.layout()
+    manifest['index_type'] = store.index_type
+    write_manifest(manifest)
+    return written
+
+
+def index_documents(paths, embeddings_model=None, chunk_size=1000, chunk_overlap=200, save_metadata=True,
+                    embeddings_provider=None, prune_folder=None, scope=None):
     """Index a list of PDF file paths into a FAISS vectorstore.
 
     - paths: iterable of file paths
-    - saves/creates vectorstore in VECTORSTORE_DIR
+    - saves/creates vectorstore in VECTORSTORE_DIR; each file goes to one shard (see sharded_store.py)
+      and only the shards that changed are re-saved
     - optionally saves metadata into SQLite DB
+    - embeddings_provider/embeddings_model default to the configured backend (see embeddings_provider.py)
+    - files already in the manifest with the same size/mtime (or content hash) are skipped;
+      changed files have their old chunks retired before being re-indexed
+    - prune_folder: retire chunks of manifest entries under this folder whose file no longer exists
+    - scope: {'chat_id', 'uploader'} for chat uploads; they go to that chat's own shard and are only
+      retrieved by searches whose scope includes them. None = the global collection.
     """
-    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    with store_lock:
+        return _index_documents(paths, embeddings_model, chunk_size, chunk_overlap, save_metadata,
+                                embeddings_provider, prune_folder, scope)
+
+
+def _open_embeddings(embeddings_provider=None, embeddings_model=None):
     try:
-        embeddings = OpenAIEmbeddings(model=embeddings_model)
+        base_embeddings, embeddings_id = get_embeddings(embeddings_provider, embeddings_model)
+        return tracing.TracedEmbeddings(base_embeddings, model=embeddings_id), embeddings_id
     except Exception as e:
         # Bubble up a clearer message for callers
-        raise RuntimeError(f"Failed to initialize embeddings: {e}. Set OPENAI_API_KEY to enable embeddings.")
+        raise RuntimeError(f"Failed to initialize embeddings: {e}. Set OPENAI_API_KEY or use AQUAAI_EMBEDDINGS_PROVIDER=hashing.")
 
-    # load existing vectorstore if present
-# load existing vectorstore if present
-    vectorstore = None
-    if os.path.exists(VECTORSTORE_DIR):
-        try:
-            allow_deser = os.environ.get('ALLOW_DANGEROUS_DESERIALIZATION', '0') in ('1', 'true', 'True')
-            if allow_deser:
-                vectorstore = FAISS.load_local(VECTORSTORE_DIR, embeddings, allow_dangerous_deserialization=True)
-            else:
-                vectorstore = FAISS.load_local(VECTORSTORE_DIR, embeddings)
-            print(f"Loaded existing vectorstore from {VECTORSTORE_DIR}")
-        except Exception as e:
-            print(f"Warning: failed loading existing vectorstore: {e}. A new one will be created.")
-            vectorstore = None
 
+def _record_document(conn, path, scope):
+    """Insert or refresh the documents row for path (uncommitted) and return its id."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    chat_id, uploader = (scope.get('chat_id'), scope.get('uploader')) if scope else (None, None)
+    cursor = conn.cursor()
+    cursor.execute("SELECT id FROM documents WHERE filepath = ?", (path,))
+    row = cursor.fetchone()
+    if row:
+        cursor.execute("UPDATE documents SET uploaded_at = ?, chat_id = ?, uploader = ? WHERE id = ?",
+                       (now, chat_id, uploader, row[0]))
+        return row[0]
+    cursor.execute("INSERT INTO documents (filename, filepath, uploaded_at, chat_id, uploader) VALUES (?, ?, ?, ?, ?)",
+                   (os.path.basename(path), path, now, chat_id, uploader))
+    return cursor.lastrowid
+
+
+def _index_documents(paths, embeddings_model, chunk_size, chunk_overlap, save_metadata, embeddings_provider, prune_folder,
+                     scope=None):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    embeddings, embeddings_id = _open_embeddings(embeddings_provider, embeddings_model)
+
+    # load existing vectorstore if present; a model mismatch is an error, not a reason to start over
+    store = None
+    try:
+        store = load_vectorstore(embeddings, embeddings_id)
+        if store is not None:
+            print(f"Loaded existing vectorstore from {VECTORSTORE_DIR} ({len(store.shards)} shard(s))")
+    except EmbeddingsMismatchError:
+        raise
+    except Exception as e:
+        print(f"Warning: failed loading existing vectorstore: {e}. A new one will be created.")
+        store = None
+
+    manifest = read_manifest()
+    if store is None:
+        # A fresh store contains none of the files, shards or tombstones the old manifest lists
+        manifest['files'] = {}
+        manifest['tombstones'] = []
+        manifest['shards'] = {}
+        manifest.pop('index_type', None)
+        store = ShardedVectorStore(VECTORSTORE_DIR, embeddings)
+    manifest['embeddings_model'] = embeddings_id
+    files = manifest.setdefault('files', {})
+    index_type = _store_index_type(store, manifest)
+    archive = _full_vector_archive(index_type)
 
     conn = None
     if save_metadata:
         conn = setup_db()
 
     indexed = 0
+    skipped = 0
+    removed = 0
     for p in paths:
         if not os.path.isfile(p):
             print(f"Skipping {p}: not a file")
@@ -70,45 +331,297 @@ def index_documents(paths, embeddings_model="text-embedding-3-small", chunk_size
             print(f"Skipping {p}: not a PDF")
             continue
 
+        abs_path = os.path.abspath(p)
+        stat = os.stat(abs_path)
+        entry = files.get(abs_path)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            skipped += 1
+            continue
+
         try:
-            print(f"Indexing {p}...")
-            try:
-                loader = PyPDFLoader(p)
-                docs = loader.load()
-            except Exception as e:
-                # Provide a clearer instruction when PDF parsing dependency missing
-                raise RuntimeError(f"Failed to load PDF '{p}': {e}. Ensure 'pypdf' (or the required PDF backend) is installed: pip install pypdf")
-            chunks = splitter.split_documents(docs)
-
-            if vectorstore is None:
-                vectorstore = FAISS.from_documents(chunks, embeddings)
-            else:
-                vectorstore.add_documents(chunks)
+            content_hash = file_sha256(abs_path)
+            if entry and entry.get('sha256') == content_hash:
+                # Touched but not modified: refresh the fingerprint only
+                entry['size'], entry['mtime'] = stat.st_size, stat.st_mtime
+                write_manifest(manifest)
+                skipped += 1
+                continue
 
-            # persist vectorstore after each file (keeps it safe)
-            os.makedirs(VECTORSTORE_DIR, exist_ok=True)
-            vectorstore.save_local(VECTORSTORE_DIR)
+            print(f"Indexing {p}...")
+            if entry:
+                print(f"{p} changed; retiring {len(entry.get('chunk_ids', []))} old chunk(s)")
+                store.delete(entry.get('chunk_ids', []))
+                files.pop(abs_path, None)
+            # A re-indexed file keeps the scope it was first indexed with
+            file_scope = scope or (entry or {}).get('scope')
+            # The documents row is written first so chunks can carry its id; it is committed on success
+            document_id = _record_document(conn, abs_path, file_scope) if conn else None
+            # Only this shard is modified and re-saved
+            shard_id = store.shard_for(abs_path, file_scope)
+            chunks = tag_chunks(iter_pdf_chunks(p, splitter, content_hash), _chunk_tags(document_id, file_scope))
+            # Stream pages -> chunks -> embedding batches -> index appends with bounded buffers
+            with tracing.span('indexer.ingest_pdf', path=os.path.basename(p), shard=shard_id):
+                shard, chunk_ids = add_chunks_streaming(store.get(shard_id), chunks, embeddings,
+                                                        index_type=index_type, archive=archive)
+            if not chunk_ids:
+                raise RuntimeError(f"No text could be extracted from '{p}'")
+            store.put(shard_id, shard, file_scope)
 
-            if save_metadata and conn:
-                cursor = conn.cursor()
-                cursor.execute("INSERT INTO documents (filename, filepath, uploaded_at) VALUES (?, ?, ?)",
-                               (os.path.basename(p), os.path.abspath(p), datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            files[abs_path] = {
+                'size': stat.st_size,
+                'mtime': stat.st_mtime,
+                'sha256': content_hash,
+                'chunk_ids': chunk_ids,
+                'shard': shard_id,
+                'document_id': document_id,
+                'indexed_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            if file_scope:
+                files[abs_path]['scope'] = file_scope
+            # persist the changed shard(s) and manifest after each file (keeps them safe and in step)
+            _save_store(store, manifest)
+            if conn:
                 conn.commit()
 
             indexed += 1
         except Exception as e:
+            if conn:
+                conn.rollback()
             print(f"Failed to index {p}: {e}")
 
+    if prune_folder:
+        root = os.path.join(os.path.abspath(prune_folder), '')
+        for path in [fp for fp in files if fp.startswith(root) and not os.path.exists(fp)]:
+            print(f"{path} was removed; retiring its chunks")
+            store.delete(files.pop(path).get('chunk_ids', []))
+            removed += 1
+        if removed:
+            _save_store(store, manifest)
+
     if conn:
         conn.close()
-    if indexed == 0:
-        msg = "No documents were indexed."
+    if indexed == 0 and removed == 0:
+        msg = "No documents were indexed." if not skipped else f"Index up to date ({skipped} unchanged document(s))."
         print(msg)
-        return {"indexed": 0, "vectorstore_dir": None, "message": msg}
+        return {"indexed": 0, "skipped": skipped, "removed": 0, "vectorstore_dir": None, "message": msg}
     else:
-        msg = f"Indexed {indexed} document(s). Vectorstore saved at '{VECTORSTORE_DIR}'."
+        msg = f"Indexed {indexed} document(s), removed {removed}, {skipped} unchanged. Vectorstore saved at '{VECTORSTORE_DIR}'."
         print(msg)
-        return {"indexed": indexed, "vectorstore_dir": VECTORSTORE_DIR, "message": msg}
+        return {"indexed": indexed, "skipped": skipped, "removed": removed, "vectorstore_dir": VECTORSTORE_DIR, "message": msg}
+
+
+def _chunk_ids_for_source(path, embeddings_provider=None, embeddings_model=None):
+    """Chunk ids whose metadata['source'] is path, for files indexed before the manifest listed them."""
+    embeddings, embeddings_id = _open_embeddings(embeddings_provider, embeddings_model)
+    try:
+        store = load_vectorstore(embeddings, embeddings_id)
+    except Exception as e:
+        raise ReindexRequiredError(f"'{path}' has no manifest entry and the vectorstore could not be read "
+                                   f"to find its chunks ({e}). Rebuild the index to remove it.")
+    if store is None:
+        return []
+    target = os.path.abspath(path)
+    chunk_ids = []
+    for shard in store.shards.values():
+        for chunk_id in shard.index_to_docstore_id.values():
+            source = (getattr(shard.docstore.search(chunk_id), 'metadata', None) or {}).get('source')
+            if source and os.path.abspath(source) == target:
+                chunk_ids.append(chunk_id)
+    return chunk_ids
+
+
+def delete_document(document_id=None, filepath=None, remove_file=True, embeddings_provider=None,
+                    embeddings_model=None):
+    """Delete a document: tombstone its chunks, drop its documents row and (for uploads) the file.
+
+    Chunks are hidden from search immediately through the manifest's tombstone list; the
+    FAISS index itself is only rewritten by compact_vectorstore(). Files without a manifest
+    entry (indexed before the manifest existed) are matched by their chunks' source path.
+    Raises LookupError if the document is unknown and ReindexRequiredError if its chunks
+    cannot be looked up; nothing is deleted in either case.
+    """
+    with store_lock:
+        conn = setup_db()
+        try:
+            cursor = conn.cursor()
+            if document_id is not None:
+                cursor.execute("SELECT id, filepath FROM documents WHERE id = ?", (document_id,))
+            else:
+                cursor.execute("SELECT id, filepath FROM documents WHERE filepath = ?", (os.path.abspath(filepath),))
+            row = cursor.fetchone()
+            if row is None and filepath is None:
+                raise LookupError(f"Document {document_id} not found")
+            doc_id, path = row if row else (None, os.path.abspath(filepath))
+
+            manifest = read_manifest()
+            entry = manifest.get('files', {}).pop(os.path.abspath(path), None) if path else None
+            if entry is not None:
+                chunk_ids = entry.get('chunk_ids', [])
+            else:
+                chunk_ids = _chunk_ids_for_source(path, embeddings_provider, embeddings_model) if path else []
+            tombstones = manifest.setdefault('tombstones', [])
+            known = set(tombstones)
+            tombstones.extend(cid for cid in chunk_ids if cid not in known)
+            write_manifest(manifest)
+            # Keep the parsed text only while another indexed file still has the same content
+            if entry and not any(e.get('sha256') == entry.get('sha256') for e in manifest['files'].values()):
+                text_cache.forget(entry.get('sha256'))
+
+            if doc_id is not None:
+                cursor.execute("DELETE FROM documents WHERE id = ?", (doc_id,))
+                conn.commit()
+        finally:
+            conn.close()
+
+    file_removed = False
+    upload_root = os.path.join(os.path.abspath(UPLOAD_DIR), '')
+    if remove_file and path and os.path.abspath(path).startswith(upload_root) and os.path.exists(path):
+        os.remove(path)
+        file_removed = True
+
+    print(f"Deleted document {doc_id or path}: {len(chunk_ids)} chunk(s) tombstoned, "
+          f"{len(tombstones)} tombstone(s) pending compaction")
+    return {
+        'document_id': doc_id,
+        'filepath': path,
+        'chunks_removed': len(chunk_ids),
+        'file_removed': file_removed,
+        'tombstones': len(tombstones),
+        'compaction_needed': len(tombstones) >= COMPACT_THRESHOLD,
+    }
+
+
+def compact_vectorstore(embeddings_provider=None, embeddings_model=None):
+    """Physically remove tombstoned chunks from the index and docstore and persist the result."""
+    with store_lock:
+        manifest = read_manifest()
+        tombstones = manifest.get('tombstones', [])
+        if not tombstones:
+            return {'compacted': 0, 'vectorstore_dir': None}
+        embeddings, embeddings_id = _open_embeddings(embeddings_provider, embeddings_model)
+        store = load_vectorstore(embeddings, embeddings_id)
+        if store is None:
+            manifest['tombstones'] = []
+            write_manifest(manifest)
+            return {'compacted': 0, 'vectorstore_dir': None}
+        before = store.ntotal
+        with tracing.span('indexer.compact', tombstones=len(tombstones)):
+            removed = store.delete(tombstones)
+            if vector_index.FullVectorArchive.exists(VECTORSTORE_DIR):
+                vector_index.FullVectorArchive(VECTORSTORE_DIR).retain(store.chunk_ids())
+        manifest['tombstones'] = []
+        # Shards without tombstones are not rewritten
+        written = _save_store(store, manifest)
+    print(f"Compacted vectorstore: {before} -> {store.ntotal} vectors ({removed} removed, {written} shard(s) rewritten)")
+    return {'compacted': removed, 'vectors': store.ntotal, 'vectorstore_dir': VECTORSTORE_DIR}
+
+
+def reindex_from_cache(chunk_size=1000, chunk_overlap=200, embeddings_provider=None, embeddings_model=None):
+    """Rebuild the whole vectorstore from the parsed-text cache with new chunking and/or embeddings.
+
+    Files missing from the cache are parsed (and cached) if they still exist. The new store is
+    built next to the old one and swapped in at the end, so a failed rebuild leaves it untouched.
+    """
+    with store_lock:
+        manifest = read_manifest()
+        splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        embeddings, embeddings_id = _open_embeddings(embeddings_provider, embeddings_model)
+        staging = VECTORSTORE_DIR + '.rebuild'
+        shutil.rmtree(staging, ignore_errors=True)
+        # A rebuild always uses the configured index type, so it doubles as a format conversion
+        archive = _full_vector_archive(vector_index.INDEX_TYPE, staging)
+        store = ShardedVectorStore(staging, embeddings)
+        files = {}
+        from_cache = 0
+        for path, entry in manifest.get('files', {}).items():
+            content_hash = entry.get('sha256')
+            if not content_hash:
+                continue
+            if text_cache.is_cached(content_hash):
+                from_cache += 1
+            elif os.path.exists(path):
+                print(f"{path} is not in the text cache; parsing it")
+            else:
+                print(f"Skipping {path}: not cached and no longer on disk")
+                continue
+            shard_id = store.shard_for(path, entry.get('scope'))
+            chunks = tag_chunks(iter_pdf_chunks(path, splitter, content_hash),
+                                _chunk_tags(entry.get('document_id'), entry.get('scope')))
+            with tracing.span('indexer.reindex_file', path=os.path.basename(path), shard=shard_id):
+                shard, chunk_ids = add_chunks_streaming(store.get(shard_id), chunks, embeddings, archive=archive)
+            if chunk_ids:
+                store.put(shard_id, shard, entry.get('scope'))
+            files[path] = dict(entry, chunk_ids=chunk_ids, shard=shard_id,
+                               indexed_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+
+        if not store.shards:
+            shutil.rmtree(staging, ignore_errors=True)
+            msg = "Nothing to re-index."
+            print(msg)
+            return {"indexed": 0, "vectorstore_dir": None, "message": msg}
+
+        new_manifest = dict(manifest, embeddings_model=embeddings_id, files=files, tombstones=[],
+                            chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                            index_type=store.index_type, shards=store.layout())
+        store.save(staging, everything=True)
+        write_manifest(new_manifest, staging)
+        retired = VECTORSTORE_DIR + '.old'
+        shutil.rmtree(retired, ignore_errors=True)
+        if os.path.exists(VECTORSTORE_DIR):
+            os.replace(VECTORSTORE_DIR, retired)
+        os.replace(staging, VECTORSTORE_DIR)
+        shutil.rmtree(retired, ignore_errors=True)
+
+    msg = (f"Re-indexed {len(files)} document(s) ({from_cache} from the text cache) into "
+           f"{store.ntotal} chunks in {len(store.shards)} shard(s) (chunk_size={chunk_size}, overlap={chunk_overlap}).")
+    print(msg)
+    return {"indexed": len(files), "vectorstore_dir": VECTORSTORE_DIR, "message": msg}
+
+
+def convert_index(index_type, embeddings_provider=None, embeddings_model=None):
+    """Rebuild the FAISS index in another storage format without re-embedding anything.
+
+    Vectors come from the full-precision archive when it covers the store, otherwise they are
+    reconstructed from the current index (exact for flat, near-exact for fp16).
+    """
+    with store_lock:
+        embeddings, embeddings_id = _open_embeddings(embeddings_provider, embeddings_model)
+        store = load_vectorstore(embeddings, embeddings_id)
+        if store is None or store.ntotal == 0:
+            print("No vectorstore to convert.")
+            return {'converted': 0, 'vectorstore_dir': None}
+        old_type = store.index_type
+        full = {}
+        if vector_index.FullVectorArchive.exists(VECTORSTORE_DIR):
+            full = vector_index.FullVectorArchive(VECTORSTORE_DIR).all()
+        archive = _full_vector_archive(index_type)
+        total = 0
+        index_bytes = 0.0
+        for shard_id, shard in list(store.shards.items()):
+            count = shard.index.ntotal
+            ids = [shard.index_to_docstore_id[i] for i in range(count)]
+            if all(cid in full for cid in ids):
+                matrix = np.vstack([full[cid] for cid in ids])
+            else:
+                shard_type = vector_index.index_type_of(shard.index)
+                if shard_type not in ('flat', 'fp16'):
+                    print(f"Warning: no full-precision vectors for {shard_type} shard {shard_id}; converting from decoded (lossy) vectors")
+                matrix = shard.index.reconstruct_n(0, count)
+            with tracing.span('indexer.convert_index', shard=shard_id, vectors=count, index_type=index_type):
+                index = vector_index.create_index(matrix, index_type)
+                index.add(np.ascontiguousarray(matrix, dtype=np.float32))
+            # Same order of vectors, so the docstore and id mapping stay valid
+            shard.index = index
+            store.put(shard_id, shard)
+            if archive is not None:
+                archive.put(ids, matrix)
+            total += count
+            index_bytes += vector_index.bytes_per_vector(index) * count
+        _save_store(store, read_manifest())
+    msg = (f"Converted {total} vectors in {len(store.shards)} shard(s) from {old_type} to {store.index_type} "
+           f"({index_bytes / total:.0f} bytes/vector in the index).")
+    print(msg)
+    return {'converted': total, 'index_type': store.index_type, 'vectorstore_dir': VECTORSTORE_DIR, 'message': msg}
 
 
 def gather_files_from_folder(folder):
@@ -120,24 +633,104 @@ def gather_files_from_folder(folder):
     return sorted(files)
 
 
+def sync_folder(folder, **kwargs):
+    """Bring the index in line with a folder: new/changed PDFs are indexed, removed ones retired."""
+    return index_documents(gather_files_from_folder(folder), prune_folder=folder, **kwargs)
+
+
+def _folder_snapshot(folder):
+    snapshot = {}
+    for path in gather_files_from_folder(folder):
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        snapshot[path] = (st.st_size, st.st_mtime)
+    return snapshot
+
+
+def watch_folder(folder, interval=5.0, debounce=2.0, **kwargs):
+    """Poll a folder and re-sync once changes have settled for `debounce` seconds."""
+    print(f"Watching {folder} (poll every {interval}s, debounce {debounce}s). Ctrl+C to stop.")
+    sync_folder(folder, **kwargs)
+    last = _folder_snapshot(folder)
+    while True:
+        time.sleep(interval)
+        current = _folder_snapshot(folder)
+        if current == last:
+            continue
+        # Wait until copies/saves in progress have finished
+        while True:
+            time.sleep(debounce)
+            settled = _folder_snapshot(folder)
+            if settled == current:
+                break
+            current = settled
+        sync_folder(folder, **kwargs)
+        last = current
+
+
 def main():
     parser = argparse.ArgumentParser(description="Index PDFs into a FAISS vectorstore")
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--files', nargs='+', help='One or more PDF file paths to index')
     group.add_argument('--folder', help='A folder; all PDF files inside will be indexed')
+    group.add_argument('--delete-document', type=int, metavar='ID', help='Delete a document (documents table id) from the index')
+    group.add_argument('--compact', action='store_true', help='Rewrite the index without tombstoned chunks')
+    group.add_argument('--reindex-from-cache', action='store_true',
+                       help='Rebuild the whole index from cached page text (use with --chunk-size/--chunk-overlap/--embeddings)')
+    group.add_argument('--convert-index', choices=vector_index.INDEX_TYPES, metavar='TYPE',
+                       help='Re-encode the existing index as flat, fp16, int8 or pq without re-embedding')
     parser.add_argument('--no-metadata', dest='save_metadata', action='store_false', help='Do not save metadata into SQLite DB')
+    parser.add_argument('--embeddings', dest='embeddings_provider', help='Embeddings backend: openai, hashing or sentence-transformers (default: AQUAAI_EMBEDDINGS_PROVIDER)')
+    parser.add_argument('--embeddings-model', help='Model name for the embeddings backend')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='Characters per chunk')
+    parser.add_argument('--chunk-overlap', type=int, default=200, help='Characters of overlap between chunks')
+    parser.add_argument('--watch', action='store_true', help='With --folder: keep polling the folder and apply changes continuously')
+    parser.add_argument('--interval', type=float, default=5.0, help='Watch mode poll interval in seconds')
+    parser.add_argument('--debounce', type=float, default=2.0, help='Watch mode: seconds a change must be stable before re-indexing')
     args = parser.parse_args()
 
+    if args.convert_index:
+        convert_index(args.convert_index, args.embeddings_provider, args.embeddings_model)
+        return
+
+    if args.reindex_from_cache:
+        reindex_from_cache(args.chunk_size, args.chunk_overlap, args.embeddings_provider, args.embeddings_model)
+        return
+
+    options = dict(save_metadata=args.save_metadata, embeddings_provider=args.embeddings_provider,
+                   embeddings_model=args.embeddings_model, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap)
+    if args.delete_document is not None:
+        result = delete_document(args.delete_document, embeddings_provider=args.embeddings_provider,
+                                 embeddings_model=args.embeddings_model)
+        if result['compaction_needed']:
+            compact_vectorstore(args.embeddings_provider, args.embeddings_model)
+        return
+
+    if args.compact:
+        compact_vectorstore(args.embeddings_provider, args.embeddings_model)
+        return
+
+    if args.watch:
+        if not args.folder:
+            parser.error('--watch requires --folder')
+        try:
+            watch_folder(args.folder, interval=args.interval, debounce=args.debounce, **options)
+        except KeyboardInterrupt:
+            print('Stopped watching.')
+        return
+
     if args.folder:
-        files = gather_files_from_folder(args.folder)
-    else:
-        files = args.files
+        # Only new or changed files are processed; files deleted from the folder are retired
+        sync_folder(args.folder, **options)
+        return
 
-    if not files:
+    if not args.files:
         print('No PDF files found to index.')
         return
 
-    index_documents(files, save_metadata=args.save_metadata)
+    index_documents(args.files, **options)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,119 @@
+"""Cheap local intent routing ahead of retrieval.
+
+classify() decides, in a few microseconds and without any model call, which
+path a message takes through the graph:
+- chitchat:  greetings, thanks, farewells, "who are you" - no embedding, no search
+- summarize: "summarize the document I uploaded" - the uploaded document's chunks
+             are fetched directly instead of a similarity search
+- retrieve:  everything else (the previous behaviour)
+
+The classifier is a lexical scorer: a message is small talk when it is short,
+all of its words come from a small-talk vocabulary, and at least one of
+them is a clear conversational cue. Anything with a content word goes to
+retrieval, so mistakes fall back to the old, safe path.
+"""
+import re
+import threading
+import time
+
+CHITCHAT = 'chitchat'
+RETRIEVE = 'retrieve'
+SUMMARIZE = 'summarize'
+ROUTES = (CHITCHAT, RETRIEVE, SUMMARIZE)
+
+_TOKEN = re.compile(r"[a-z']+")
+
+# Words a pure small-talk message is made of
+SMALL_TALK_WORDS = {
+    'hi', 'hello', 'hey', 'hiya', 'yo', 'sup', 'howdy', 'greetings',
+    'thanks', 'thank', 'thx', 'ty', 'cheers', 'appreciate', 'appreciated',
+    'bye', 'goodbye', 'later', 'see', 'cya', 'night', 'morning', 'afternoon', 'evening', 'day',
+    'ok', 'okay', 'cool', 'great', 'nice', 'awesome', 'perfect', 'lol', 'welcome',
+    'good', 'fine', 'well', 'how', 'are', 'you', 'u', 'r', 'doing', "what's", 'whats', 'up',
+    'who', 'what', 'is', 'your', 'name', 'meet', 'to', 'there', 'again', 'a', 'lot', 'so',
+    'much', 'very', 'it', 'that', 'i', 'am', "i'm", 'me', 'for', 'the', 'help', 'aquaai', 'all',
+}
+# At least one of these must be present (keeps "yes please" / "and?" on the retrieval path)
+SMALL_TALK_CUES = {
+    'hi', 'hello', 'hey', 'hiya', 'yo', 'sup', 'howdy', 'greetings', 'thanks', 'thank', 'thx', 'ty',
+    'cheers', 'appreciate', 'appreciated', 'bye', 'goodbye', 'cya', 'morning', 'evening', 'afternoon',
+    'cool', 'great', 'awesome', 'perfect', 'lol', 'nice', 'who', 'name', 'doing',
+}
+MAX_SMALL_TALK_WORDS = 8
+_SMALL_TALK_PHRASES = re.compile(r"^(how are (you|u)|how('s| is) it going|what'?s up|who are you|what can you do)\b")
+
+_SUMMARY_VERB = re.compile(r"\b(summari[sz]e|summary|summarise|overview|tl;?dr|gist|key (points|findings|takeaways)|main (points|ideas))\b")
+_DOCUMENT_REF = re.compile(r"\b(document|doc|pdf|file|paper|report|upload(ed)?|attachment|this|it)\b")
+_ABOUT_DOCUMENT = re.compile(r"\bwhat('s| is) (this|the|my) (document|doc|pdf|file|paper|report) about\b")
+
+
+def classify(question):
+    """Return (route, reason) for a user message."""
+    text = (question or '').strip().lower()
+    if not text:
+        return CHITCHAT, 'empty'
+    if _ABOUT_DOCUMENT.search(text) or (_SUMMARY_VERB.search(text) and _DOCUMENT_REF.search(text)):
+        return SUMMARIZE, 'summary request'
+    tokens = _TOKEN.findall(text)
+    if _SMALL_TALK_PHRASES.match(text) and len(tokens) <= MAX_SMALL_TALK_WORDS:
+        return CHITCHAT, 'small talk phrase'
+    if tokens and len(tokens) <= MAX_SMALL_TALK_WORDS:
+        known = sum(1 for t in tokens if t in SMALL_TALK_WORDS)
+        if known == len(tokens) and any(t in SMALL_TALK_CUES for t in tokens):
+            return CHITCHAT, 'small talk'
+    return RETRIEVE, 'default'
+
+
+class IntentRouter:
+    """classify() plus route counters and an estimate of the retrieval time skipped."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {route: 0 for route in ROUTES}
+        self.fallbacks = 0                 # summarize requests with no uploaded document
+        self.classify_seconds = 0.0
+        self.retrieval_ms_avg = None       # EWMA of embed + search time on the retrieve path
+        self.summary_fetch_ms_avg = None
+        self.latency_saved_ms = 0.0
+
+    def route(self, question):
+        start = time.perf_counter()
+        route, reason = classify(question)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.counts[route] += 1
+            self.classify_seconds += elapsed
+            if route == CHITCHAT and self.retrieval_ms_avg is not None:
+                self.latency_saved_ms += self.retrieval_ms_avg
+        return route, reason
+
+    def record_fallback(self):
+        with self._lock:
+            self.fallbacks += 1
+
+    def observe_retrieval(self, ms):
+        with self._lock:
+            self.retrieval_ms_avg = _ewma(self.retrieval_ms_avg, ms)
+
+    def observe_summary_fetch(self, ms):
+        with self._lock:
+            self.summary_fetch_ms_avg = _ewma(self.summary_fetch_ms_avg, ms)
+            if self.retrieval_ms_avg is not None:
+                self.latency_saved_ms += max(0.0, self.retrieval_ms_avg - ms)
+
+    def stats(self):
+        with self._lock:
+            total = sum(self.counts.values())
+            return {
+                'routes': dict(self.counts),
+                'distribution': {r: round(n / total, 3) for r, n in self.counts.items()} if total else {},
+                'summarize_fallbacks': self.fallbacks,
+                'classify_us_avg': round(self.classify_seconds / total * 1e6, 1) if total else 0.0,
+                'retrieval_ms_avg': round(self.retrieval_ms_avg, 2) if self.retrieval_ms_avg is not None else None,
+                'summary_fetch_ms_avg': round(self.summary_fetch_ms_avg, 2) if self.summary_fetch_ms_avg is not None else None,
+                'latency_saved_ms': round(self.latency_saved_ms, 1),
+            }
+
+
+def _ewma(current, sample, alpha=0.2):
+    return sample if current is None else (1 - alpha) * current + alpha * sample
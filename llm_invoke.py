@@ -0,0 +1,382 @@
+"""Deadline-aware LLM calls: timeouts, retries with jitter, hedging and a circuit breaker.
+
+LLMInvoker.invoke(prompt, deadline) runs the model call on a worker thread and:
+- never waits past the request deadline (a time.monotonic() value carried in
+  the graph state as state["deadline"]) or AQUAAI_LLM_TIMEOUT per attempt;
+- retries retryable failures up to AQUAAI_LLM_RETRIES times with full-jitter
+  exponential backoff, as long as the deadline leaves room;
+- optionally (AQUAAI_LLM_HEDGE=1) sends one duplicate request when the first
+  has not answered within the recent p95 latency, and takes whichever answers first;
+- fails fast with CircuitOpenError after AQUAAI_LLM_BREAKER_FAILURES consecutive
+  failures, until a trial call succeeds again after AQUAAI_LLM_BREAKER_COOLDOWN seconds.
+
+Run ``python llm_invoke.py`` to check every path against a fake model with
+injectable latency and errors (it exits non-zero when a check fails), followed
+by a simulation of each scenario.
+"""
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import tracing
+
+REQUEST_TIMEOUT = float(os.environ.get('AQUAAI_REQUEST_TIMEOUT', '60'))
+ATTEMPT_TIMEOUT = float(os.environ.get('AQUAAI_LLM_TIMEOUT', '30'))
+MAX_RETRIES = int(os.environ.get('AQUAAI_LLM_RETRIES', '2'))
+BACKOFF_BASE = float(os.environ.get('AQUAAI_LLM_BACKOFF_MS', '250')) / 1000.0
+BACKOFF_CAP = float(os.environ.get('AQUAAI_LLM_BACKOFF_CAP_MS', '4000')) / 1000.0
+HEDGE_ENABLED = os.environ.get('AQUAAI_LLM_HEDGE', '0') in ('1', 'true', 'True')
+HEDGE_DELAY_DEFAULT = float(os.environ.get('AQUAAI_LLM_HEDGE_DELAY_MS', '3000')) / 1000.0
+BREAKER_FAILURES = int(os.environ.get('AQUAAI_LLM_BREAKER_FAILURES', '5'))
+BREAKER_COOLDOWN = float(os.environ.get('AQUAAI_LLM_BREAKER_COOLDOWN', '30'))
+MAX_INFLIGHT = int(os.environ.get('AQUAAI_LLM_MAX_INFLIGHT', '32'))
+LATENCY_WINDOW = 200
+MIN_SAMPLES_FOR_P95 = 20
+
+# Errors that will not go away by retrying (bad request, auth, programming errors)
+_NON_RETRYABLE = {'AuthenticationError', 'PermissionDeniedError', 'BadRequestError', 'NotFoundError',
+                  'UnprocessableEntityError', 'ValueError', 'TypeError', 'KeyError', 'AttributeError'}
+
+
+class LLMTimeoutError(TimeoutError):
+    """The LLM did not answer within the attempt timeout or the request deadline."""
+
+
+class CircuitOpenError(RuntimeError):
+    """The circuit breaker is open: upstream has been failing, the call was not attempted."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM upstream unavailable (circuit open); retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def new_deadline(timeout=None):
+    return time.monotonic() + (REQUEST_TIMEOUT if timeout is None else timeout)
+
+
+def call_model(model, prompt_text):
+    """Call whichever API the model exposes (chat model, legacy LLM, or plain callable) once."""
+    if hasattr(model, 'invoke'):
+        result = model.invoke(prompt_text)
+        return getattr(result, 'content', result)
+    if hasattr(model, 'generate'):
+        res = model.generate([prompt_text])
+        return "\n\n".join(gens[0].text for gens in res.generations if gens and hasattr(gens[0], 'text'))
+    return model(prompt_text)
+
+
+def is_retryable(error):
+    return not any(cls.__name__ in _NON_RETRYABLE for cls in type(error).__mro__)
+
+
+class CircuitBreaker:
+    def __init__(self, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.opens = 0
+        self._trial_running = False
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through (closed, or the half-open trial)."""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            waited = time.monotonic() - self.opened_at
+            if self.state == 'open' and waited >= self.cooldown:
+                self.state = 'half-open'
+            if self.state == 'half-open' and not self._trial_running:
+                self._trial_running = True
+                return
+            raise CircuitOpenError(max(0.0, self.cooldown - waited))
+
+    def abandon(self):
+        """End a call that says nothing about upstream health (e.g. a 400): the state is unchanged."""
+        with self._lock:
+            self._trial_running = False
+
+    def record(self, success):
+        with self._lock:
+            self._trial_running = False
+            if success:
+                self.state = 'closed'
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.state == 'half-open' or self.consecutive_failures >= self.failures:
+                if self.state != 'open':
+                    self.opens += 1
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+class LLMInvoker:
+    def __init__(self, model, name='llm', attempt_timeout=ATTEMPT_TIMEOUT, max_retries=MAX_RETRIES,
+                 hedge=HEDGE_ENABLED, breaker=None, call=call_model):
+        self.model = model
+        self.name = name
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.breaker = breaker or CircuitBreaker()
+        self._call = call
+        self._pool = ThreadPoolExecutor(max_workers=MAX_INFLIGHT, thread_name_prefix=f'{name}-call')
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self.metrics = {k: 0 for k in (
+            'requests', 'succeeded', 'failed', 'attempts', 'retries', 'timeouts', 'errors',
+            'non_retryable', 'deadline_exceeded', 'hedges_sent', 'hedge_wins', 'breaker_rejections')}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self.metrics[key] += n
+
+    def hedge_delay(self):
+        """Recent p95 latency, or the configured default until enough calls were observed."""
+        with self._lock:
+            samples = sorted(self._latencies)
+        if len(samples) < MIN_SAMPLES_FOR_P95:
+            return HEDGE_DELAY_DEFAULT
+        return samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+
+    def invoke(self, prompt_text, deadline=None):
+        deadline = deadline or new_deadline()
+        self._count('requests')
+        try:
+            self.breaker.before_call()
+        except CircuitOpenError:
+            self._count('breaker_rejections')
+            raise
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if attempt:
+                self._count('retries')
+            try:
+                with tracing.span('llm.attempt', model=self.name, attempt=attempt):
+                    text = self._attempt(prompt_text, min(self.attempt_timeout, remaining))
+            except Exception as e:
+                last_error = e
+                if isinstance(e, LLMTimeoutError):
+                    self._count('timeouts')
+                elif not is_retryable(e):
+                    # Upstream answered; the request itself is bad. Neither opens nor closes the breaker.
+                    self._count('non_retryable')
+                    self._count('failed')
+                    self.breaker.abandon()
+                    raise
+                else:
+                    self._count('errors')
+                # Full jitter; never sleep past the deadline
+                backoff = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)))
+                if attempt < self.max_retries and time.monotonic() + backoff < deadline:
+                    time.sleep(backoff)
+                continue
+            self.breaker.record(True)
+            self._count('succeeded')
+            return text
+
+        self.breaker.record(False)
+        self._count('failed')
+        if last_error is None or time.monotonic() >= deadline:
+            self._count('deadline_exceeded')
+            raise LLMTimeoutError(f"LLM request deadline exceeded ({self.name})") from last_error
+        raise last_error
+
+    def _submit(self, prompt_text):
+        self._count('attempts')
+        ctx = contextvars.copy_context()
+        return self._pool.submit(ctx.run, self._timed_call, prompt_text)
+
+    def _timed_call(self, prompt_text):
+        start = time.monotonic()
+        text = self._call(self.model, prompt_text)
+        with self._lock:
+            self._latencies.append(time.monotonic() - start)
+        return text
+
+    def _attempt(self, prompt_text, timeout):
+        """One attempt, plus at most one hedged duplicate; returns the first successful answer."""
+        give_up_at = time.monotonic() + timeout
+        futures = [self._submit(prompt_text)]
+        if self.hedge:
+            delay = self.hedge_delay()
+            if delay < timeout:
+                done, _ = wait(futures, timeout=delay)
+                if not done:
+                    self._count('hedges_sent')
+                    futures.append(self._submit(prompt_text))
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, timeout=max(0.0, give_up_at - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    if len(futures) > 1 and future is futures[1]:
+                        self._count('hedge_wins')
+                    # The losing duplicate is left to finish in the background
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        raise LLMTimeoutError(f"LLM did not answer within {timeout:.1f}s ({self.name})")
+
+    def stats(self):
+        with self._lock:
+            samples = sorted(self._latencies)
+            metrics = dict(self.metrics)
+
+        def pct(p):
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000.0, 1) if samples else None
+        metrics.update(
+            latency_p50_ms=pct(0.50), latency_p95_ms=pct(0.95),
+            hedge_enabled=self.hedge, hedge_delay_ms=round(self.hedge_delay() * 1000.0, 1),
+            breaker_state=self.breaker.state, breaker_opens=self.breaker.opens,
+        )
+        return metrics
+
+
+class FakeModel:
+    """Chat-model stand-in: latency() seconds per call, failing with probability error_rate
+    (and always for the first fail_first calls)."""
+
+    class _Reply:
+        def __init__(self, content):
+            self.content = content
+
+    def __init__(self, latency=lambda: 0.01, error_rate=0.0, error=ConnectionError, fail_first=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error = error
+        self.fail_first = fail_first
+        self.calls = 0
+
+    def invoke(self, prompt_text):
+        self.calls += 1
+        call = self.calls
+        time.sleep(self.latency())
+        if call <= self.fail_first or random.random() < self.error_rate:
+            raise self.error("injected failure")
+        return self._Reply(f"echo: {prompt_text[:20]}")
+
+
+def _simulate(label, model, requests=100, deadline=2.0, **kwargs):
+    invoker = LLMInvoker(model, name=label, **kwargs)
+    outcomes = {}
+    start = time.monotonic()
+    for _ in range(requests):
+        try:
+            invoker.invoke("What is water stress?", deadline=new_deadline(deadline))
+            outcome = 'ok'
+        except Exception as e:
+            outcome = type(e).__name__
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    elapsed = time.monotonic() - start
+    stats = invoker.stats()
+    print(f"\n== {label}: {requests} requests in {elapsed:.2f}s, model calls {model.calls}")
+    print(f"   outcomes {outcomes}")
+    print("   " + ", ".join(f"{k}={v}" for k, v in stats.items() if v not in (0, None)))
+    return invoker
+
+
+def _expect(error_type, fn):
+    try:
+        fn()
+    except error_type as e:
+        return e
+    raise AssertionError(f"expected {error_type.__name__}")
+
+
+def check():
+    """Assertions for each path; raises AssertionError on a regression."""
+    # Deadline: a hung upstream fails at the request deadline, not the attempt timeout
+    invoker = LLMInvoker(FakeModel(latency=lambda: 2.0), name='check-deadline', attempt_timeout=5.0)
+    start = time.monotonic()
+    _expect(LLMTimeoutError, lambda: invoker.invoke("q", deadline=new_deadline(0.2)))
+    assert time.monotonic() - start < 0.5, "waited past the deadline"
+    assert invoker.metrics['deadline_exceeded'] == 1
+
+    # Retries: transient errors are retried until one attempt succeeds
+    model = FakeModel(fail_first=2)
+    invoker = LLMInvoker(model, name='check-retry', max_retries=2)
+    assert invoker.invoke("q", deadline=new_deadline(2.0)).startswith("echo")
+    assert model.calls == 3 and invoker.metrics['retries'] == 2 and invoker.breaker.state == 'closed'
+    model = FakeModel(fail_first=5)
+    invoker = LLMInvoker(model, name='check-retry-exhausted', max_retries=2)
+    _expect(ConnectionError, lambda: invoker.invoke("q", deadline=new_deadline(2.0)))
+    assert model.calls == 3
+
+    # Non-retryable errors: one call, no retry
+    model = FakeModel(error_rate=1.0, error=ValueError)
+    invoker = LLMInvoker(model, name='check-bad-request')
+    _expect(ValueError, lambda: invoker.invoke("q", deadline=new_deadline(2.0)))
+    assert model.calls == 1 and invoker.metrics['non_retryable'] == 1
+
+    # Hedging: a slow first attempt loses to the duplicate sent after the p95 delay
+    latencies = iter([0.5, 0.01])
+    invoker = LLMInvoker(FakeModel(latency=lambda: next(latencies)), name='check-hedge', hedge=True)
+    invoker._latencies.extend([0.02] * MIN_SAMPLES_FOR_P95)
+    start = time.monotonic()
+    invoker.invoke("q", deadline=new_deadline(2.0))
+    assert time.monotonic() - start < 0.3, "hedge did not answer first"
+    assert invoker.metrics['hedges_sent'] == 1 and invoker.metrics['hedge_wins'] == 1
+
+    # Breaker: opens after N failed requests and rejects without calling the model
+    model = FakeModel(error_rate=1.0)
+    invoker = LLMInvoker(model, name='check-breaker', max_retries=0, breaker=CircuitBreaker(failures=2, cooldown=0.2))
+    for _ in range(2):
+        _expect(ConnectionError, lambda: invoker.invoke("q", deadline=new_deadline(1.0)))
+    assert invoker.breaker.state == 'open'
+    calls = model.calls
+    _expect(CircuitOpenError, lambda: invoker.invoke("q", deadline=new_deadline(1.0)))
+    assert model.calls == calls and invoker.metrics['breaker_rejections'] == 1
+
+    # Half-open: a failed trial reopens; a non-retryable error leaves it half-open; a success closes
+    time.sleep(0.25)
+    _expect(ConnectionError, lambda: invoker.invoke("q", deadline=new_deadline(1.0)))
+    assert invoker.breaker.state == 'open' and invoker.breaker.opens == 2
+    time.sleep(0.25)
+    model.error = ValueError
+    _expect(ValueError, lambda: invoker.invoke("q", deadline=new_deadline(1.0)))
+    assert invoker.breaker.state == 'half-open', "a bad request must not close the breaker"
+    model.error_rate = 0.0
+    invoker.invoke("q", deadline=new_deadline(1.0))
+    assert invoker.breaker.state == 'closed' and invoker.breaker.consecutive_failures == 0
+    print("llm_invoke checks passed")
+
+
+def main():
+    random.seed(7)
+    global BACKOFF_BASE
+    BACKOFF_BASE = 0.01
+    check()
+    _simulate('healthy', FakeModel())
+    _simulate('flaky 30% errors + retries', FakeModel(error_rate=0.3))
+    _simulate('slow tail, no hedge', FakeModel(latency=lambda: 0.6 if random.random() < 0.03 else 0.02),
+              attempt_timeout=1.0)
+    _simulate('slow tail, hedged', FakeModel(latency=lambda: 0.6 if random.random() < 0.03 else 0.02),
+              attempt_timeout=1.0, hedge=True)
+    _simulate('hung upstream, 0.3s deadline', FakeModel(latency=lambda: 5.0), requests=3, deadline=0.3)
+    invoker = _simulate('down upstream + breaker', FakeModel(error_rate=1.0), requests=20,
+                        breaker=CircuitBreaker(failures=3, cooldown=0.2))
+    time.sleep(0.25)
+    invoker.model.error_rate = 0.0
+    invoker.invoke("recovered?", deadline=new_deadline(1.0))
+    print(f"   after cooldown: breaker {invoker.breaker.state}")
+    _simulate('bad request (not retried)', FakeModel(error_rate=1.0, error=ValueError), requests=5)
+    os._exit(0)  # don't wait for abandoned hung calls
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""Write-behind log for chat messages.
+
+save_message() used to INSERT + COMMIT on the request path, one fsync per
+message. MessageLog queues messages in memory and a background thread writes
+them in batched transactions, at most FLUSH_INTERVAL after they were queued
+(or immediately once MAX_PENDING messages are waiting).
+
+Readers get read-your-writes consistency through consistent_read(): it opens
+a read transaction on the reader's connection and copies the queue while no
+batch is being committed, then lets the writer go on. Queries in the block see
+the DB as of that moment, so "rows in the DB" plus "messages still queued" is
+always the complete, duplicate-free conversation, and readers neither wait
+for each other nor hold up the writer for longer than that copy.
+"""
+import atexit
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+FLUSH_INTERVAL = float(os.environ.get('AQUAAI_MESSAGE_FLUSH_MS', '50')) / 1000.0
+MAX_PENDING = int(os.environ.get('AQUAAI_MESSAGE_MAX_PENDING', '1000'))
+
+
+class MessageLog:
+    def __init__(self, db_path, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._queue = []                       # [(chat_id, timestamp, role, message)]
+        self._queue_lock = threading.Lock()    # guards _queue; never held across I/O
+        self._commit_lock = threading.Lock()   # held while a batch moves from _queue to the DB
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self.batches_written = 0
+        self.messages_written = 0
+
+    def append(self, chat_id, role, message):
+        """Queue a message; returns immediately unless the queue is full."""
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._queue_lock:
+            self._queue.append((chat_id, timestamp, role, message))
+            backlog = len(self._queue)
+        if self._stopped:
+            self.flush()
+            return
+        self._ensure_started()
+        if backlog >= self.max_pending:
+            # Back-pressure: the writer is behind, so pay for a flush here
+            self.flush()
+
+    def _pending(self, chat_id):
+        with self._queue_lock:
+            return [(ts, role, msg) for cid, ts, role, msg in self._queue if chat_id is None or cid == chat_id]
+
+    @contextmanager
+    def consistent_read(self, conn, chat_id=None):
+        """Yield queued (timestamp, role, message) rows for chat_id; query the DB through conn inside the block."""
+        own_transaction = not conn.in_transaction
+        with self._commit_lock:
+            if own_transaction:
+                conn.execute("BEGIN")
+            # The first read fixes what this connection sees until the transaction ends
+            conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+            pending = self._pending(chat_id)
+        try:
+            yield pending
+        finally:
+            if own_transaction:
+                conn.commit()
+
+    @contextmanager
+    def paused(self, chat_id=None):
+        """Hold off the writer for the whole block (for other writers, e.g. the archiver); yields queued rows."""
+        with self._commit_lock:
+            yield self._pending(chat_id)
+
+    def discard(self, chat_id):
+        """Drop queued messages for a chat that is being deleted."""
+        with self._commit_lock:
+            with self._queue_lock:
+                self._queue = [row for row in self._queue if row[0] != chat_id]
+
+    def flush(self):
+        """Synchronously write everything queued so far."""
+        with self._commit_lock:
+            with self._queue_lock:
+                batch, self._queue = self._queue, []
+            if not batch:
+                return 0
+            try:
+                self._write(batch)
+            except Exception:
+                # Put the batch back in front so nothing is lost; the next flush retries
+                with self._queue_lock:
+                    self._queue = batch + self._queue
+                raise
+            return len(batch)
+
+    def _write(self, batch):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO conversations (chat_id, timestamp, role, message) VALUES (?, ?, ?, ?)",
+                    batch
+                )
+        finally:
+            conn.close()
+        self.batches_written += 1
+        self.messages_written += len(batch)
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._queue_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='message-log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Warning: message log flush failed, will retry: {e}")
+
+    def pending_count(self):
+        with self._queue_lock:
+            return len(self._queue)
+
+    def close(self):
+        """Stop the writer and flush what is left (registered with atexit)."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Warning: failed to flush chat messages on shutdown: {e}")
+
+    def stats(self):
+        return {
+            'pending': self.pending_count(),
+            'batches_written': self.batches_written,
+            'messages_written': self.messages_written,
+            'flush_interval_ms': self.flush_interval * 1000.0,
+        }
+
+
+def create_message_log(db_path):
+    log = MessageLog(db_path)
+    atexit.register(log.close)
+    return log
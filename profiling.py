@@ -0,0 +1,189 @@
+"""On-demand profiling of slow request handlers.
+
+Profiling is off unless AQUAAI_PROFILING=1. When it is off, profile_request()
+returns the view function unchanged, so handlers pay nothing at all.
+
+When it is on, a request is profiled if:
+- an admin sends the header ``X-AquaAI-Profile: 1`` or the query flag
+  ``?profile=1`` -> deterministic profile with cProfile; or
+- AQUAAI_PROFILE_SLOW_MS is set -> the request runs under a low-rate stack
+  sampler and the profile is kept only if the request took longer than the
+  threshold.
+
+Profiles are stored under PROFILE_DIR as a JSON metadata file plus a text
+report (pstats output or folded stacks for the sampler) and, for cProfile,
+the raw .prof file for snakeviz/pstats.
+"""
+import cProfile
+import functools
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import tracing
+
+PROFILING_ENABLED = os.environ.get('AQUAAI_PROFILING', '0') in ('1', 'true', 'True')
+PROFILE_DIR = os.environ.get('AQUAAI_PROFILE_DIR', 'profiles')
+SLOW_MS = float(os.environ.get('AQUAAI_PROFILE_SLOW_MS', '0') or 0)
+SAMPLE_INTERVAL = float(os.environ.get('AQUAAI_PROFILE_SAMPLE_INTERVAL', '0.005'))
+MAX_PROFILES = int(os.environ.get('AQUAAI_PROFILE_KEEP', '50'))
+PROFILE_HEADER = 'X-AquaAI-Profile'
+
+
+class StackSampler:
+    """Samples one thread's Python stack at a fixed interval and counts folded stacks."""
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def report(self):
+        """Folded-stack text (flamegraph.pl / speedscope compatible), hottest first."""
+        lines = [f"{stack} {count}" for stack, count in sorted(self.counts.items(), key=lambda kv: kv[1], reverse=True)]
+        return '\n'.join(lines) + '\n'
+
+
+def _cprofile_report(profiler):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(60)
+    return out.getvalue()
+
+
+def _save_profile(name, mode, duration_ms, report, profiler=None, extra=None):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{name}-{uuid.uuid4().hex[:8]}"
+    meta = {
+        'id': profile_id,
+        'handler': name,
+        'mode': mode,
+        'duration_ms': round(duration_ms, 1),
+        'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'trace_id': tracing.current_trace_id(),
+    }
+    meta.update(extra or {})
+    with open(os.path.join(PROFILE_DIR, profile_id + '.txt'), 'w', encoding='utf-8') as f:
+        f.write(report)
+    if profiler is not None:
+        profiler.dump_stats(os.path.join(PROFILE_DIR, profile_id + '.prof'))
+    with open(os.path.join(PROFILE_DIR, profile_id + '.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    _prune()
+    print(f"Saved {mode} profile for {name} ({duration_ms:.0f} ms): {profile_id}")
+    return meta
+
+
+def _prune():
+    metas = sorted(f for f in os.listdir(PROFILE_DIR) if f.endswith('.json'))
+    for old in metas[:-MAX_PROFILES] if MAX_PROFILES > 0 else []:
+        base = old[:-len('.json')]
+        for ext in ('.json', '.txt', '.prof'):
+            try:
+                os.remove(os.path.join(PROFILE_DIR, base + ext))
+            except OSError:
+                pass
+
+
+def _requested(flask_request):
+    flag = flask_request.headers.get(PROFILE_HEADER) or flask_request.args.get('profile')
+    return flag in ('1', 'true', 'True')
+
+
+def profile_request(name, is_admin):
+    """Decorator for Flask views. ``is_admin`` is a zero-argument callable checked per request."""
+    def decorator(view):
+        if not PROFILING_ENABLED:
+            return view
+
+        from flask import request
+
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if _requested(request) and is_admin():
+                profiler = cProfile.Profile()
+                start = time.perf_counter()
+                profiler.enable()
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    profiler.disable()
+                    duration_ms = (time.perf_counter() - start) * 1000.0
+                    try:
+                        _save_profile(name, 'cprofile', duration_ms, _cprofile_report(profiler), profiler,
+                                      {'path': request.path, 'trigger': 'requested'})
+                    except Exception as e:
+                        print(f"Warning: failed to save profile: {e}")
+
+            if SLOW_MS <= 0:
+                return view(*args, **kwargs)
+
+            sampler = StackSampler(threading.get_ident()).start()
+            start = time.perf_counter()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                sampler.stop()
+                duration_ms = (time.perf_counter() - start) * 1000.0
+                if duration_ms >= SLOW_MS and sampler.samples:
+                    try:
+                        _save_profile(name, 'sampled', duration_ms, sampler.report(), None,
+                                      {'path': request.path, 'trigger': f'latency>{SLOW_MS:.0f}ms',
+                                       'samples': sampler.samples, 'interval_s': sampler.interval})
+                    except Exception as e:
+                        print(f"Warning: failed to save profile: {e}")
+        return wrapper
+    return decorator
+
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    profiles = []
+    for fname in sorted(os.listdir(PROFILE_DIR), reverse=True):
+        if not fname.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, fname), encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except Exception:
+            continue
+    return profiles
+
+
+def profile_path(profile_id, ext='.txt'):
+    """Return the artifact path for a stored profile, or None if unknown."""
+    safe_id = os.path.basename(profile_id)
+    path = os.path.join(PROFILE_DIR, safe_id + ext)
+    return path if os.path.isfile(path) else None
@@ -0,0 +1,343 @@
+"""A vectorstore split into independent FAISS shards.
+
+Each shard is an ordinary langchain FAISS store saved under
+VECTORSTORE_DIR/shards/<shard_id>/. The manifest's "shards" map lists them.
+Indexing a document only modifies (and re-saves) the shard it lands in, and
+a query is run on every shard in parallel on a thread pool (FAISS releases
+the GIL while searching), followed by a k-way merge of the sorted results.
+
+AQUAAI_SHARD_MODE picks the shard a new document goes to:
+- size (default): the newest shard until it holds AQUAAI_SHARD_MAX_CHUNKS chunks
+- document: one shard per source file
+
+Documents uploaded in a chat are scoped: they go to a shard of their own per
+(uploader, chat_id), whatever the mode, and the shard records that scope.
+A search with a RetrievalScope only fans out to the shards in scope, so its
+cost follows the size of the scope rather than the whole corpus:
+- global: unscoped shards (the literature collection)
+- chat:   uploads of this user in this chat
+- mine:   all uploads of this user
+- all:    everything (admin / CLI)
+
+A store written before sharding (index.faiss directly in VECTORSTORE_DIR)
+is loaded as a single global shard with path "." and keeps working unchanged.
+"""
+import contextvars
+import hashlib
+import heapq
+import itertools
+import os
+import shutil
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tracing
+import vector_index
+
+SHARD_MODE = os.environ.get('AQUAAI_SHARD_MODE', 'size').strip().lower()
+SHARD_MAX_CHUNKS = int(os.environ.get('AQUAAI_SHARD_MAX_CHUNKS', '20000'))
+SEARCH_THREADS = int(os.environ.get('AQUAAI_SEARCH_THREADS', str(min(8, os.cpu_count() or 1))))
+SHARDS_DIR = 'shards'
+LEGACY_SHARD = 'legacy'
+SCOPE_SELECTORS = ('global', 'chat', 'mine', 'all')
+DEFAULT_SCOPE = os.environ.get('AQUAAI_RETRIEVAL_SCOPE', 'chat,global')
+
+# Hashable so it can be part of retrieval/answer cache keys
+RetrievalScope = namedtuple('RetrievalScope', 'include chat_id user')
+
+
+def make_scope(spec=None, chat_id=None, user=None, allow_all=False):
+    """Build a RetrievalScope from selectors ("chat,global" or a list); unknown selectors are ignored."""
+    spec = spec or DEFAULT_SCOPE
+    if isinstance(spec, str):
+        spec = spec.split(',')
+    include = {sel.strip().lower() for sel in spec} & set(SCOPE_SELECTORS)
+    if not allow_all:
+        include.discard('all')
+    return RetrievalScope(frozenset(include or {'global'}), chat_id, user)
+
+
+def scope_matches(shard_scope, scope):
+    if 'all' in scope.include:
+        return True
+    if not shard_scope:
+        return 'global' in scope.include
+    if shard_scope.get('uploader') != scope.user:
+        return False
+    return 'mine' in scope.include or ('chat' in scope.include and shard_scope.get('chat_id') == scope.chat_id)
+
+_pool = None
+
+
+def _search_pool():
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=SEARCH_THREADS, thread_name_prefix='shard-search')
+    return _pool
+
+
+def _load_faiss(path, embeddings, allow_deser):
+    from langchain_community.vectorstores import FAISS
+    if allow_deser:
+        return FAISS.load_local(path, embeddings, allow_dangerous_deserialization=True)
+    return FAISS.load_local(path, embeddings)
+
+
+class ShardedVectorStore:
+    def __init__(self, directory, embeddings):
+        self.directory = directory
+        self.embeddings = embeddings
+        self.shards = {}     # shard_id -> FAISS
+        self.paths = {}      # shard_id -> path relative to directory
+        self.scopes = {}     # shard_id -> {'uploader', 'chat_id'} for scoped shards
+        self.dirty = set()   # shards changed since the last save
+        self.removed = set()
+        self._positions = {}  # shard_id -> (key, {chunk_id: position}) for vectors_for
+
+    @classmethod
+    def load(cls, directory, embeddings, manifest, allow_deser=False):
+        """Load every shard listed in the manifest. Returns None if the store has no shards."""
+        store = cls(directory, embeddings)
+        layout = manifest.get('shards')
+        if layout is None and os.path.exists(os.path.join(directory, 'index.faiss')):
+            layout = {LEGACY_SHARD: {'path': '.'}}
+        for shard_id, info in (layout or {}).items():
+            store.shards[shard_id] = _load_faiss(os.path.join(directory, info['path']), embeddings, allow_deser)
+            store.paths[shard_id] = info['path']
+            if info.get('scope'):
+                store.scopes[shard_id] = info['scope']
+        return store if store.shards else None
+
+    # -- placement -------------------------------------------------------------------------
+
+    def shard_for(self, source_path, scope=None):
+        """Shard id a (new or changed) document should be written to."""
+        if scope:
+            key = f"{scope.get('uploader')}\0{scope.get('chat_id')}"
+            return 'c' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+        if SHARD_MODE == 'document':
+            return 'd' + hashlib.sha1(os.path.abspath(source_path).encode('utf-8')).hexdigest()[:12]
+        numbered = sorted(s for s in self.shards if s.startswith('s'))
+        if numbered and self.shards[numbered[-1]].index.ntotal < SHARD_MAX_CHUNKS:
+            return numbered[-1]
+        if not numbered and LEGACY_SHARD in self.shards and self.shards[LEGACY_SHARD].index.ntotal < SHARD_MAX_CHUNKS:
+            return LEGACY_SHARD
+        next_no = int(numbered[-1][1:]) + 1 if numbered else 0
+        return f"s{next_no:04d}"
+
+    def get(self, shard_id):
+        return self.shards.get(shard_id)
+
+    def put(self, shard_id, vectorstore, scope=None):
+        self.shards[shard_id] = vectorstore
+        self.paths.setdefault(shard_id, os.path.join(SHARDS_DIR, shard_id))
+        if scope:
+            self.scopes[shard_id] = {'uploader': scope.get('uploader'), 'chat_id': scope.get('chat_id')}
+        self.removed.discard(shard_id)
+        self.dirty.add(shard_id)
+
+    def delete(self, chunk_ids):
+        """Remove chunk ids from whichever shards hold them. Returns the number removed."""
+        wanted = set(chunk_ids)
+        removed = 0
+        for shard_id, shard in self.shards.items():
+            ids = [cid for cid in shard.index_to_docstore_id.values() if cid in wanted]
+            if ids:
+                shard.delete(ids)
+                self.dirty.add(shard_id)
+                removed += len(ids)
+        return removed
+
+    def drop_empty(self):
+        for shard_id in [s for s, shard in self.shards.items() if shard.index.ntotal == 0]:
+            del self.shards[shard_id]
+            self.scopes.pop(shard_id, None)
+            self._positions.pop(shard_id, None)
+            self.dirty.discard(shard_id)
+            self.removed.add(shard_id)
+
+    # -- introspection ---------------------------------------------------------------------
+
+    @property
+    def ntotal(self):
+        return sum(shard.index.ntotal for shard in self.shards.values())
+
+    def chunk_ids(self):
+        for shard in self.shards.values():
+            yield from shard.index_to_docstore_id.values()
+
+    def _position_map(self, shard_id, shard):
+        # add_embeddings grows index_to_docstore_id in place and delete() replaces it, so
+        # (identity, length) tells whether the cached reverse map is still valid
+        mapping = shard.index_to_docstore_id
+        key = (id(mapping), len(mapping))
+        cached = self._positions.get(shard_id)
+        if cached is None or cached[0] != key:
+            cached = self._positions[shard_id] = (key, {cid: pos for pos, cid in mapping.items()})
+        return cached[1]
+
+    def vectors_for(self, chunk_ids):
+        """{chunk_id: vector} reconstructed from the indexes (approximate for compressed index types)."""
+        wanted = set(chunk_ids)
+        found = {}
+        for shard_id, shard in self.shards.items():
+            positions = self._position_map(shard_id, shard)
+            for cid in wanted & positions.keys():
+                found[cid] = shard.index.reconstruct(positions[cid])
+            wanted -= found.keys()
+            if not wanted:
+                break
+        return found
+
+    @property
+    def index_type(self):
+        types = {vector_index.index_type_of(shard.index) for shard in self.shards.values()}
+        if not types:
+            return None
+        return types.pop() if len(types) == 1 else 'mixed'
+
+    @property
+    def compressed(self):
+        return any(vector_index.index_type_of(shard.index) != 'flat' for shard in self.shards.values())
+
+    def layout(self):
+        layout = {}
+        for shard_id, shard in sorted(self.shards.items()):
+            layout[shard_id] = {'path': self.paths[shard_id], 'chunks': shard.index.ntotal}
+            if shard_id in self.scopes:
+                layout[shard_id]['scope'] = self.scopes[shard_id]
+        return layout
+
+    def select(self, scope=None):
+        """(shard_id, shard) pairs a search with this RetrievalScope has to visit."""
+        if scope is None:
+            return list(self.shards.items())
+        return [(shard_id, shard) for shard_id, shard in self.shards.items()
+                if scope_matches(self.scopes.get(shard_id), scope)]
+
+    def scope_key(self, scope=None):
+        """Sorted ids of the shards a search with this scope visits; scopes seeing the same shards share cache entries."""
+        return tuple(sorted(shard_id for shard_id, _ in self.select(scope)))
+
+    def latest_document(self, scope, exclude=frozenset()):
+        """Chunks, in document order, of the most recently indexed upload in scope ([] if none).
+
+        Only scoped (uploaded) shards are considered; document ids come from chunk metadata.
+        """
+        chunks = []
+        for shard_id, shard in self.select(scope):
+            if shard_id not in self.scopes:
+                continue
+            for i in sorted(shard.index_to_docstore_id):
+                chunk_id = shard.index_to_docstore_id[i]
+                if chunk_id in exclude:
+                    continue
+                doc = shard.docstore.search(chunk_id)
+                if hasattr(doc, 'metadata') and doc.metadata.get('document_id') is not None:
+                    chunks.append(doc)
+        if not chunks:
+            return []
+        latest = max(doc.metadata['document_id'] for doc in chunks)
+        return [doc for doc in chunks if doc.metadata['document_id'] == latest]
+
+    def disk_bytes(self):
+        """Size of the saved shard files (index.faiss + index.pkl)."""
+        total = 0
+        for shard_id in self.shards:
+            for name in ('index.faiss', 'index.pkl'):
+                path = os.path.join(self.directory, self.paths[shard_id], name)
+                if os.path.exists(path):
+                    total += os.path.getsize(path)
+        return total
+
+    def stats(self):
+        return {'shards': len(self.shards), 'scoped_shards': len(self.scopes), 'chunks': self.ntotal,
+                'index_bytes': self.disk_bytes(), 'mode': SHARD_MODE,
+                'per_shard': {shard_id: info['chunks'] for shard_id, info in self.layout().items()}}
+
+    # -- persistence -----------------------------------------------------------------------
+
+    def save(self, directory=None, everything=False):
+        """Write changed shards (or all of them) and delete dropped ones. Returns the shards touched."""
+        directory = directory or self.directory
+        targets = sorted(self.shards) if everything else sorted(self.dirty)
+        for shard_id in targets:
+            path = os.path.join(directory, self.paths[shard_id])
+            with tracing.span('indexer.save_shard', shard=shard_id, chunks=self.shards[shard_id].index.ntotal):
+                if self.paths[shard_id] == '.':
+                    self.shards[shard_id].save_local(path)
+                    continue
+                tmp, old = path + '.tmp', path + '.old'
+                shutil.rmtree(tmp, ignore_errors=True)
+                self.shards[shard_id].save_local(tmp)
+                shutil.rmtree(old, ignore_errors=True)
+                if os.path.exists(path):
+                    os.replace(path, old)
+                os.replace(tmp, path)
+                shutil.rmtree(old, ignore_errors=True)
+        touched = len(targets) + len(self.removed)
+        for shard_id in self.removed:
+            path = self.paths.pop(shard_id, None)
+            if path == '.':
+                for name in ('index.faiss', 'index.pkl'):
+                    if os.path.exists(os.path.join(directory, name)):
+                        os.remove(os.path.join(directory, name))
+            elif path:
+                shutil.rmtree(os.path.join(directory, path), ignore_errors=True)
+        self.dirty.clear()
+        self.removed.clear()
+        return touched
+
+    # -- search ----------------------------------------------------------------------------
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, scope=None, **kwargs):
+        """Top-k over the shards in scope: parallel per-shard search, then a k-way merge by distance."""
+        shards = self.select(scope)
+        if not shards:
+            return []
+        if len(shards) == 1:
+            return shards[0][1].similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+        def search(shard_id, shard):
+            with tracing.span('retrieval.shard_search', shard=shard_id):
+                return shard.similarity_search_with_score_by_vector(embedding, k=k, **kwargs)
+
+        # Each task runs in a copy of the caller's context so its span joins the request trace
+        pool = _search_pool()
+        futures = [pool.submit(contextvars.copy_context().run, search, shard_id, shard) for shard_id, shard in shards]
+        per_shard = [f.result() for f in futures]
+        # Every shard returns its hits sorted by ascending L2 distance
+        return list(itertools.islice(heapq.merge(*per_shard, key=lambda pair: pair[1]), k))
+
+    def similarity_search_with_score_by_vectors(self, vectors, k=4, scope=None):
+        """Top-k for many query vectors at once: one FAISS search per shard with the whole matrix.
+
+        Returns one list of (doc, distance) per query, as similarity_search_with_score_by_vector would.
+        """
+        matrix = np.asarray(vectors, dtype=np.float32)
+        shards = self.select(scope)
+        if not shards or not len(matrix):
+            return [[] for _ in range(len(matrix))]
+
+        def search(shard_id, shard):
+            query = matrix
+            if shard._normalize_L2:
+                import faiss
+                query = matrix.copy()
+                faiss.normalize_L2(query)
+            with tracing.span('retrieval.shard_search', shard=shard_id, queries=len(query)):
+                distances, indices = shard.index.search(query, k)
+            return [[(shard.docstore.search(shard.index_to_docstore_id[i]), float(d))
+                     for d, i in zip(row_d, row_i) if i != -1]
+                    for row_d, row_i in zip(distances, indices)]
+
+        pool = _search_pool()
+        futures = [pool.submit(contextvars.copy_context().run, search, shard_id, shard) for shard_id, shard in shards]
+        per_shard = [f.result() for f in futures]
+        return [list(itertools.islice(heapq.merge(*(hits[q] for hits in per_shard), key=lambda pair: pair[1]), k))
+                for q in range(len(matrix))]
+
+    def similarity_search_with_score(self, query, k=4, scope=None, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k=k, scope=scope, **kwargs)
@@ -0,0 +1,186 @@
+"""Fingerprinted, precompressed static assets.
+
+build() copies every non-HTML file in static/ to AQUAAI_ASSET_BUILD_DIR as
+<name>.<content hash>.<ext>, plus .gz (and .br when the brotli package is
+installed) variants, and rewrites the /static/... references in the HTML pages
+to /assets/<hashed name>. The app runs it at startup; ``python static_assets.py``
+runs it ahead of time (``--prune`` also deletes files from older builds).
+
+Hashed assets are served with a one-year immutable Cache-Control, so repeat
+visits don't request them at all. Pages are served with no-cache and a strong
+ETag, so a reload costs a 304. Both pick the smallest variant the client's
+Accept-Encoding allows.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+SOURCE_DIR = 'static'
+BUILD_DIR = os.environ.get('AQUAAI_ASSET_BUILD_DIR', 'static_build')
+PAGES = ('index.html', 'admin.html', 'login.html', 'forgot.html')
+MANIFEST_FILE = 'manifest.json'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+MIN_COMPRESS_BYTES = 512
+MIMETYPES = {'.js': 'application/javascript; charset=utf-8', '.css': 'text/css; charset=utf-8',
+             '.html': 'text/html; charset=utf-8', '.svg': 'image/svg+xml', '.json': 'application/json',
+             '.png': 'image/png', '.ico': 'image/x-icon', '.woff2': 'font/woff2'}
+# Only text formats are worth precompressing
+COMPRESSIBLE = ('.js', '.css', '.html', '.svg', '.json')
+
+_REFERENCE = re.compile(r"""(["'])/static/([^"'?#]+)\1""")
+
+# hashed file name / page name -> {'file', 'etag', 'type', 'bodies': {encoding: bytes}}
+_assets = {}
+_pages = {}
+
+
+def _digest(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _write(path, data, overwrite=False):
+    """Atomic write; content-addressed files that already exist are left alone."""
+    if not overwrite and os.path.exists(path):
+        return
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _variants(name, data):
+    bodies = {'identity': data}
+    if name.endswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS_BYTES:
+        bodies['gzip'] = gzip.compress(data, compresslevel=9, mtime=0)
+        if brotli is not None:
+            bodies['br'] = brotli.compress(data, quality=11)
+    return bodies
+
+
+def _emit(file_name, data, build_dir, overwrite=False):
+    bodies = _variants(file_name, data)
+    for encoding, body in bodies.items():
+        _write(os.path.join(build_dir, file_name + {'identity': '', 'gzip': '.gz', 'br': '.br'}[encoding]), body,
+               overwrite)
+    return {'file': file_name, 'etag': _digest(data),
+            'type': MIMETYPES.get(os.path.splitext(file_name)[1], 'application/octet-stream'), 'bodies': bodies}
+
+
+def build(source_dir=SOURCE_DIR, build_dir=BUILD_DIR):
+    """Fingerprint and precompress assets, rewrite pages, and load everything for serving."""
+    os.makedirs(build_dir, exist_ok=True)
+    assets, pages = {}, {}
+    for name in sorted(os.listdir(source_dir)):
+        path = os.path.join(source_dir, name)
+        if not os.path.isfile(path) or name.endswith('.html'):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        assets[name] = _emit(f"{stem}.{_digest(data)}{ext}", data, build_dir)
+
+    def rewrite(match):
+        entry = assets.get(match.group(2))
+        return f"{match.group(1)}/assets/{entry['file']}{match.group(1)}" if entry else match.group(0)
+
+    for name in PAGES:
+        path = os.path.join(source_dir, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8') as f:
+            html = _REFERENCE.sub(rewrite, f.read()).encode('utf-8')
+        pages[name] = _emit(name, html, build_dir, overwrite=True)
+
+    manifest = {name: entry['file'] for name, entry in assets.items()}
+    _write_manifest(os.path.join(build_dir, MANIFEST_FILE), manifest)
+    _assets.clear()
+    _assets.update({entry['file']: entry for entry in assets.values()})
+    _pages.clear()
+    _pages.update(pages)
+    return manifest
+
+
+def _write_manifest(path, manifest):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def prune(build_dir=BUILD_DIR):
+    """Delete build outputs not produced by the last build(). Returns the number removed."""
+    keep = {MANIFEST_FILE}
+    for entry in list(_assets.values()) + list(_pages.values()):
+        keep.update(entry['file'] + suffix for suffix in ('', '.gz', '.br'))
+    removed = 0
+    for name in os.listdir(build_dir):
+        if name not in keep:
+            os.remove(os.path.join(build_dir, name))
+            removed += 1
+    return removed
+
+
+def stats():
+    entries = list(_assets.values()) + list(_pages.values())
+    return {'assets': len(_assets), 'pages': len(_pages), 'brotli': brotli is not None,
+            'bytes': sum(len(e['bodies']['identity']) for e in entries),
+            'compressed_bytes': sum(min(len(body) for body in e['bodies'].values()) for e in entries)}
+
+
+# -- serving -------------------------------------------------------------------------------
+
+def _respond(entry, cache_control):
+    from flask import Response, request
+    encoding = 'identity'
+    for candidate in ('br', 'gzip'):
+        if candidate in entry['bodies'] and request.accept_encodings[candidate]:
+            encoding = candidate
+            break
+    # Each encoding is a different representation, so it gets its own strong validator
+    etag = entry['etag'] if encoding == 'identity' else f"{entry['etag']}-{encoding}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(entry['bodies'][encoding], headers=headers, content_type=entry['type'])
+
+
+def send_asset(file_name):
+    """Response for /assets/<file_name>, or None if it is not part of the current build."""
+    entry = _assets.get(file_name)
+    return _respond(entry, IMMUTABLE) if entry else None
+
+
+def send_page(name):
+    """Response for a rewritten HTML page, or None if the build has no such page."""
+    entry = _pages.get(name)
+    return _respond(entry, REVALIDATE) if entry else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--prune', action='store_true', help='Delete outputs of older builds')
+    args = parser.parse_args()
+    manifest = build()
+    for name, hashed in sorted(manifest.items()):
+        print(f"{name} -> {hashed}")
+    summary = stats()
+    print(f"{summary['assets']} asset(s), {summary['pages']} page(s) in {BUILD_DIR}: "
+          f"{summary['bytes']} bytes, {summary['compressed_bytes']} compressed"
+          + ('' if summary['brotli'] else ' (brotli not installed, gzip only)'))
+    if args.prune:
+        print(f"Pruned {prune()} stale file(s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+"""Cache of extracted PDF page text, keyed by the file's content hash.
+
+Parsing is the slowest CPU stage of indexing, so every page PyPDFLoader
+extracts is stored zlib-compressed in a small SQLite database
+(AQUAAI_TEXT_CACHE_DB, default parsed_text.db). Re-chunking or switching
+embedding models then runs from the cache instead of re-parsing the PDFs.
+
+A document only counts as cached once all of its pages were written, so an
+interrupted parse is simply parsed again next time. Callers embed between
+pages, so no connection stays open across a yield: pages are read up front
+and written in one short transaction once the parse is complete.
+"""
+import json
+import os
+import sqlite3
+import zlib
+from datetime import datetime
+
+from langchain_core.documents import Document
+
+TEXT_CACHE_DB = os.environ.get('AQUAAI_TEXT_CACHE_DB', 'parsed_text.db')
+
+
+def _connect(db_path=None):
+    conn = sqlite3.connect(db_path or TEXT_CACHE_DB, timeout=30)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS parsed_documents (
+            content_hash TEXT PRIMARY KEY,
+            pages INTEGER,
+            parsed_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS parsed_pages (
+            content_hash TEXT,
+            page_no INTEGER,
+            metadata TEXT,
+            text BLOB,
+            PRIMARY KEY (content_hash, page_no)
+        )
+    """)
+    return conn
+
+
+def is_cached(content_hash, db_path=None):
+    conn = _connect(db_path)
+    try:
+        row = conn.execute("SELECT 1 FROM parsed_documents WHERE content_hash = ?", (content_hash,)).fetchone()
+        return row is not None
+    finally:
+        conn.close()
+
+
+def cached_pages(content_hash, source=None, db_path=None):
+    """Yield cached pages as Documents (metadata 'source' set to `source`), or return None if not cached."""
+    if not is_cached(content_hash, db_path):
+        return None
+    return _read_pages(content_hash, source, db_path)
+
+
+def _read_pages(content_hash, source, db_path):
+    conn = _connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT metadata, text FROM parsed_pages WHERE content_hash = ? ORDER BY page_no", (content_hash,)
+        ).fetchall()
+    finally:
+        conn.close()
+    for metadata, blob in rows:
+        meta = json.loads(metadata) if metadata else {}
+        if source is not None:
+            meta['source'] = source
+        yield Document(page_content=zlib.decompress(blob).decode('utf-8'), metadata=meta)
+
+
+def iter_pages(path, content_hash, db_path=None):
+    """Yield the pages of a PDF, from the cache when possible, otherwise parsing and caching them."""
+    cached = cached_pages(content_hash, source=path, db_path=db_path)
+    if cached is not None:
+        yield from cached
+        return
+
+    from langchain_community.document_loaders import PyPDFLoader
+    # Only the compressed text is kept until the end, not the pages themselves
+    rows = []
+    for page in PyPDFLoader(path).lazy_load():
+        meta = {k: v for k, v in page.metadata.items() if k != 'source'}
+        rows.append((content_hash, len(rows), json.dumps(meta, default=str),
+                     zlib.compress(page.page_content.encode('utf-8'), 6)))
+        yield page
+    _write_pages(content_hash, rows, db_path)
+
+
+def _write_pages(content_hash, rows, db_path=None):
+    conn = _connect(db_path)
+    try:
+        with conn:
+            # Drop leftovers of an earlier interrupted parse
+            conn.execute("DELETE FROM parsed_pages WHERE content_hash = ?", (content_hash,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO parsed_pages (content_hash, page_no, metadata, text) VALUES (?, ?, ?, ?)", rows
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO parsed_documents (content_hash, pages, parsed_at) VALUES (?, ?, ?)",
+                (content_hash, len(rows), datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+    finally:
+        conn.close()
+
+
+def forget(content_hash, db_path=None):
+    conn = _connect(db_path)
+    try:
+        conn.execute("DELETE FROM parsed_pages WHERE content_hash = ?", (content_hash,))
+        conn.execute("DELETE FROM parsed_documents WHERE content_hash = ?", (content_hash,))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def stats(db_path=None):
+    conn = _connect(db_path)
+    try:
+        docs = conn.execute("SELECT COUNT(*) FROM parsed_documents").fetchone()[0]
+        pages, stored = conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(text)), 0) FROM parsed_pages").fetchone()
+        return {'documents': docs, 'pages': pages, 'compressed_bytes': stored}
+    finally:
+        conn.close()
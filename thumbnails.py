@@ -0,0 +1,189 @@
+"""Content-addressed image store with resized WebP/PNG derivatives.
+
+store(data, kind) keeps one copy of each distinct image under AQUAAI_MEDIA_DIR,
+named by the SHA-256 of its bytes, in its real format (whatever the upload
+claimed), and renders a WebP and a PNG thumbnail for every size in
+AQUAAI_THUMB_SIZES. Uploading the same image twice costs a hash and nothing
+else. A <digest>.json sidecar (written last, so it also marks a complete set)
+records the format, dimensions and the kinds of use (avatar, image). store()
+and remove() of one digest are serialized within the process, so concurrent
+uploads of the same picture neither collide nor lose a kind.
+
+send(digest, size) serves /media/<digest>/<size>: WebP when the client accepts
+it, PNG otherwise, with a strong ETag and an immutable one-year Cache-Control,
+since the content behind a URL never changes.
+"""
+import contextlib
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+import weakref
+
+import tracing
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+MEDIA_DIR = os.environ.get('AQUAAI_MEDIA_DIR', os.path.join('uploads', 'media'))
+SIZES = tuple(sorted(int(s) for s in os.environ.get('AQUAAI_THUMB_SIZES', '64,256,1024').split(',') if s.strip()))
+AVATAR_SIZE = 256
+VISION_SIZE = 1024  # what the vision model gets instead of the full-resolution upload
+FORMATS = ('webp', 'png')
+WEBP_QUALITY = 82
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+MAX_BYTES = 20 * 1024 * 1024
+
+
+_locks = weakref.WeakValueDictionary()   # digest -> lock, alive while someone holds or waits on it
+_locks_guard = threading.Lock()
+
+
+class ImageRejected(ValueError):
+    pass
+
+
+def _digest_lock(digest):
+    with _locks_guard:
+        lock = _locks.get(digest)
+        if lock is None:
+            lock = _locks[digest] = threading.Lock()
+        return lock
+
+
+def url(digest, size=AVATAR_SIZE):
+    return f"/media/{digest}/{size}"
+
+
+def digest_from_url(value):
+    """Digest of a /media/<digest>/<size> URL, or None for anything else (legacy paths, external URLs)."""
+    parts = (value or '').split('/')
+    if len(parts) == 4 and parts[1] == 'media' and parts[2].isalnum():
+        return parts[2]
+    return None
+
+
+def _meta_path(digest):
+    return os.path.join(MEDIA_DIR, f"{digest}.json")
+
+
+def derivative_path(digest, size, fmt):
+    return os.path.join(MEDIA_DIR, f"{digest}_{size}.{fmt}")
+
+
+def load_meta(digest):
+    try:
+        with open(_meta_path(digest), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def _encode(image, size, fmt):
+    thumb = image.copy()
+    thumb.thumbnail((size, size), Image.LANCZOS)
+    has_alpha = thumb.mode in ('RGBA', 'LA') or (thumb.mode == 'P' and 'transparency' in thumb.info)
+    thumb = thumb.convert('RGBA' if has_alpha else 'RGB')
+    out = io.BytesIO()
+    if fmt == 'webp':
+        thumb.save(out, 'WEBP', quality=WEBP_QUALITY, method=4)
+    else:
+        thumb.save(out, 'PNG', optimize=True)
+    return out.getvalue()
+
+
+def store(data, kind):
+    """Store image bytes and their derivatives. Returns the digest; raises ImageRejected for non-images."""
+    if Image is None:
+        raise ImageRejected('Pillow is not installed')
+    if len(data) > MAX_BYTES:
+        raise ImageRejected('Image too large')
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    with _digest_lock(digest):
+        return _store(data, digest, kind)
+
+
+def _store(data, digest, kind):
+    meta = load_meta(digest)
+    if meta is not None:
+        if kind not in meta['kinds']:
+            meta['kinds'].append(kind)
+            _write(_meta_path(digest), json.dumps(meta).encode('utf-8'))
+        return digest
+    try:
+        Image.open(io.BytesIO(data)).verify()
+        image = Image.open(io.BytesIO(data))
+        fmt = (image.format or 'png').lower()
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        raise ImageRejected('Not a readable image')
+
+    os.makedirs(MEDIA_DIR, exist_ok=True)
+    with tracing.span('image.derive', digest=digest, width=image.width, height=image.height):
+        _write(os.path.join(MEDIA_DIR, f"{digest}.{fmt}"), data)
+        for size in SIZES:
+            for out_fmt in FORMATS:
+                _write(derivative_path(digest, size, out_fmt), _encode(image, size, out_fmt))
+    meta = {'format': fmt, 'width': image.width, 'height': image.height, 'bytes': len(data), 'kinds': [kind]}
+    _write(_meta_path(digest), json.dumps(meta).encode('utf-8'))
+    return digest
+
+
+def remove(digest, kind):
+    """Drop one kind of use; delete the files once no kind is left. Returns True if deleted."""
+    with _digest_lock(digest):
+        return _remove(digest, kind)
+
+
+def _remove(digest, kind):
+    meta = load_meta(digest)
+    if meta is None:
+        return False
+    if kind in meta['kinds']:
+        meta['kinds'].remove(kind)
+    if meta['kinds']:
+        _write(_meta_path(digest), json.dumps(meta).encode('utf-8'))
+        return False
+    paths = [derivative_path(digest, size, fmt) for size in SIZES for fmt in FORMATS]
+    paths.append(os.path.join(MEDIA_DIR, f"{digest}.{meta['format']}"))
+    paths.append(_meta_path(digest))
+    for path in paths:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+    return True
+
+
+def send(digest, size):
+    """Flask response for a derivative (the nearest configured size at or above `size`), or None."""
+    from flask import Response, request
+    if not digest.isalnum() or load_meta(digest) is None:
+        return None
+    size = next((s for s in SIZES if s >= size), SIZES[-1])
+    # Only an explicit image/webp counts; */* alone is no promise the client decodes WebP
+    fmt = 'webp' if any(mt == 'image/webp' and q > 0 for mt, q in request.accept_mimetypes) else 'png'
+    path = derivative_path(digest, size, fmt)
+    if not os.path.exists(path):
+        return None
+    etag = f"{digest}-{size}-{fmt}"
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL, 'Vary': 'Accept'}
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    with open(path, 'rb') as f:
+        return Response(f.read(), headers=headers, content_type=f"image/{fmt}")
@@ -0,0 +1,369 @@
+"""Lightweight per-request tracing.
+
+Every sampled HTTP request gets a trace id. Code on the request path opens
+spans with ``with span("name", **attrs)``; finished spans are queued and
+written to a rotating JSONL file by a background thread so the request never
+waits on disk.
+
+Configuration (environment variables):
+- AQUAAI_TRACE_FILE: output file (default: requests.jsonl)
+- AQUAAI_TRACE_SAMPLE_RATE: fraction of requests traced, 0..1 (default: 1.0)
+- AQUAAI_TRACE_MAX_BYTES: rotate once the file grows past this (default: 10 MB)
+- AQUAAI_TRACE_BACKUPS: number of rotated files kept (default: 3)
+
+Summarize a trace file with:  python tracing.py --top 10
+"""
+import argparse
+import atexit
+import contextvars
+import functools
+import json
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+try:
+    from langchain_core.embeddings import Embeddings as _EmbeddingsBase
+except Exception:
+    _EmbeddingsBase = object
+
+TRACE_FILE = os.environ.get('AQUAAI_TRACE_FILE', 'requests.jsonl')
+SAMPLE_RATE = float(os.environ.get('AQUAAI_TRACE_SAMPLE_RATE', '1.0'))
+MAX_BYTES = int(os.environ.get('AQUAAI_TRACE_MAX_BYTES', str(10 * 1024 * 1024)))
+BACKUP_COUNT = int(os.environ.get('AQUAAI_TRACE_BACKUPS', '3'))
+QUEUE_SIZE = 10000
+
+_current_span = contextvars.ContextVar('aquaai_current_span', default=None)
+
+
+class Span:
+    """A timed unit of work belonging to a trace."""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'attrs', 'start', '_t0', '_token')
+
+    def __init__(self, name, trace_id, parent_id=None, attrs=None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attrs = dict(attrs or {})
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+        self._token = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, error=None):
+        duration_ms = (time.perf_counter() - self._t0) * 1000.0
+        record = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': round(self.start, 6),
+            'duration_ms': round(duration_ms, 3),
+            'status': 'error' if error else 'ok',
+        }
+        if self.attrs:
+            record['attrs'] = self.attrs
+        if error:
+            record['error'] = str(error)[:500]
+        _writer.submit(record)
+        return duration_ms
+
+
+class _NoopSpan:
+    """Returned when the current request is not sampled; accepts and drops attributes."""
+
+    trace_id = None
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class _TraceWriter:
+    """Background JSONL writer with size-based rotation. Never blocks callers."""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def submit(self, record):
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='trace-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Drain whatever else is waiting so a burst becomes a single write
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"Warning: failed to write trace spans: {e}")
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, batch):
+        directory = os.path.dirname(TRACE_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if os.path.exists(TRACE_FILE) and os.path.getsize(TRACE_FILE) >= MAX_BYTES:
+            self._rotate()
+        with open(TRACE_FILE, 'a', encoding='utf-8') as f:
+            for record in batch:
+                f.write(json.dumps(record, default=str) + '\n')
+
+    def _rotate(self):
+        for i in range(BACKUP_COUNT - 1, 0, -1):
+            src = f"{TRACE_FILE}.{i}"
+            if os.path.exists(src):
+                os.replace(src, f"{TRACE_FILE}.{i + 1}")
+        if BACKUP_COUNT > 0:
+            os.replace(TRACE_FILE, f"{TRACE_FILE}.1")
+        else:
+            os.remove(TRACE_FILE)
+
+    def flush(self, timeout=2.0):
+        """Wait (up to timeout seconds) until queued spans are written."""
+        if self._thread is None:
+            return
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.01)
+
+
+_writer = _TraceWriter()
+atexit.register(_writer.flush)
+
+
+def current_trace_id():
+    current = _current_span.get()
+    return current.trace_id if current is not None else None
+
+
+def start_trace(name, trace_id=None, **attrs):
+    """Start a root span for a new request. Returns None when the request is not sampled.
+
+    The returned span is the active span until end_trace() is called with it.
+    """
+    if SAMPLE_RATE <= 0 or random.random() >= SAMPLE_RATE:
+        return None
+    root = Span(name, trace_id or uuid.uuid4().hex, attrs=attrs)
+    root._token = _current_span.set(root)
+    return root
+
+
+def end_trace(root, error=None, **attrs):
+    if root is None:
+        return
+    root.set(**attrs)
+    root.finish(error=error)
+    if root._token is not None:
+        _current_span.reset(root._token)
+        root._token = None
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the enclosed block as a child of the active span (no-op outside a sampled trace)."""
+    parent = _current_span.get()
+    if parent is None:
+        yield _NOOP
+        return
+    child = Span(name, parent.trace_id, parent.span_id, attrs)
+    token = _current_span.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(error=e)
+        raise
+    else:
+        child.finish()
+    finally:
+        _current_span.reset(token)
+
+
+def traced(name):
+    """Decorator form of span()."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_span.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _short_sql(sql):
+    return ' '.join(str(sql).split())[:120]
+
+
+class TracedCursor(sqlite3.Cursor):
+    """sqlite3 cursor that records each statement as a span."""
+
+    def execute(self, sql, parameters=()):
+        if _current_span.get() is None:
+            return super().execute(sql, parameters)
+        with span('sqlite.execute', sql=_short_sql(sql)):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        if _current_span.get() is None:
+            return super().executemany(sql, seq_of_parameters)
+        with span('sqlite.executemany', sql=_short_sql(sql)):
+            return super().executemany(sql, seq_of_parameters)
+
+
+class TracedConnection(sqlite3.Connection):
+    """Pass as ``sqlite3.connect(..., factory=TracedConnection)`` to trace statements and commits."""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def commit(self):
+        if _current_span.get() is None:
+            return super().commit()
+        with span('sqlite.commit'):
+            return super().commit()
+
+
+class TracedEmbeddings(_EmbeddingsBase):
+    """Wrap an embeddings object so embedding calls show up as spans."""
+
+    def __init__(self, inner, model=None):
+        self.inner = inner
+        self.model = model or getattr(inner, 'model', None)
+
+    def embed_query(self, text):
+        with span('embeddings.embed_query', model=self.model, chars=len(text or '')):
+            return self.inner.embed_query(text)
+
+    def embed_documents(self, texts):
+        with span('embeddings.embed_documents', model=self.model, count=len(texts)):
+            return self.inner.embed_documents(texts)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper itself
+        if name == 'inner':
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+
+# --- Summary CLI -----------------------------------------------------------
+
+def load_spans(path=None):
+    path = path or TRACE_FILE
+    files = [f"{path}.{i}" for i in range(BACKUP_COUNT, 0, -1)] + [path]
+    spans = []
+    for fp in files:
+        if not os.path.exists(fp):
+            continue
+        with open(fp, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if 'trace_id' in record and 'duration_ms' in record:
+                    spans.append(record)
+    return spans
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def critical_path(root, children):
+    """Follow, from the root, the child that finished last at each level."""
+    path = [root]
+    node = root
+    while children.get(node['span_id']):
+        node = max(children[node['span_id']], key=lambda s: s['start'] + s['duration_ms'] / 1000.0)
+        path.append(node)
+    return path
+
+
+def summarize(spans, top=10, name_filter=None):
+    lines = []
+    by_name = {}
+    for s in spans:
+        by_name.setdefault(s['name'], []).append(s['duration_ms'])
+    lines.append(f"{'span':<40} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10} {'total ms':>12}")
+    rows = sorted(by_name.items(), key=lambda kv: sum(kv[1]), reverse=True)
+    for name, durations in rows[:max(top, 1) * 3]:
+        lines.append(f"{name[:40]:<40} {len(durations):>7} {_percentile(durations, 50):>10.1f} "
+                     f"{_percentile(durations, 95):>10.1f} {max(durations):>10.1f} {sum(durations):>12.1f}")
+
+    children = {}
+    roots = []
+    for s in spans:
+        if s.get('parent_id'):
+            children.setdefault(s['parent_id'], []).append(s)
+        else:
+            roots.append(s)
+    if name_filter:
+        roots = [r for r in roots if name_filter in r['name']]
+    roots.sort(key=lambda s: s['duration_ms'], reverse=True)
+
+    lines.append('')
+    lines.append(f"Slowest {min(top, len(roots))} request(s) and their critical paths:")
+    for root in roots[:top]:
+        lines.append(f"\n{root['name']}  {root['duration_ms']:.1f} ms  trace={root['trace_id']}")
+        for depth, s in enumerate(critical_path(root, children)):
+            own = s['duration_ms'] - sum(c['duration_ms'] for c in children.get(s['span_id'], []))
+            lines.append(f"  {'  ' * depth}{s['name']}  {s['duration_ms']:.1f} ms (self {max(own, 0.0):.1f} ms)")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize AquaAI request traces")
+    parser.add_argument('--file', default=TRACE_FILE, help='Trace JSONL file (rotated backups are read too)')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest requests to show')
+    parser.add_argument('--filter', dest='name_filter', help="Only requests whose root span contains this text, e.g. '/api/message'")
+    args = parser.parse_args()
+
+    spans = load_spans(args.file)
+    if not spans:
+        print(f"No spans found in {args.file}")
+        return
+    print(summarize(spans, top=args.top, name_filter=args.name_filter))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Compressed FAISS index types and exact re-ranking.
+
+AQUAAI_INDEX_TYPE selects how new indexes store their vectors:
+- flat  (default): float32, 4 bytes per dimension
+- fp16:  scalar-quantized float16, 2 bytes per dimension
+- int8:  scalar-quantized 8-bit, 1 byte per dimension (trained min/max)
+- pq:    product quantization, AQUAAI_PQ_M bytes per vector (trained codebooks)
+
+For every type except flat, the full-precision vectors are also written to a
+SQLite archive next to the index (full_vectors.db). Searches can then fetch
+AQUAAI_RERANK_FACTOR x k candidates from the compressed index and re-rank them
+exactly, which recovers most of the recall lost to quantization while the
+resident index stays small.
+"""
+import os
+import sqlite3
+
+import numpy as np
+
+INDEX_TYPES = ('flat', 'fp16', 'int8', 'pq')
+INDEX_TYPE = os.environ.get('AQUAAI_INDEX_TYPE', 'flat').strip().lower()
+PQ_M = int(os.environ.get('AQUAAI_PQ_M', '0') or 0)          # 0 = dim // 16
+TRAIN_SIZE = int(os.environ.get('AQUAAI_INDEX_TRAIN_SIZE', '2048'))
+RERANK_FACTOR = int(os.environ.get('AQUAAI_RERANK_FACTOR', '4'))   # 0/1 disables re-ranking
+FULL_VECTORS_FILE = 'full_vectors.db'
+
+
+def needs_training(index_type):
+    return index_type in ('int8', 'pq')
+
+
+def _pq_m(dim):
+    m = PQ_M or max(1, dim // 16)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def create_index(train_vectors, index_type=INDEX_TYPE):
+    """Create (and train, if needed) an empty L2 index for vectors shaped like train_vectors."""
+    import faiss
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown AQUAAI_INDEX_TYPE '{index_type}'. Use one of: {', '.join(INDEX_TYPES)}")
+    train = np.ascontiguousarray(train_vectors, dtype=np.float32)
+    dim = train.shape[1]
+    if index_type == 'pq' and len(train) < 256:
+        # 8-bit PQ codebooks need at least 256 training points
+        print(f"Warning: only {len(train)} vectors to train PQ; using int8 scalar quantization instead")
+        index_type = 'int8'
+    if index_type == 'flat':
+        return faiss.IndexFlatL2(dim)
+    if index_type == 'fp16':
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    if index_type == 'int8':
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    else:
+        index = faiss.IndexPQ(dim, _pq_m(dim), 8, faiss.METRIC_L2)
+    index.train(train)
+    return index
+
+
+def index_type_of(index):
+    """Best-effort name of an existing FAISS index's storage type."""
+    import faiss
+    if isinstance(index, faiss.IndexFlat):
+        return 'flat'
+    if isinstance(index, faiss.IndexPQ):
+        return 'pq'
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return 'fp16' if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'int8'
+    return type(index).__name__
+
+
+def bytes_per_vector(index):
+    import faiss
+    if index.ntotal == 0:
+        return 0.0
+    return faiss.serialize_index(index).nbytes / index.ntotal
+
+
+class FullVectorArchive:
+    """Full-precision vectors keyed by chunk id, stored on disk for exact re-ranking."""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, FULL_VECTORS_FILE)
+        conn = sqlite3.connect(self.path)
+        conn.execute("CREATE TABLE IF NOT EXISTS vectors (chunk_id TEXT PRIMARY KEY, vec BLOB)")
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def exists(directory):
+        return os.path.exists(os.path.join(directory, FULL_VECTORS_FILE))
+
+    def put(self, ids, vectors):
+        rows = [(cid, np.asarray(v, dtype=np.float32).tobytes()) for cid, v in zip(ids, vectors)]
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO vectors (chunk_id, vec) VALUES (?, ?)", rows)
+        finally:
+            conn.close()
+
+    def get(self, ids):
+        """Return {chunk_id: float32 vector} for the ids that are archived."""
+        ids = list(ids)
+        if not ids:
+            return {}
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            placeholders = ','.join('?' * len(ids))
+            rows = conn.execute(f"SELECT chunk_id, vec FROM vectors WHERE chunk_id IN ({placeholders})", ids).fetchall()
+        finally:
+            conn.close()
+        return {cid: np.frombuffer(blob, dtype=np.float32) for cid, blob in rows}
+
+    def all(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            rows = conn.execute("SELECT chunk_id, vec FROM vectors").fetchall()
+        finally:
+            conn.close()
+        return {cid: np.frombuffer(blob, dtype=np.float32) for cid, blob in rows}
+
+    def retain(self, live_ids):
+        """Drop archived vectors whose chunk is no longer in the index."""
+        live = set(live_ids)
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            stale = [(cid,) for (cid,) in conn.execute("SELECT chunk_id FROM vectors") if cid not in live]
+            with conn:
+                conn.executemany("DELETE FROM vectors WHERE chunk_id = ?", stale)
+        finally:
+            conn.close()
+        return len(stale)
+
+
+def rerank(query_vector, results, archive, k):
+    """Re-score (doc, score) candidates with exact squared L2 distance from archived vectors."""
+    full = archive.get(doc.id for doc, _ in results if getattr(doc, 'id', None))
+    if not full:
+        return results[:k]
+    query = np.asarray(query_vector, dtype=np.float32)
+    rescored = []
+    for doc, score in results:
+        vec = full.get(getattr(doc, 'id', None))
+        if vec is not None and vec.shape == query.shape:
+            diff = vec - query
+            score = float(diff @ diff)
+        rescored.append((doc, score))
+    rescored.sort(key=lambda pair: pair[1])
+    return rescored[:k]
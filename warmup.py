@@ -0,0 +1,180 @@
+"""Warm-up of lazily initialised resources, so the first requests after a deploy don't pay for them.
+
+start() runs these steps once, in a background thread, right after startup
+(AQUAAI_WARMUP=0 disables it):
+- imports: modules that are otherwise first imported inside a request
+- http: AQUAAI_WARMUP_CONNECTIONS parallel model lookups against the OpenAI API
+  (no tokens billed), leaving that many TLS connections open in the client's pool
+- index: one search per shard; every index type here is exhaustive, so this
+  touches all index pages and starts FAISS's worker threads
+- retrieval: a synthetic question through the real embed + search path
+- sqlite: the queries behind the chat list, history and search pages, which pull
+  their tables, indexes and the FTS index into the page cache
+
+Every step records its duration and outcome; a failing step doesn't stop the
+others. stats() (readiness and step timings) and rss_bytes() are reported by
+/api/diagnostics and /api/admin/system-status.
+"""
+import importlib
+import os
+import resource
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import tracing
+
+WARMUP_ENABLED = os.environ.get('AQUAAI_WARMUP', '1') in ('1', 'true', 'True')
+WARMUP_CONNECTIONS = int(os.environ.get('AQUAAI_WARMUP_CONNECTIONS', '2'))
+HTTP_TIMEOUT = 5.0
+WARMUP_QUESTION = 'How does irrigation scheduling affect crop water productivity?'
+IMPORTS = ('langchain_community.document_loaders', 'langchain_community.docstore.in_memory', 'pypdf', 'PIL.Image')
+# Full scans pull the tables into the page cache; the lookups do the same for the indexes the pages use
+PRIMING_QUERIES = (
+    ("SELECT COUNT(*), MAX(LENGTH(message)) FROM conversations", ()),
+    ("SELECT COUNT(*), MAX(LENGTH(chat_name)) FROM chat_metadata", ()),
+    ("SELECT COUNT(*), MAX(LENGTH(username)) FROM users", ()),
+    ("SELECT role, message FROM conversations WHERE chat_id = ? ORDER BY id DESC LIMIT 10", ('',)),
+    ("SELECT chat_id, chat_name FROM chat_metadata WHERE user_id = ?", ('',)),
+    ("SELECT id FROM users WHERE username = ?", ('',)),
+    ("SELECT rowid FROM conversations_fts WHERE conversations_fts MATCH ? LIMIT 1", ('"irrigation"',)),
+)
+
+_state = {'status': 'pending', 'steps': {}, 'total_ms': None}
+_lock = threading.Lock()
+
+
+class Skipped(Exception):
+    """A step with nothing to warm in this configuration (no API key, no vectorstore, ...)."""
+
+
+def warm_imports():
+    missing = []
+    for name in IMPORTS:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            missing.append(name)
+    return f"{len(IMPORTS) - len(missing)} module(s)" + (f", not installed: {', '.join(missing)}" if missing else '')
+
+
+def warm_http(llm):
+    client = getattr(llm, 'root_client', None)
+    if client is None or not os.environ.get('OPENAI_API_KEY'):
+        raise Skipped('no OpenAI client configured')
+    import openai
+    # with_options() keeps the same httpx client, so the connections stay in the shared pool
+    probe = client.with_options(timeout=HTTP_TIMEOUT, max_retries=0)
+    model = getattr(llm, 'model_name', None) or 'gpt-5-mini'
+
+    def connect(_):
+        try:
+            probe.models.retrieve(model)
+        except openai.APIStatusError as e:
+            # Any HTTP status means the TCP + TLS connection is up, which is all this is for
+            return e.status_code
+        return 200
+
+    with ThreadPoolExecutor(max_workers=WARMUP_CONNECTIONS) as pool:
+        statuses = list(pool.map(connect, range(WARMUP_CONNECTIONS)))
+    return f"{len(statuses)} connection(s), HTTP {sorted(set(statuses))}"
+
+
+def warm_index(store):
+    if store is None:
+        raise Skipped('no vectorstore')
+    touched = 0
+    for shard_id, shard in store.shards.items():
+        if shard.index.ntotal == 0:
+            continue
+        with tracing.span('warmup.index', shard=shard_id):
+            shard.index.search(np.random.default_rng(0).random((1, shard.index.d), dtype=np.float32), 1)
+        touched += shard.index.ntotal
+    return f"{len(store.shards)} shard(s), {touched} vector(s)"
+
+
+def warm_retrieval(embed_question, search_by_vector, store):
+    if store is None:
+        raise Skipped('no vectorstore')
+    vector = embed_question(WARMUP_QUESTION)
+    if vector is None:
+        raise Skipped('embeddings unavailable')
+    return f"{len(search_by_vector(vector))} result(s)"
+
+
+def warm_sqlite(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    primed = 0
+    try:
+        for query, params in PRIMING_QUERIES:
+            try:
+                conn.execute(query, params).fetchall()
+                primed += 1
+            except sqlite3.OperationalError:
+                pass  # table or column of an older schema / FTS5 not available
+    finally:
+        conn.close()
+    return f"{primed}/{len(PRIMING_QUERIES)} queries"
+
+
+def _run_step(name, fn):
+    start = time.perf_counter()
+    try:
+        with tracing.span(f'warmup.{name}'):
+            detail = fn()
+        outcome = {'ok': True, 'detail': detail}
+    except Skipped as e:
+        outcome = {'ok': True, 'skipped': True, 'detail': str(e)}
+    except Exception as e:
+        outcome = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+    outcome['ms'] = round((time.perf_counter() - start) * 1000.0, 1)
+    with _lock:
+        _state['steps'][name] = outcome
+    return outcome
+
+
+def run(steps):
+    """Run (name, fn) steps in order, recording each one. Returns the final state."""
+    with _lock:
+        _state.update(status='running', steps={}, total_ms=None)
+    start = time.perf_counter()
+    for name, fn in steps:
+        _run_step(name, fn)
+    with _lock:
+        _state['total_ms'] = round((time.perf_counter() - start) * 1000.0, 1)
+        _state['status'] = 'ready'
+        failed = [name for name, step in _state['steps'].items() if not step['ok']]
+    print(f"Warm-up finished in {_state['total_ms']:.0f} ms" + (f"; failed: {', '.join(failed)}" if failed else ''))
+    return stats()
+
+
+def start(steps):
+    """Run the steps in a daemon thread (or mark the app ready at once when warm-up is disabled)."""
+    if not WARMUP_ENABLED:
+        with _lock:
+            _state['status'] = 'disabled'
+        return None
+    thread = threading.Thread(target=run, args=(list(steps),), name='warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def stats():
+    with _lock:
+        return {'ready': _state['status'] in ('ready', 'disabled'), 'status': _state['status'],
+                'total_ms': _state['total_ms'], 'steps': {name: dict(step) for name, step in _state['steps'].items()}}
+
+
+def rss_bytes():
+    """Current resident set size (peak RSS where /proc is not available)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # ru_maxrss is in bytes on macOS, KiB elsewhere
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024